@@ -0,0 +1,124 @@
+"""Бенчмарк сжатия сообщений: байты в сети и процессорное время на сообщение
+
+Корпус синтетический: короткие реплики на русском и английском из
+шаблонов со случайными именами, адресами и числами, плюс редкие длинные
+сообщения (логи, вставки кода). Сравниваются кадры без сжатия, deflate
+без словаря и deflate с общим словарём.
+
+Запуск: python benchmarks/bench_compression.py
+"""
+import os
+import random
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.compression import compress, decompress
+from modules.protocol import HEADER_SIZE, MSG_CHAT, encode_chat
+from modules.fragments import fragment
+
+MESSAGES = 20000
+SEED = 7
+MAX_MESSAGE = 1024 * 1024
+
+SHORT = [
+    "Всем привет!",
+    "ок",
+    "Спасибо, сейчас посмотрю",
+    "Кто-нибудь знает, почему сервер не отвечает?",
+    "Перезапустил {service}, проверьте пожалуйста",
+    "Сборка {build} опять упала на тестах",
+    "Обед в {hour}:00?",
+    "Не работает принтер на {floor} этаже",
+    "Коллеги, на {ip} снова упал {service}, перезапускаю",
+    "Скинул документ в общую папку",
+    "Совещание перенесли на {hour}:30",
+    "да",
+    "нет, ещё не смотрел",
+    "Good morning everyone!",
+    "Thanks, I will check it now",
+    "Build {build} is failing on integration tests again",
+    "Can someone review my pull request?",
+    "Please restart {service} on {ip}",
+    "ok",
+]
+SERVICES = ["nginx", "postgres", "jenkins", "сервис сборки", "почта", "1С", "файловый сервер"]
+LONG = [
+    "Traceback (most recent call last):\n  File \"/srv/app/main.py\", line {hour}, in run\n"
+    "    result = handler(request)\nConnectionError: connection refused by {ip}",
+    "Коллеги, напоминаю: завтра в {hour}:00 планёрка в переговорной. Пожалуйста, "
+    "подготовьте короткий отчёт по задачам за неделю и список проблем, которые "
+    "нужно обсудить. Если не сможете прийти, напишите заранее.",
+]
+
+
+def corpus():
+    rng = random.Random(SEED)
+    names = [f"192.168.1.{rng.randint(2, 254)}" for _ in range(30)]
+    messages = []
+    for _ in range(MESSAGES):
+        template = rng.choice(LONG) if rng.random() < 0.03 else rng.choice(SHORT)
+        text = template.format(service=rng.choice(SERVICES), build=rng.randint(100, 9999),
+                               hour=rng.randint(9, 18), floor=rng.randint(1, 5),
+                               ip=f"10.0.0.{rng.randint(2, 254)}")
+        messages.append(encode_chat(rng.choice(names), text))
+    return messages
+
+
+def plain_zlib(payload):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    data = compressor.compress(payload) + compressor.flush()
+    return data if len(data) < len(payload) else None
+
+
+def wire_bytes(payload):
+    return sum(len(datagram) for datagram in fragment(MSG_CHAT, 1, 1, 0, payload))
+
+
+def run(label, payloads, pack):
+    start = time.perf_counter()
+    packed = [pack(payload) for payload in payloads]
+    elapsed = time.perf_counter() - start
+    wire = 0
+    compressed = 0
+    for payload, data in zip(payloads, packed):
+        if data is not None:
+            compressed += 1
+            payload = data
+        wire += wire_bytes(payload)
+    return label, wire, compressed, elapsed, packed
+
+
+def main():
+    payloads = corpus()
+    raw = sum(len(payload) for payload in payloads)
+    print(f"корпус: {len(payloads)} сообщений, {raw} байт нагрузки, "
+          f"заголовок {HEADER_SIZE} байт на датаграмму\n")
+    print(f"{'':<22} {'байт в сети':>12} {'на сообщение':>13} {'сжато':>7} {'мкс/сжатие':>11} {'мкс/распаковка':>15}")
+
+    results = [
+        run("без сжатия", payloads, lambda payload: None),
+        run("deflate без словаря", payloads, plain_zlib),
+        run("deflate со словарём", payloads, compress),
+    ]
+    for label, wire, compressed, elapsed, packed in results:
+        unpack = ""
+        if label == "deflate со словарём":
+            blobs = [data for data in packed if data is not None]
+            start = time.perf_counter()
+            for data in blobs:
+                decompress(data, MAX_MESSAGE)
+            unpack = f"{(time.perf_counter() - start) / max(1, len(blobs)) * 1e6:.1f}"
+        print(f"{label:<22} {wire:>12} {wire / len(payloads):>13.1f} "
+              f"{compressed / len(payloads):>7.0%} {elapsed / len(payloads) * 1e6:>11.1f} {unpack:>15}")
+
+    # Корректность: распаковка возвращает исходную нагрузку
+    for payload, data in zip(payloads, results[2][4]):
+        if data is not None:
+            assert decompress(data, MAX_MESSAGE) == payload
+
+
+if __name__ == "__main__":
+    main()
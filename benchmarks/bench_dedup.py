@@ -0,0 +1,111 @@
+"""Бенчмарк подавления повторов: множество ключей против окна номеров и фильтра Блума
+
+Поток кадров от SENDERS отправителей, где каждый DUPLICATE_EVERY-й кадр -
+копия недавнего (второй интерфейс, ретранслятор, повтор по NACK).
+Сравниваются множество ключей с очередью сроков (как было у
+ретранслятора), SeenFilter для кадров с номерами и RotatingBloom для
+кадров вне последовательности: время на кадр, память по tracemalloc и
+ошибки - пропущенные повторы и новые кадры, принятые за повтор.
+
+Запуск: python benchmarks/bench_dedup.py
+"""
+import os
+import random
+import sys
+import time
+import tracemalloc
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.dedup import RotatingBloom, SeenFilter
+
+SENDERS = 64
+FRAMES = 200000
+DUPLICATE_EVERY = 4
+# Насколько назад (в кадрах потока) уходит копия
+DUPLICATE_DISTANCE = 500
+WINDOW = 10.0
+
+
+class KeySet:
+    """Ключи за последние window секунд: множество и очередь сроков"""
+
+    def __init__(self, window):
+        self.window = window
+        self.keys = set()
+        self.order = deque()
+
+    def seen(self, sender, seq):
+        return not self.add((sender, seq))
+
+    def add(self, key):
+        now = time.monotonic()
+        while self.order and self.order[0][0] <= now:
+            self.keys.discard(self.order.popleft()[1])
+        if key in self.keys:
+            return False
+        self.keys.add(key)
+        self.order.append((now + self.window, key))
+        return True
+
+
+def stream():
+    """Кадры (отправитель, номер, повтор ли)"""
+    rng = random.Random(1)
+    senders = [rng.getrandbits(64) for _ in range(SENDERS)]
+    seqs = dict.fromkeys(senders, 0)
+    history = []
+    frames = []
+    for index in range(FRAMES):
+        if index % DUPLICATE_EVERY == DUPLICATE_EVERY - 1 and len(history) > DUPLICATE_DISTANCE:
+            sender, seq = history[-rng.randint(1, DUPLICATE_DISTANCE)]
+            frames.append((sender, seq, True))
+            continue
+        sender = rng.choice(senders)
+        seqs[sender] += 1
+        history.append((sender, seqs[sender]))
+        frames.append((sender, seqs[sender], False))
+    return frames
+
+
+def run(name, check, frames):
+    start = time.perf_counter()
+    verdicts = [check(sender, seq) for sender, seq, _ in frames]
+    elapsed = time.perf_counter() - start
+    missed = sum(1 for verdict, (_, _, duplicate) in zip(verdicts, frames) if duplicate and not verdict)
+    false = sum(1 for verdict, (_, _, duplicate) in zip(verdicts, frames) if verdict and not duplicate)
+    print(f"{name:<34} {elapsed / len(frames) * 1e9:8.0f} нс/кадр  "
+          f"пропущено повторов {missed}, ложных {false}")
+
+
+def memory(factory, frames):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    check = factory()
+    for sender, seq, _ in frames:
+        check(sender, seq)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used
+
+
+def main():
+    frames = stream()
+    print(f"{len(frames)} кадров от {SENDERS} отправителей, каждый {DUPLICATE_EVERY}-й - повтор")
+    variants = [
+        ("множество ключей (окно 10 с)", lambda: KeySet(WINDOW).seen),
+        ("SeenFilter (окно номеров)", lambda: SeenFilter().seen),
+        ("RotatingBloom (вне последовательности)",
+         lambda: (lambda bloom: lambda sender, seq: not bloom.add((sender, seq)))(RotatingBloom(capacity=1 << 18))),
+    ]
+    for name, factory in variants:
+        run(name, factory(), frames)
+    for name, factory in variants:
+        print(f"{name:<34} {memory(factory, frames) / 1024:8.0f} КиБ")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+"""Микробенчмарк: бинарный кадр против старого формата "workstation:message"
+
+Запуск: python benchmarks/bench_protocol.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.protocol import (MSG_CHAT, ProtocolError, decode_chat, decode_frame,
+                              encode_chat, encode_frame, new_sender_id, now_ms,
+                              peek_sender)
+
+NAME = "192.168.1.10"
+TEXT = "Привет, коллеги! Сборка на стенде прошла, можно проверять."
+NUMBER = 200000
+
+OWN_ID = new_sender_id()
+PEER_ID = OWN_ID ^ 1
+
+
+def check_round_trip():
+    """Проверка, что кадр разбирается обратно без потерь"""
+    for name, text in ((NAME, TEXT), ("host:with:colons", "a:b:c"), ("", ""),
+                       ("пользователь", "x" * 60000)):
+        data = encode_frame(MSG_CHAT, PEER_ID, 42, 1234567890123, encode_chat(name, text), flags=0x5)
+        frame = decode_frame(data)
+        assert (frame.msg_type, frame.flags, frame.sender, frame.seq, frame.timestamp) == \
+            (MSG_CHAT, 0x5, PEER_ID, 42, 1234567890123)
+        assert decode_chat(frame.payload) == (name, text)
+        assert peek_sender(data) == PEER_ID
+    assert peek_sender(b"192.168.1.10:hello world, this is old text") is None
+    assert peek_sender(b"\xc1\x01") is None
+    try:
+        decode_frame(encode_frame(MSG_CHAT, PEER_ID, 1, 0, b"\x00abc")[:-1])
+    except ProtocolError:
+        pass
+    else:
+        raise AssertionError("обрезанный кадр не отвергнут")
+
+
+def old_encode():
+    return f"{NAME}:{TEXT}".encode('utf-8')
+
+
+def old_receive(data, own=NAME):
+    message = data.decode('utf-8', errors='ignore')
+    if ':' in message:
+        workstation, msg = message.split(':', 1)
+        if workstation != own:
+            return workstation, msg
+    return None
+
+
+def new_encode():
+    return encode_frame(MSG_CHAT, PEER_ID, 1, now_ms(), encode_chat(NAME, TEXT))
+
+
+def new_receive(data, own=OWN_ID):
+    sender = peek_sender(data)
+    if sender is None or sender == own:
+        return None
+    return decode_chat(decode_frame(data).payload)
+
+
+def bench(label, stmt):
+    seconds = min(timeit.repeat(stmt, number=NUMBER, repeat=3))
+    print(f"{label:<40} {seconds / NUMBER * 1e9:8.0f} нс/оп")
+
+
+def main():
+    check_round_trip()
+
+    old_data = old_encode()
+    new_data = new_encode()
+    own_old = old_data
+    own_new = encode_frame(MSG_CHAT, OWN_ID, 1, now_ms(), encode_chat(NAME, TEXT))
+    foreign = b"\x17" + os.urandom(len(new_data) - 1)
+
+    print(f"Размер датаграммы: старый {len(old_data)} байт, новый {len(new_data)} байт")
+    bench("старый: кодирование", old_encode)
+    bench("новый:  кодирование", new_encode)
+    bench("старый: приём чужого сообщения", lambda: old_receive(old_data, own="other"))
+    bench("новый:  приём чужого сообщения", lambda: new_receive(new_data))
+    bench("старый: отбрасывание своего эха", lambda: old_receive(own_old))
+    bench("новый:  отбрасывание своего эха", lambda: new_receive(own_new))
+    bench("новый:  отбрасывание постороннего пакета", lambda: new_receive(foreign))
+
+
+if __name__ == "__main__":
+    main()
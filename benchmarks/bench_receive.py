@@ -0,0 +1,120 @@
+"""Бенчмарк пути приёма: recvfrom + decode + split против recv_into в пул буферов
+
+Датаграммы идут через UDP на 127.0.0.1: отправитель заполняет буфер
+приёма пачкой, затем замеряется только разбор этой пачки. Пиковое
+выделение памяти на пакет считается через tracemalloc отдельным проходом.
+
+Запуск: python benchmarks/bench_receive.py
+"""
+import os
+import socket
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.buffers import BufferPool
+from modules.messages import ChatMessage
+from modules.protocol import (MSG_CHAT, RECV_BUFFER, decode_frame, encode_chat,
+                              encode_frame, new_sender_id, now_ms, peek_sender)
+
+BATCH = 256
+ROUNDS = 200
+NAME = "192.168.1.10"
+TEXT = "Коллеги, на 10.0.0.15 снова упал сервис сборки, перезапускаю"
+
+OWN_ID = new_sender_id()
+PEER_ID = OWN_ID ^ 1
+
+
+def old_datagrams(own):
+    return [f"{NAME if own else 'peer'}:{TEXT} {i}".encode('utf-8') for i in range(BATCH)]
+
+
+def new_datagrams(own):
+    sender = OWN_ID if own else PEER_ID
+    return [encode_frame(MSG_CHAT, sender, i + 1, now_ms(), encode_chat(NAME, f"{TEXT} {i}"))
+            for i in range(BATCH)]
+
+
+def old_receive(sock, keep):
+    data, addr = sock.recvfrom(4096)
+    message = data.decode('utf-8', errors='ignore')
+    if ':' in message:
+        workstation, msg = message.split(':', 1)
+        if workstation != NAME:
+            keep.append((workstation, msg))
+
+
+def make_new_receive(pool):
+    def new_receive(sock, keep):
+        buffer = pool.acquire()
+        try:
+            size = sock.recv_into(buffer)
+            view = memoryview(buffer)[:size]
+            sender = peek_sender(view)
+            if sender is None or sender == OWN_ID:
+                return
+            frame = decode_frame(view)
+            keep.append(ChatMessage.from_payload(bytes(frame.payload), False, frame.timestamp))
+        finally:
+            pool.release(buffer)
+    return new_receive
+
+
+def run(receive, datagrams, trace=False):
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    receiver.bind(('127.0.0.1', 0))
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = receiver.getsockname()
+
+    elapsed = 0.0
+    peak = 0
+    packets = 0
+    for _ in range(ROUNDS if not trace else 4):
+        for data in datagrams:
+            sender.sendto(data, address)
+        keep = []
+        if trace:
+            for _ in datagrams:
+                before = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                receive(receiver, keep)
+                peak += tracemalloc.get_traced_memory()[1] - before
+        else:
+            start = time.perf_counter()
+            for _ in datagrams:
+                receive(receiver, keep)
+            elapsed += time.perf_counter() - start
+        packets += len(datagrams)
+
+    receiver.close()
+    sender.close()
+    if trace:
+        return peak / packets
+    return packets / elapsed
+
+
+def main():
+    pool = BufferPool(4, RECV_BUFFER)
+    new_receive = make_new_receive(pool)
+    cases = [
+        ("старый путь, чужие сообщения", old_receive, old_datagrams(False)),
+        ("новый путь, чужие сообщения", new_receive, new_datagrams(False)),
+        ("старый путь, собственное эхо", old_receive, old_datagrams(True)),
+        ("новый путь, собственное эхо", new_receive, new_datagrams(True)),
+    ]
+    print(f"{'':<32} {'пакетов/с':>12} {'пик байт/пакет':>15}")
+    for label, receive, datagrams in cases:
+        pps = run(receive, datagrams)
+        tracemalloc.start()
+        allocated = run(receive, datagrams, trace=True)
+        tracemalloc.stop()
+        print(f"{label:<32} {pps:>12.0f} {allocated:>15.0f}")
+    print(f"промахов пула: {pool.misses}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Бенчмарк холодного старта: консольная утилита против окна чата
+
+Каждый замер - новый процесс интерпретатора. Сравниваются:
+
+    import modules.network     сетевое ядро без Qt
+    import messenger           точка входа (Qt не загружается)
+    chim.py --help             разбор аргументов консольной утилиты
+    chim.py send               полная отправка сообщения (с ожиданием NACK)
+    import gui                 загрузка PyQt5 и классов окна
+    окно чата                  QApplication и ChatWindow до первого кадра
+
+Окно создаётся с платформой offscreen, поэтому дисплей не нужен.
+Запуск: python benchmarks/bench_startup.py
+"""
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUNS = 10
+PORT = '5199'
+
+GUI_SCRIPT = """
+import os, sys
+import gui
+gui.ChatWindow.HISTORY_DIR = sys.argv[1]
+app = gui.QApplication(sys.argv[:1])
+window = gui.ChatWindow('bench')
+window.show()
+app.processEvents()
+window.close()
+"""
+
+CASES = [
+    ("пустой интерпретатор", ['-c', 'pass'], None),
+    ("import modules.network", ['-c', 'import modules.network'], None),
+    ("import messenger", ['-c', 'import messenger'], None),
+    ("chim.py --help", ['chim.py', '--help'], None),
+    ("chim.py send (с LINGER)", ['chim.py', '--port', PORT, 'send', 'тест'], None),
+    ("import gui (PyQt5)", ['-c', 'import gui'], None),
+    ("окно чата", ['-c', GUI_SCRIPT], 'history'),
+]
+
+
+def measure(args, extra):
+    env = dict(os.environ, QT_QPA_PLATFORM='offscreen', PYTHONDONTWRITEBYTECODE='1')
+    times = []
+    for _ in range(RUNS):
+        with tempfile.TemporaryDirectory() as directory:
+            command = [sys.executable] + args + ([directory] if extra else [])
+            start = time.perf_counter()
+            subprocess.run(command, cwd=ROOT, env=env, check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            times.append(time.perf_counter() - start)
+    return statistics.median(times), min(times)
+
+
+def main():
+    print(f"{'':<28} {'медиана, мс':>12} {'минимум, мс':>12}")
+    for label, args, extra in CASES:
+        median, best = measure(args, extra)
+        print(f"{label:<28} {median * 1000:>12.1f} {best * 1000:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
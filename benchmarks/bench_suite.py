@@ -0,0 +1,573 @@
+"""Нагрузочный бенчмарк: сеть на loopback multicast и вставка в окно чата
+
+Сетевая часть поднимает N экземпляров MulticastMessenger в одном цикле
+SelectorLoop на loopback-интерфейсе. Первый из них отправляет сообщения
+пачками, остальные принимают. Для каждого размера нагрузки
+измеряются пропускная способность (доставок в секунду), задержка от
+отправки до on_frame (p50/p99) и доля недоставленных сообщений.
+Время отправки передаётся в тексте сообщения (perf_counter_ns), поэтому
+задержка измеряется точнее миллисекундного поля заголовка.
+
+Интерфейсная часть создаёт ChatWindow с платформой offscreen и
+замеряет стоимость вставки 10 тысяч сообщений тремя путями:
+add_message (своё сообщение), drain_inbox (входящие пачкой за кадр) и
+late_arrivals (то же, но каждое LATE_EVERY-е опоздало на LATE_BY
+сообщений и встаёт на место двоичным поиском), а также прирост памяти процесса (RSS) и числа блоков памяти Python на
+10 тысяч сообщений. tracemalloc не используется: он в разы замедляет
+цикл и искажает время.
+
+Сценарий флуда запускает отдельный процесс, который шлёт в окно чата
+10 тысяч сообщений в секунду от одного отправителя и раз в секунду
+обычное сообщение от другого. Замеряется отзывчивость интерфейса -
+опоздание таймера 10 мс (p50/p99/максимум), - сколько сообщений
+подавлено лимитом отправителя и дошли ли все обычные. С --worker окно
+работает с сетью через отдельный процесс (modules/worker.py).
+
+Сценарий массовой отправки раздаёт файл со скоростью выше бюджета
+отправки и одновременно шлёт сообщения чата с того же клиента раз в
+20 мс. Замеряются задержка чата у получателя (p50/p99/максимум) и
+скорость раздачи файла.
+
+Сценарий узла хоста запускает N процессов-получателей на одной машине
+- каждый со своим сокетом и через общий узел (modules/hub.py) - и
+сравнивает суммарное процессорное время получателей на приём одного
+потока сообщений и число доставок.
+
+Результат пишется в JSON; --compare печатает изменения относительно
+файла от другого коммита:
+
+    python benchmarks/bench_suite.py -o before.json
+    python benchmarks/bench_suite.py -o after.json --compare before.json
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from modules.loop import SelectorLoop
+from modules.network import MulticastMessenger
+from modules.protocol import MSG_CHAT, decode_chat
+
+GROUP = '224.1.1.1'
+PEERS = 4
+MESSAGES = 2000
+SIZES = (32, 256, 1024, 4096, 16384)
+# Сколько сообщений отправитель выдаёт за одну итерацию цикла
+SEND_BATCH = 16
+# Сколько ждать доставки после последней отправки
+SETTLE = 2.0
+UI_MESSAGES = 10000
+# В late_arrivals каждое LATE_EVERY-е входящее опаздывает на LATE_BY
+# сообщений - больше пачки разбора, поэтому встаёт в середину списка
+LATE_EVERY = 10
+LATE_BY = 500
+FLOOD_RATE = 10000
+FLOOD_SECONDS = 3.0
+BULK_SECONDS = 3.0
+# Скорость раздачи файла в сценарии массовой отправки, бит/с
+BULK_RATE = 400 * 1000 * 1000
+BULK_FILE = 64 * 1024 * 1024
+CHAT_INTERVAL = 0.02
+HUB_CLIENTS = 8
+HUB_MESSAGES = 5000
+
+FLOOD_SCRIPT = """
+import sys, time
+sys.path.insert(0, sys.argv[1])
+from modules.loop import SelectorLoop
+from modules.network import MulticastMessenger
+rate, seconds = float(sys.argv[2]), float(sys.argv[3])
+loop = SelectorLoop()
+flood = MulticastMessenger('flood', loop, lambda frame: None)
+normal = MulticastMessenger('normal', loop, lambda frame: None)
+start = time.perf_counter()
+sent = normal_sent = 0
+while True:
+    elapsed = time.perf_counter() - start
+    if elapsed >= seconds:
+        break
+    while sent < rate * elapsed:
+        flood.send_message(f'флуд {sent}')
+        sent += 1
+    if normal_sent < elapsed:
+        normal.send_message(f'обычное {normal_sent}')
+        normal_sent += 1
+    loop.run_once(0.001)
+loop.run_once(0.5)
+print(sent, normal_sent)
+"""
+
+HUB_SCRIPT = """
+import sys, time
+sys.path.insert(0, sys.argv[1])
+from modules.hub import HubMessenger
+from modules.loop import SelectorLoop
+from modules.network import MulticastMessenger
+port, count, hub = int(sys.argv[2]), int(sys.argv[3]), sys.argv[4] == '1'
+loop = SelectorLoop()
+received = [0]
+def on_frame(frame):
+    received[0] += 1
+messenger = (HubMessenger if hub else MulticastMessenger)('client', loop, on_frame, '224.1.1.1', port)
+print('ready', flush=True)
+start = time.process_time()
+deadline = time.monotonic() + 30
+while received[0] < count and time.monotonic() < deadline:
+    loop.run_once(0.05)
+print(received[0], time.process_time() - start, flush=True)
+# Узел нужен остальным, пока они не дочитали: выход по закрытию stdin
+loop.add_reader(sys.stdin.fileno(), loop.stop)
+loop.run()
+messenger.close()
+"""
+
+WORDS = ("сервер", "сборка", "коллеги", "проверьте", "перезапустил", "обед", "build",
+         "deploy", "please", "check", "ok", "10.0.0.15", "логи", "ошибка", "готово")
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def filler(size, rng):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word.encode('utf-8')) + 1
+    return ' '.join(words).encode('utf-8')[:size].decode('utf-8', 'ignore')
+
+
+def run_network(peers, size, count, port, compression=True):
+    rng = random.Random(size)
+    loop = SelectorLoop()
+    latencies = []
+    delivered = [0]
+    last_delivery = [0.0]
+
+    def on_frame(frame):
+        if frame.msg_type != MSG_CHAT:
+            return
+        received = time.perf_counter_ns()
+        _, text = decode_chat(frame.payload)
+        sent = int(text.split(' ', 1)[0])
+        latencies.append((received - sent) / 1e6)
+        delivered[0] += 1
+        last_delivery[0] = time.perf_counter()
+
+    messengers = [MulticastMessenger(f"peer{index}", loop, on_frame, GROUP, port,
+                                     compression=compression)
+                  for index in range(peers)]
+    sender = messengers[0]
+    body = filler(size, rng)
+    expected = count * (peers - 1)
+    sent = [0]
+
+    def send_batch():
+        for _ in range(min(SEND_BATCH, count - sent[0])):
+            sender.send_message(f"{time.perf_counter_ns()} {body}")
+            sent[0] += 1
+        if sent[0] < count:
+            loop.call_later(0, send_batch)
+
+    start = time.perf_counter()
+    loop.call_later(0, send_batch)
+    deadline = None
+    while delivered[0] < expected:
+        loop.run_once(0.05)
+        if sent[0] >= count and deadline is None:
+            deadline = time.perf_counter() + SETTLE
+        if deadline is not None and time.perf_counter() > deadline:
+            break
+    send_elapsed = time.perf_counter() - start
+    elapsed = (last_delivery[0] or time.perf_counter()) - start
+
+    stats = [messenger.reliability_stats() for messenger in messengers]
+    for messenger in messengers:
+        messenger.close()
+    loop.close()
+    return {
+        'peers': peers,
+        'payload': size,
+        'messages': count,
+        'delivered': delivered[0],
+        'expected': expected,
+        'loss': 1 - delivered[0] / expected if expected else 0.0,
+        'deliveries_per_sec': delivered[0] / elapsed if elapsed > 0 else None,
+        'messages_per_sec': count / elapsed if elapsed > 0 else None,
+        'send_seconds': send_elapsed,
+        'latency_ms_p50': percentile(latencies, 0.50),
+        'latency_ms_p99': percentile(latencies, 0.99),
+        'latency_ms_max': max(latencies) if latencies else None,
+        'gaps': sum(stat['gaps'] for stat in stats),
+        'nacks_sent': sum(stat['nacks_sent'] for stat in stats),
+        'retransmits': sum(stat['retransmits'] for stat in stats),
+        'unrecoverable': sum(stat['unrecoverable'] for stat in stats),
+    }
+
+
+def run_bulk(port, seconds):
+    from modules.transfer import CHUNK_SIZE, Transfers
+
+    loop = SelectorLoop()
+    latencies = []
+
+    def on_frame(frame):
+        if frame.msg_type == MSG_CHAT:
+            _, text = decode_chat(frame.payload)
+            latencies.append((time.perf_counter_ns() - int(text.split(' ', 1)[0])) / 1e6)
+
+    sender = MulticastMessenger('bulk', loop, lambda frame: None, GROUP, port)
+    receiver = MulticastMessenger('probe', loop, on_frame, GROUP, port)
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'bulk.bin')
+    with open(path, 'wb') as source:
+        source.write(os.urandom(BULK_FILE))
+    transfers = Transfers(sender, loop, directory)
+    file_sender = transfers.send_file(path, rate=BULK_RATE)
+    sent = [0]
+
+    def chat():
+        sender.send_message(f"{time.perf_counter_ns()} проверка связи")
+        sent[0] += 1
+        if time.perf_counter() < deadline:
+            loop.call_later(CHAT_INTERVAL, chat)
+
+    start = time.perf_counter()
+    deadline = start + seconds
+    loop.call_later(CHAT_INTERVAL, chat)
+    while time.perf_counter() < deadline + SETTLE / 4:
+        loop.run_once(0.05)
+    elapsed = time.perf_counter() - start
+    chunks = file_sender.chunks_sent + file_sender.parity_sent
+
+    transfers.close()
+    sender.close()
+    receiver.close()
+    loop.close()
+    os.unlink(path)
+    return {
+        'seconds': seconds,
+        'chat_sent': sent[0],
+        'chat_delivered': len(latencies),
+        'chat_latency_ms_p50': percentile(latencies, 0.50),
+        'chat_latency_ms_p99': percentile(latencies, 0.99),
+        'chat_latency_ms_max': max(latencies) if latencies else None,
+        'bulk_mbit_per_sec': chunks * CHUNK_SIZE * 8 / elapsed / 1e6,
+    }
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        # На macOS ru_maxrss в байтах, на Linux - в килобайтах
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def run_ui(count):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    import gui
+    from modules.clock import LOGICAL_BITS
+    from modules.messages import ChatMessage
+    from modules.protocol import encode_chat, now_ms
+
+    app = gui.QApplication.instance() or gui.QApplication(sys.argv[:1])
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        gui.ChatWindow.HISTORY_DIR = directory
+        rng = random.Random(1)
+        texts = [filler(rng.randint(8, 200), rng) for _ in range(count)]
+
+        for mode in ('add_message', 'drain_inbox', 'late_arrivals'):
+            window = gui.ChatWindow('bench')
+            window.show()
+            app.processEvents()
+            gc.collect()
+            rss_before = rss_bytes()
+            blocks_before = sys.getallocatedblocks()
+
+            start = time.perf_counter()
+            if mode == 'add_message':
+                for text in texts:
+                    window.add_message('bench', text, True)
+                    app.processEvents()
+            else:
+                base = now_ms() << LOGICAL_BITS
+                for number, text in enumerate(texts):
+                    timestamp = base + number
+                    if mode == 'late_arrivals' and number % LATE_EVERY == LATE_EVERY - 1:
+                        timestamp -= LATE_BY
+                    message = ChatMessage.from_payload(encode_chat('peer', text), False,
+                                                       timestamp, 1, number + 1)
+                    if window.inbox.put((window.room, message)):
+                        window.schedule_drain()
+                    # Кадр раз в DRAIN_BUDGET сообщений, как при потоке из сети
+                    if number % window.DRAIN_BUDGET == 0:
+                        app.processEvents()
+                while len(window.inbox):
+                    window.drain_inbox()
+                    app.processEvents()
+            app.processEvents()
+            elapsed = time.perf_counter() - start
+
+            gc.collect()
+            blocks_after = sys.getallocatedblocks()
+            rss_after = rss_bytes()
+            window.close()
+            app.processEvents()
+
+            scale = 10000 / count
+            results[mode] = {
+                'messages': count,
+                'seconds': elapsed,
+                'us_per_message': elapsed / count * 1e6,
+                'rss_bytes_per_10k': (rss_after - rss_before) * scale,
+                'python_blocks_per_10k': (blocks_after - blocks_before) * scale,
+            }
+    return results
+
+
+def run_hub(clients, count, port, hub):
+    receivers = [subprocess.Popen([sys.executable, '-c', HUB_SCRIPT, ROOT, str(port), str(count),
+                                   '1' if hub else '0'],
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+                 for _ in range(clients)]
+    for receiver in receivers:
+        receiver.stdout.readline()
+    time.sleep(0.2)
+
+    loop = SelectorLoop()
+    sender = MulticastMessenger('bench', loop, lambda frame: None, GROUP, port)
+    rng = random.Random(1)
+    start = time.perf_counter()
+    for index in range(count):
+        sender.send_message(filler(256, rng))
+        if index % SEND_BATCH == SEND_BATCH - 1:
+            loop.run_once(0)
+            while sender.pending():
+                time.sleep(0.0005)
+    elapsed = time.perf_counter() - start
+
+    delivered = cpu = 0.0
+    for receiver in receivers:
+        received, seconds = receiver.stdout.readline().split()
+        delivered += int(received)
+        cpu += float(seconds)
+    for receiver in receivers:
+        receiver.stdin.close()
+    for receiver in receivers:
+        receiver.wait(10)
+    sender.close()
+    loop.close()
+    return {
+        'clients': clients,
+        'messages': count,
+        'send_seconds': elapsed,
+        'delivered': int(delivered),
+        'loss': 1 - delivered / (clients * count),
+        'receiver_cpu_seconds': cpu,
+        'cpu_us_per_delivery': cpu / delivered * 1e6 if delivered else None,
+    }
+
+
+def run_flood(rate, seconds, worker=False):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    import gui
+
+    app = gui.QApplication.instance() or gui.QApplication(sys.argv[:1])
+    with tempfile.TemporaryDirectory() as directory:
+        gui.ChatWindow.HISTORY_DIR = directory
+        gui.ChatWindow.WORKER_CONTROL = os.path.join(directory, 'worker.sock')
+        window = gui.ChatWindow('bench', worker)
+        window.show()
+        app.processEvents()
+        rows_before = window.room.model.rowCount()
+        # В режиме worker счётчики приёма и лимит - в сетевом процессе
+        received = getattr(window.messenger, 'datagrams_received', None)
+        received_before = received.value if received is not None else None
+
+        # Опоздания таймера с периодом 10 мс, пока идёт флуд
+        lateness = []
+        last = [time.perf_counter()]
+
+        def on_tick():
+            now = time.perf_counter()
+            lateness.append(max(0.0, now - last[0] - 0.010) * 1000)
+            last[0] = now
+
+        timer = gui.QTimer()
+        timer.setInterval(10)
+        timer.timeout.connect(on_tick)
+        timer.start()
+
+        flooder = subprocess.Popen([sys.executable, '-c', FLOOD_SCRIPT, ROOT, str(rate), str(seconds)],
+                                   stdout=subprocess.PIPE, text=True)
+        while flooder.poll() is None:
+            app.processEvents()
+            time.sleep(0.001)
+        deadline = time.perf_counter() + 0.5
+        while time.perf_counter() < deadline:
+            app.processEvents()
+        timer.stop()
+        sent, normal_sent = map(int, flooder.stdout.read().split())
+
+        texts = [message.text for message in window.room.model.messages[rows_before:]]
+        result = {
+            'rate': rate,
+            'seconds': seconds,
+            'worker': worker,
+            'sent': sent,
+            'received': received.value - received_before if received is not None else None,
+            'suppressed': window.limiter.total_suppressed if not worker else None,
+            'inbox_dropped': window.inbox.dropped,
+            'shown': len(texts),
+            'normal_sent': normal_sent,
+            'normal_shown': sum(1 for text in texts if text.startswith('обычное')),
+            'timer_late_ms_p50': percentile(lateness, 0.50),
+            'timer_late_ms_p99': percentile(lateness, 0.99),
+            'timer_late_ms_max': max(lateness) if lateness else None,
+        }
+        if worker:
+            window.messenger.close(shutdown=True)
+            window.messenger = None
+        window.close()
+        app.processEvents()
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, previous):
+    """Печать относительных изменений метрик с тем же ключом"""
+    def flatten(data, prefix=''):
+        values = {}
+        if isinstance(data, dict):
+            for key, value in data.items():
+                values.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(data, list):
+            for item in data:
+                if isinstance(item, dict) and 'payload' in item:
+                    values.update(flatten(item, f"{prefix}{item['payload']}b."))
+        elif isinstance(data, (int, float)) and not isinstance(data, bool):
+            values[prefix[:-1]] = data
+        return values
+
+    before = flatten(previous.get('results', {}))
+    after = flatten(current['results'])
+    print(f"\nсравнение с {previous.get('commit')}:")
+    for key in sorted(after):
+        if key in before and before[key]:
+            change = (after[key] - before[key]) / abs(before[key])
+            print(f"  {key:<48} {before[key]:>14.3f} -> {after[key]:>14.3f} {change:>+8.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный бенчмарк Chim Messenger")
+    parser.add_argument('-o', '--output', help="файл для JSON (по умолчанию stdout)")
+    parser.add_argument('--compare', help="JSON предыдущего прогона")
+    parser.add_argument('--peers', type=int, default=PEERS)
+    parser.add_argument('--messages', type=int, default=MESSAGES)
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES))
+    parser.add_argument('--ui-messages', type=int, default=UI_MESSAGES)
+    parser.add_argument('--flood-rate', type=int, default=FLOOD_RATE, help="сообщений в секунду, 0 - без флуда")
+    parser.add_argument('--bulk-seconds', type=float, default=BULK_SECONDS,
+                        help="длительность сценария массовой отправки, 0 - без него")
+    parser.add_argument('--hub-clients', type=int, default=HUB_CLIENTS,
+                        help="получателей в сценарии узла хоста, 0 - без него")
+    parser.add_argument('--no-compression', action='store_true')
+    parser.add_argument('--skip-ui', action='store_true', help="без замеров интерфейса (нет PyQt5)")
+    parser.add_argument('--worker', action='store_true', help="флуд с сетью в отдельном процессе")
+    args = parser.parse_args()
+
+    port = random.randint(20000, 40000)
+    network = []
+    for offset, size in enumerate(args.sizes):
+        result = run_network(args.peers, size, args.messages, port + offset,
+                             compression=not args.no_compression)
+        network.append(result)
+        print(f"сеть {size:>6} б: {result['deliveries_per_sec']:>9.0f} доставок/с, "
+              f"p50 {result['latency_ms_p50']:.2f} мс, p99 {result['latency_ms_p99']:.2f} мс, "
+              f"потери {result['loss']:.2%}", file=sys.stderr)
+
+    if args.bulk_seconds:
+        bulk = run_bulk(port + len(args.sizes), args.bulk_seconds)
+        print(f"чат при раздаче файла ({bulk['bulk_mbit_per_sec']:.0f} Мбит/с): "
+              f"доставлено {bulk['chat_delivered']}/{bulk['chat_sent']}, "
+              f"p50 {bulk['chat_latency_ms_p50']:.2f} мс, p99 {bulk['chat_latency_ms_p99']:.2f} мс, "
+              f"максимум {bulk['chat_latency_ms_max']:.2f} мс", file=sys.stderr)
+
+    if args.hub_clients:
+        hub = {}
+        for offset, mode in enumerate(('sockets', 'hub')):
+            result = hub[mode] = run_hub(args.hub_clients, HUB_MESSAGES,
+                                         port + len(args.sizes) + 1 + offset, mode == 'hub')
+            print(f"{args.hub_clients} получателей ({mode}): процессор {result['receiver_cpu_seconds']:.2f} с, "
+                  f"{result['cpu_us_per_delivery']:.1f} мкс/доставку, потери {result['loss']:.2%}",
+                  file=sys.stderr)
+
+    report = {
+        'commit': git_commit(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            'peers': args.peers,
+            'messages': args.messages,
+            'send_batch': SEND_BATCH,
+            'compression': not args.no_compression,
+        },
+        'results': {'network': network},
+    }
+    if args.bulk_seconds:
+        report['results']['bulk'] = bulk
+    if args.hub_clients:
+        report['results']['hub'] = hub
+    if not args.skip_ui:
+        report['results']['ui'] = run_ui(args.ui_messages)
+        for mode, result in report['results']['ui'].items():
+            print(f"интерфейс {mode}: {result['us_per_message']:.1f} мкс/сообщение, "
+                  f"RSS +{result['rss_bytes_per_10k'] / 1e6:.1f} МБ на 10 тыс.", file=sys.stderr)
+        if args.flood_rate:
+            flood = report['results']['flood'] = run_flood(args.flood_rate, FLOOD_SECONDS, args.worker)
+            print(f"флуд {flood['sent']} сообщений: подавлено {flood['suppressed']}, "
+                  f"показано {flood['shown']}, обычных {flood['normal_shown']}/{flood['normal_sent']}, "
+                  f"опоздание таймера p99 {flood['timer_late_ms_p99']:.1f} мс, "
+                  f"максимум {flood['timer_late_ms_max']:.1f} мс", file=sys.stderr)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as previous:
+            compare(report, json.load(previous))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""Стенд ретрансляторов на одной машине без маршрутизаторов
+
+Сегмент сети моделируется отдельным UDP-портом на loopback: клиенты и
+ретранслятор сегмента i слушают порт base + i и друг друга не слышат, как
+в разных VLAN. Ретрансляторы (python chim.py relay) запускаются
+отдельными процессами и соединяются по TCP кольцом, цепочкой или
+полной сеткой - кольцо и сетка проверяют подавление петель.
+
+В каждом сегменте работают несколько клиентов MulticastMessenger; первый
+отправляет сообщения. Проверяется, что каждый клиент получил все
+сообщения всех сегментов по одному разу, и замеряются задержка между
+сегментами (p50/p99), дубликаты, дошедшие до клиентов, и процессорное
+время ретрансляторов на кадр. Все клиенты работают в одном цикле стенда,
+поэтому под нагрузкой задержка включает и его очередь.
+
+    python benchmarks/relay_harness.py --segments 3 --topology ring
+"""
+import argparse
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from modules.loop import SelectorLoop
+from modules.metrics import Registry
+from modules.network import MulticastMessenger
+from modules.protocol import MSG_CHAT, decode_chat
+from modules.relay import Relay
+
+GROUP = '224.1.1.1'
+SEND_BATCH = 16
+# Время на установку соединений: ретранслятор, запущенный раньше соседа,
+# подключается к нему со второй попытки
+CONNECT_DELAY = Relay.RECONNECT + 1.0
+SETTLE = 2.0
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def links(segments, topology):
+    """Пары (кто подключается, к кому)"""
+    if topology == 'chain':
+        return [(i, i + 1) for i in range(segments - 1)]
+    if topology == 'ring':
+        return [(i, (i + 1) % segments) for i in range(segments)] if segments > 2 else links(segments, 'chain')
+    return [(i, j) for i in range(segments) for j in range(i + 1, segments)]
+
+
+def cpu_seconds(pid):
+    """Процессорное время процесса по /proc (Linux) или None"""
+    try:
+        with open(f'/proc/{pid}/stat') as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def run(segments, topology, clients, messages, base_port, tcp_port):
+    directory = tempfile.mkdtemp()
+    relays = []
+    peers = {i: [] for i in range(segments)}
+    for i, j in links(segments, topology):
+        peers[i].append(f'127.0.0.1:{tcp_port + j}')
+    for i in range(segments):
+        command = [sys.executable, os.path.join(ROOT, 'chim.py'), '--port', str(base_port + i),
+                   '--metrics-file', os.path.join(directory, f'relay{i}.json'),
+                   'relay', '--listen', f'127.0.0.1:{tcp_port + i}']
+        for peer in peers[i]:
+            command += ['--peer', peer]
+        relays.append(subprocess.Popen(command, stderr=subprocess.DEVNULL))
+
+    loop = SelectorLoop()
+    received = []
+    latencies = []
+    members = []
+    for i in range(segments):
+        for index in range(clients):
+            seen = {}
+            received.append(seen)
+
+            def on_frame(frame, seen=seen, segment=i):
+                if frame.msg_type != MSG_CHAT:
+                    return
+                _, text = decode_chat(frame.payload)
+                origin, sent_at, _ = text.split(' ', 2)
+                key = (frame.sender, frame.seq)
+                seen[key] = seen.get(key, 0) + 1
+                if int(origin) != segment:
+                    latencies.append((time.perf_counter_ns() - int(sent_at)) / 1e6)
+
+            members.append(MulticastMessenger(f's{i}c{index}', loop, on_frame, GROUP, base_port + i,
+                                              metrics=Registry()))
+    deadline = time.perf_counter() + CONNECT_DELAY
+    while time.perf_counter() < deadline:
+        loop.run_once(0.05)
+
+    senders = members[::clients]
+    rng = random.Random(1)
+    start = time.perf_counter()
+    for index in range(messages):
+        for segment, sender in enumerate(senders):
+            sender.send_message(f"{segment} {time.perf_counter_ns()} " + 'x' * rng.randint(16, 200))
+        if index % SEND_BATCH == SEND_BATCH - 1:
+            loop.run_once(0)
+            while any(sender.pending() for sender in senders):
+                time.sleep(0.0005)
+                loop.run_once(0)
+    elapsed = time.perf_counter() - start
+    deadline = time.perf_counter() + SETTLE
+    while time.perf_counter() < deadline:
+        loop.run_once(0.05)
+
+    cpu = [cpu_seconds(relay.pid) for relay in relays]
+    for relay in relays:
+        relay.send_signal(signal.SIGTERM)
+    for relay in relays:
+        relay.wait(10)
+    stats = []
+    for i in range(segments):
+        try:
+            with open(os.path.join(directory, f'relay{i}.json'), encoding='utf-8') as metrics:
+                values = json.load(metrics)
+        except (OSError, ValueError, KeyError):
+            values = {}
+        stats.append({key[len('chim_relay_'):]: value for key, value in values.items()
+                      if key.startswith('chim_relay_')})
+
+    expected = messages * segments
+    delivered = [len(seen) for seen in received]
+    # Собственные сообщения клиент не получает (эхо), остальные - все
+    wanted = [expected - messages if index % clients == 0 else expected for index in range(len(received))]
+    duplicates = sum(member.reliability_stats()['duplicates'] + member.duplicates.value for member in members)
+    for member in members:
+        member.close()
+    loop.close()
+
+    frames = sum(stat.get('received_total', 0) + stat.get('relayed_total', 0) for stat in stats)
+    total_cpu = sum(value for value in cpu if value is not None) if None not in cpu else None
+    return {
+        'segments': segments,
+        'topology': topology,
+        'clients_per_segment': clients,
+        'messages_per_segment': messages,
+        'send_seconds': elapsed,
+        'complete_clients': sum(1 for got, want in zip(delivered, wanted) if got >= want),
+        'clients': len(received),
+        'loss': 1 - sum(min(got, want) for got, want in zip(delivered, wanted)) / sum(wanted),
+        'duplicates_at_clients': duplicates,
+        'latency_ms_p50': percentile(latencies, 0.50),
+        'latency_ms_p99': percentile(latencies, 0.99),
+        'relay_cpu_seconds': total_cpu,
+        'relay_frames': frames,
+        'relay_frames_per_cpu_second': frames / total_cpu if total_cpu else None,
+        'relays': stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Стенд ретрансляторов Chim на loopback")
+    parser.add_argument('--segments', type=int, default=3)
+    parser.add_argument('--topology', choices=('ring', 'chain', 'mesh'), default='ring')
+    parser.add_argument('--clients', type=int, default=2, help="клиентов в сегменте")
+    parser.add_argument('--messages', type=int, default=2000, help="сообщений от каждого сегмента")
+    parser.add_argument('-o', '--output', help="файл для JSON (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    base_port = random.randint(20000, 40000)
+    result = run(args.segments, args.topology, args.clients, args.messages, base_port, base_port + 100)
+    print(f"{result['segments']} сегмента ({result['topology']}): получили всё "
+          f"{result['complete_clients']}/{result['clients']} клиентов, потери {result['loss']:.2%}, "
+          f"дубликатов у клиентов {result['duplicates_at_clients']}, "
+          f"задержка p50 {result['latency_ms_p50']:.2f} мс, p99 {result['latency_ms_p99']:.2f} мс",
+          file=sys.stderr)
+    if result['relay_frames_per_cpu_second']:
+        print(f"ретрансляторы: {result['relay_frames']} кадров, "
+              f"{result['relay_frames_per_cpu_second']:.0f} кадров на секунду процессора", file=sys.stderr)
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
+    return 0 if result['complete_clients'] == result['clients'] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
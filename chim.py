@@ -0,0 +1,397 @@
+"""Консольная утилита Chim Messenger без Qt
+
+    python chim.py send "текст"        отправить сообщение и выйти
+    python chim.py tail                печатать входящие сообщения
+    python chim.py bridge              строки stdin - в чат, входящие - в stdout
+    python chim.py record              писать входящие в историю комнаты
+    python chim.py record --sync       то же, с догрузкой и раздачей истории
+    python chim.py who                 список участников в сети
+    python chim.py sendfile PATH       раздать файл
+    python chim.py recvfile            принимать файлы
+    python chim.py relay --peer HOST   ретранслятор в другие сегменты сети
+
+Канал выбирается общим параметром --channel: имя или имя=группа. С --hub
+процессы одного хоста делят multicast-сокет (modules/hub.py).
+
+Работает на SelectorLoop и не импортирует PyQt5, поэтому запускается
+за десятки миллисекунд и подходит для скриптов, cron и серверов без
+дисплея. Запись истории и одновременный запуск окна чата с тем же
+каталогом истории не поддерживаются.
+"""
+import argparse
+import os
+import signal
+import sys
+
+from modules.channels import DEFAULT_CHANNEL, parse_channel
+from modules.clock import order_key
+from modules.loop import SelectorLoop
+from modules.messages import ChatMessage
+from modules.metrics import REGISTRY, start_from_environment
+from modules.hub import HubMessenger
+from modules.network import MulticastMessenger, get_local_ip
+from modules.presence import Presence
+from modules.protocol import MSG_CHAT, MSG_FILE_DATA, MSG_FILE_NACK, MSG_FILE_OFFER, MSG_PRESENCE
+from modules.reorder import ReorderBuffer
+
+# Сколько ждать после отправки: на случай NACK от получателей
+LINGER = 0.5
+
+
+class Client:
+    """Мессенджер в собственном цикле событий"""
+
+    def __init__(self, args, on_message=None):
+        self.loop = SelectorLoop()
+        self.on_message = on_message
+        messenger = HubMessenger if args.hub else MulticastMessenger
+        self.messenger = messenger(args.name, self.loop, self.on_frame, args.group, args.port,
+                                   compression=not args.no_compression, channel=args.channel,
+                                   send_rate=int(args.send_rate * 1000 * 1000 / 8) or None)
+        # Входящие выходят по меткам часов отправителей (modules/reorder.py)
+        self.reorder = ReorderBuffer(self.loop, self.release, args.reorder_ms / 1000)
+        self.presence = None
+        self.transfers = None
+
+    def on_frame(self, frame):
+        if frame.msg_type == MSG_CHAT and self.on_message is not None:
+            message = ChatMessage.from_payload(bytes(frame.payload), False, frame.timestamp,
+                                               frame.sender, frame.seq)
+            self.reorder.put((order_key(frame.timestamp), frame.sender, frame.seq), message)
+        elif frame.msg_type == MSG_PRESENCE and self.presence is not None:
+            self.presence.on_payload(frame.sender, frame.payload, frame.address)
+        elif frame.msg_type in (MSG_FILE_OFFER, MSG_FILE_DATA, MSG_FILE_NACK) and self.transfers:
+            self.transfers.on_frame(frame)
+
+    def release(self, messages):
+        for message in messages:
+            self.on_message(message)
+
+    def join(self, name, sync_port=0):
+        """Участие в списке комнаты: сигналы присутствия и учёт остальных"""
+        self.presence = Presence(name, self.loop, self.messenger.send_presence, sync_port=sync_port)
+        self.presence.start()
+
+    def send(self, text):
+        return self.messenger.send_message(text)
+
+    def linger_and_stop(self, delay=LINGER):
+        """Остановка цикла, когда очередь отправки пуста и NACK отвечены"""
+        def check():
+            if self.messenger.pending():
+                self.loop.call_later(delay, check)
+            else:
+                self.loop.stop()
+        self.loop.call_later(delay, check)
+
+    def run(self):
+        # SIGTERM (systemd, timeout) завершает так же, как Ctrl+C: с записью истории
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.loop.stop())
+        try:
+            self.loop.run()
+        except KeyboardInterrupt:
+            pass
+
+    def close(self):
+        self.reorder.close()
+        if self.transfers is not None:
+            self.transfers.close()
+            self.transfers = None
+        if self.presence is not None:
+            self.presence.stop()
+            self.presence = None
+        self.messenger.close()
+        self.loop.close()
+
+
+def print_message(message):
+    sys.stdout.write(f"[{message.time_text}] {message.sender}: {message.text}\n")
+    sys.stdout.flush()
+
+
+def cmd_send(args):
+    text = ' '.join(args.text)
+    if text == '-':
+        text = sys.stdin.read().rstrip('\n')
+    if not text:
+        print("Пустое сообщение", file=sys.stderr)
+        return 1
+    client = Client(args)
+    try:
+        client.send(text)
+        client.linger_and_stop()
+        client.run()
+    finally:
+        client.close()
+    return 0
+
+
+def cmd_tail(args):
+    client = Client(args, print_message)
+    try:
+        client.run()
+    finally:
+        client.close()
+    return 0
+
+
+def cmd_bridge(args):
+    client = Client(args, print_message)
+    stdin = sys.stdin.fileno()
+    pending = bytearray()
+
+    def on_stdin():
+        data = os.read(stdin, 65536)
+        if not data:
+            # Конец ввода: досылаем остаток и выходим
+            client.loop.remove_reader(stdin)
+            if pending:
+                client.send(pending.decode('utf-8', 'replace'))
+            client.linger_and_stop()
+            return
+        pending.extend(data)
+        *lines, rest = pending.split(b'\n')
+        pending[:] = rest
+        for line in lines:
+            if line.strip():
+                client.send(line.decode('utf-8', 'replace'))
+
+    client.loop.add_reader(stdin, on_stdin)
+    try:
+        client.run()
+    finally:
+        client.close()
+    return 0
+
+
+def cmd_record(args):
+    # История и индекс нужны только этой команде
+    from modules.history import HISTORY_ROOT, HistoryStore
+    from modules.search import SearchIndex
+
+    directory = args.history or os.path.join(HISTORY_ROOT, args.room or args.channel)
+    history = HistoryStore(directory)
+    index = SearchIndex(os.path.join(directory, 'search.idx'), history)
+    index.load_async()
+
+    def record(message):
+        index.add(history.append(message), message.text)
+        if args.verbose:
+            print_message(message)
+
+    client = Client(args, record)
+    server = None
+    if args.sync:
+        from modules.sync import CatchUp, SyncServer
+
+        def history_of(channel):
+            return history if channel == args.channel else None
+
+        def merge(messages):
+            for message in messages:
+                record(message)
+            print(f"догружено сообщений: {len(messages)}", file=sys.stderr)
+
+        def catch_up():
+            peers = client.presence.sync_peers()
+            if peers:
+                history.flush()
+                have = {(message.sender_id, message.seq)
+                        for message in history.tail(SyncServer.WINDOW) if message.seq}
+                CatchUp(client.loop, args.channel, peers, have, merge).start()
+
+        server = SyncServer(client.loop, history_of)
+        client.join(args.name, server.port)
+        client.loop.call_later(Presence.HELLO_DELAY + 1, catch_up)
+    try:
+        client.run()
+    finally:
+        if server is not None:
+            server.close()
+        client.close()
+        history.close()
+        index.save(history.first())
+    return 0
+
+
+def cmd_who(args):
+    client = Client(args)
+    client.join(args.name)
+    # Новичку отвечают в пределах HELLO_DELAY, остальных ловим по сигналам
+    client.loop.call_later(args.wait, client.loop.stop)
+    try:
+        client.run()
+        for name in client.presence.members():
+            print(name + (" (вы)" if name == args.name else ""))
+    finally:
+        client.close()
+    return 0
+
+
+def cmd_sendfile(args):
+    from modules.transfer import Transfers, format_size
+
+    client = Client(args)
+
+    def on_event(kind, transfer):
+        if kind == 'sent':
+            elapsed = transfer.finished - transfer.started
+            print(f"{transfer.name}: {format_size(transfer.size)} за {elapsed:.1f} с, "
+                  f"блоков {transfer.chunks_sent}, чётности {transfer.parity_sent}, "
+                  f"досылок {transfer.repairs_sent}")
+            client.linger_and_stop()
+
+    client.transfers = Transfers(client.messenger, client.loop, on_event=on_event)
+    try:
+        client.transfers.send_file(args.path, args.channel, int(args.rate * 1000 * 1000))
+        client.run()
+    finally:
+        client.close()
+    return 0
+
+
+def cmd_recvfile(args):
+    from modules.transfer import FILES_ROOT, Transfers, format_size
+
+    client = Client(args)
+
+    def on_event(kind, transfer):
+        if kind == 'offer':
+            # Запуск recvfile и есть согласие принимать предложенные файлы
+            client.transfers.accept(transfer)
+        elif kind == 'accepted':
+            resumed = f" (продолжение, {transfer.resumed}/{transfer.count})" if transfer.resumed else ""
+            print(f"приём {transfer.name}, {format_size(transfer.size)}{resumed}")
+        elif kind == 'received':
+            print(f"сохранён {transfer.path}, восстановлено по чётности {transfer.recovered}")
+            if args.once:
+                client.loop.stop()
+        elif kind in ('failed', 'paused'):
+            reason = transfer.error or kind
+            print(f"{transfer.name} не получен ({reason})", file=sys.stderr)
+        sys.stdout.flush()
+
+    client.transfers = Transfers(client.messenger, client.loop, args.dir or FILES_ROOT, on_event)
+    try:
+        client.run()
+    finally:
+        client.close()
+    return 0
+
+
+def cmd_relay(args):
+    from modules.relay import Relay, parse_address
+
+    groups = [args.group]
+    for spec in args.channels:
+        try:
+            groups.append(parse_channel(spec)[1])
+        except Exception as e:
+            print(str(e), file=sys.stderr)
+            return 1
+    loop = SelectorLoop()
+    try:
+        relay = Relay(loop, groups, args.port, parse_address(args.listen) if args.listen else None,
+                      [parse_address(peer) for peer in args.peer], allow=args.allow or None)
+    except Exception as e:
+        print(str(e), file=sys.stderr)
+        loop.close()
+        return 1
+    print(f"ретранслятор {relay.relay_id:016x}: группы {', '.join(relay.groups.values())}, "
+          f"порт {args.port}", file=sys.stderr)
+    signal.signal(signal.SIGTERM, lambda signum, frame: loop.stop())
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        relay.close()
+        loop.close()
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='chim', description="Chim Messenger без графического интерфейса")
+    parser.add_argument('--name', help="имя в чате (по умолчанию - IP-адрес)")
+    parser.add_argument('--channel', default=DEFAULT_CHANNEL, help="канал: имя или имя=группа")
+    parser.add_argument('--group', help="multicast-группа вместо выведенной из имени канала")
+    parser.add_argument('--port', type=int, default=5007)
+    parser.add_argument('--no-compression', action='store_true',
+                        help="не сжимать исходящие (для старых клиентов)")
+    parser.add_argument('--send-rate', type=float, default=100,
+                        help="бюджет отправки в сеть, Мбит/с; 0 - без ограничения")
+    parser.add_argument('--hub', action='store_true',
+                        help="делить multicast-сокет с другими клиентами этого хоста")
+    parser.add_argument('--reorder-ms', type=float, default=150,
+                        help="окно переупорядочения входящих, мс; 0 - выводить сразу")
+    parser.add_argument('--metrics-file', help="записать метрики в JSON при выходе")
+    parser.add_argument('--metrics-port', type=int, help="отдавать метрики по HTTP на 127.0.0.1")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    send = commands.add_parser('send', help="отправить сообщение")
+    send.add_argument('text', nargs='+', help="текст; '-' - прочитать из stdin")
+    send.set_defaults(handler=cmd_send)
+
+    tail = commands.add_parser('tail', help="печатать входящие")
+    tail.set_defaults(handler=cmd_tail)
+
+    bridge = commands.add_parser('bridge', help="stdin в чат, чат в stdout")
+    bridge.set_defaults(handler=cmd_bridge)
+
+    record = commands.add_parser('record', help="писать входящие в историю")
+    record.add_argument('--room', help="каталог истории в ~/.chim/history (по умолчанию - имя канала)")
+    record.add_argument('--history', help="каталог истории вместо ~/.chim/history/<room>")
+    record.add_argument('-v', '--verbose', action='store_true', help="печатать записанное")
+    record.add_argument('--sync', action='store_true',
+                        help="догрузить пропущенное у участников и раздавать историю опоздавшим")
+    record.set_defaults(handler=cmd_record)
+
+    who = commands.add_parser('who', help="список участников в сети")
+    who.add_argument('--wait', type=float, default=Presence.HELLO_DELAY + 1,
+                     help="сколько секунд собирать ответы")
+    who.set_defaults(handler=cmd_who)
+
+    sendfile = commands.add_parser('sendfile', help="раздать файл в канал")
+    sendfile.add_argument('path')
+    sendfile.add_argument('--rate', type=float, default=20, help="скорость, Мбит/с")
+    sendfile.set_defaults(handler=cmd_sendfile)
+
+    recvfile = commands.add_parser('recvfile', help="принимать файлы")
+    recvfile.add_argument('--dir', help="каталог вместо ~/.chim/files")
+    recvfile.add_argument('--once', action='store_true', help="выйти после первого файла")
+    recvfile.set_defaults(handler=cmd_recvfile)
+
+    relay = commands.add_parser('relay', help="ретранслятор в другие сегменты сети")
+    relay.add_argument('--listen', help="адрес для соседей на доверенном интерфейсе, например 10.1.0.5:7007")
+    relay.add_argument('--allow', action='append', default=[],
+                       help="принимать соседей только с этого адреса (можно несколько)")
+    relay.add_argument('--peer', action='append', default=[], help="сосед хост:порт (можно несколько)")
+    relay.add_argument('--channels', nargs='*', default=[],
+                       help="ещё каналы, кроме --channel: имя или имя=группа")
+    relay.set_defaults(handler=cmd_relay)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if not args.name:
+        args.name = get_local_ip()
+    try:
+        args.channel, group = parse_channel(args.channel)
+    except Exception as e:
+        parser.error(str(e))
+    args.group = args.group or group
+    metrics_file = args.metrics_file or start_from_environment()
+    if args.metrics_port is not None:
+        REGISTRY.serve(args.metrics_port)
+    try:
+        return args.handler(args)
+    finally:
+        if metrics_file:
+            REGISTRY.dump(metrics_file)
+        REGISTRY.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1892 @@
+"""Интерфейс Chim Messenger на PyQt5
+
+Импортируется только при запуске окна (см. messenger.py), поэтому
+сетевое ядро и консольная утилита chim.py не загружают Qt.
+"""
+import itertools
+import os
+import sys
+import time
+from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
+                             QHBoxLayout, QLabel, QLineEdit, QPushButton, 
+                             QListView, QAbstractItemView, QStyledItemDelegate, QShortcut,
+                             QPlainTextEdit, QCheckBox, QToolButton, QMenu, QTabBar,
+                             QInputDialog, QFileDialog, QMessageBox)
+from PyQt5.QtCore import (Qt, QTimer, pyqtSignal, QPropertyAnimation, QEasingCurve, QRect,
+                          QSize, QAbstractListModel, QModelIndex, QSocketNotifier, QEvent)
+from PyQt5.QtGui import QFont, QFontMetrics, QColor, QPainter, QPen, QLinearGradient, QKeySequence
+
+from modules.cache import LRUCache
+from modules.channels import DEFAULT_CHANNEL, DEFAULT_GROUP, parse_channel
+from modules.clock import order_key
+from modules.history import FSYNC_INTERVAL, HISTORY_ROOT, HistoryStore
+from modules.inbox import Inbox
+from modules.messages import KIND_SYSTEM, ChatMessage
+from modules.metrics import REGISTRY, Gauge, Histogram, start_from_environment
+from modules.network import MulticastMessenger, get_local_ip
+from modules.presence import Presence
+from modules.ratelimit import SenderLimiter
+from modules.reorder import ReorderBuffer
+from modules.protocol import MSG_CHAT, MSG_FILE_DATA, MSG_FILE_NACK, MSG_FILE_OFFER, MSG_PRESENCE, now_ms
+from modules.scheduler import DEFAULT_SEND_RATE
+from modules.search import SearchIndex
+from modules.sync import CatchUp, SyncServer
+from modules.transfer import FILES_ROOT, Transfers, format_size
+from modules.hub import HubMessenger
+from modules.worker import CONTROL_PATH, WorkerMessenger, WorkerTransfers
+
+# Игнорирование предупреждений о deprecated функциях
+import warnings
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+class QtTimerHandle:
+    def __init__(self, timer):
+        self.timer = timer
+        
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.stop()
+            self.timer.deleteLater()
+            self.timer = None
+
+
+class QtLoop:
+    """Мост сетевого ядра к циклу событий Qt: QSocketNotifier и QTimer"""
+    
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.notifiers = {}
+        
+    def add_reader(self, fd, callback):
+        self._add_notifier(fd, QSocketNotifier.Read, callback)
+        
+    def remove_reader(self, fd):
+        self._remove_notifier(fd, QSocketNotifier.Read)
+        
+    def add_writer(self, fd, callback):
+        self._add_notifier(fd, QSocketNotifier.Write, callback)
+        
+    def remove_writer(self, fd):
+        self._remove_notifier(fd, QSocketNotifier.Write)
+        
+    def _add_notifier(self, fd, kind, callback):
+        self._remove_notifier(fd, kind)
+        notifier = QSocketNotifier(fd, kind, self.parent)
+        notifier.activated.connect(lambda _fd: callback())
+        self.notifiers[(fd, kind)] = notifier
+        
+    def _remove_notifier(self, fd, kind):
+        notifier = self.notifiers.pop((fd, kind), None)
+        if notifier is not None:
+            notifier.setEnabled(False)
+            notifier.deleteLater()
+            
+    def call_later(self, delay, callback):
+        timer = QTimer(self.parent)
+        timer.setSingleShot(True)
+        handle = QtTimerHandle(timer)
+        
+        def fire():
+            handle.cancel()
+            callback()
+            
+        timer.timeout.connect(fire)
+        timer.start(max(0, int(delay * 1000)))
+        return handle
+
+
+MessageRole = Qt.UserRole + 1
+
+
+def stamp_order(messages):
+    """Сообщения по меткам часов; история хранит их в порядке записи
+
+    Опоздавшее сверх окна переупорядочения и догруженное у участников
+    записываются в историю позже, чем стоят в разговоре.
+    """
+    return sorted(messages, key=lambda message: order_key(message.timestamp))
+
+
+class MessageListModel(QAbstractListModel):
+    """Плоский список сообщений по меткам времени
+
+    Новые сообщения добавляются в конец за O(1), опоздавшие (повтор по
+    NACK, ретранслятор, догрузка истории) вставляются на своё место
+    двоичным поиском отдельной строкой - без перестройки списка.
+    """
+    
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.messages = []
+        
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.messages)
+        
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        message = self.messages[index.row()]
+        if role == MessageRole:
+            return message
+        if role == Qt.DisplayRole:
+            return message.text
+        return None
+        
+    def append(self, message):
+        self.extend((message,))
+        
+    def prepend(self, messages):
+        messages = list(messages)
+        if not messages:
+            return
+        self.beginInsertRows(QModelIndex(), 0, len(messages) - 1)
+        self.messages[:0] = messages
+        self.endInsertRows()
+        
+    def extend(self, messages):
+        messages = list(messages)
+        if not messages:
+            return
+        first = len(self.messages)
+        self.beginInsertRows(QModelIndex(), first, first + len(messages) - 1)
+        self.messages.extend(messages)
+        self.endInsertRows()
+        
+    def merge(self, messages):
+        """Вставка пачки по меткам: не раньше последней строки - в конец, остальные - на место"""
+        messages = stamp_order(messages)
+        if not messages:
+            return
+        tail = order_key(self.messages[-1].timestamp) if self.messages else 0
+        late = 0
+        while late < len(messages) and order_key(messages[late].timestamp) < tail:
+            late += 1
+        for message in messages[:late]:
+            row = self.bisect(order_key(message.timestamp))
+            self.beginInsertRows(QModelIndex(), row, row)
+            self.messages.insert(row, message)
+            self.endInsertRows()
+        self.extend(messages[late:])
+        
+    def bisect(self, key):
+        """Строка для вставки сообщения с ключом key после равных ему"""
+        messages = self.messages
+        low, high = 0, len(messages)
+        while low < high:
+            middle = (low + high) // 2
+            if key < order_key(messages[middle].timestamp):
+                high = middle
+            else:
+                low = middle + 1
+        return low
+        
+    def reset(self, messages):
+        self.beginResetModel()
+        self.messages = list(messages)
+        self.endResetModel()
+        
+    def replace(self, old, new):
+        """Замена сообщения тем же объектом в строке; поиск с конца списка"""
+        for row in range(len(self.messages) - 1, -1, -1):
+            if self.messages[row] is old:
+                self.messages[row] = new
+                index = self.index(row)
+                self.dataChanged.emit(index, index)
+                return True
+        return False
+        
+    def row_of(self, number, start=0):
+        """Строка сообщения истории с номером number или -1"""
+        # Номера идут в порядке записи, а строки - в порядке меток, поэтому
+        # опоздавшее сообщение стоит выше своего номера: поиск от start
+        # вниз, затем вверх
+        start = min(max(0, start), len(self.messages))
+        for row in itertools.chain(range(start, len(self.messages)), range(start - 1, -1, -1)):
+            if self.messages[row].number == number:
+                return row
+        return -1
+
+
+class BubbleLayout:
+    """Размеры элементов пузыря сообщения при заданной ширине"""
+    __slots__ = ('width', 'height', 'sender_height', 'text_width', 'text_height', 'time_height')
+    
+    def __init__(self, width, height, sender_height, text_width, text_height, time_height):
+        self.width = width
+        self.height = height
+        self.sender_height = sender_height
+        self.text_width = text_width
+        self.text_height = text_height
+        self.time_height = time_height
+
+
+class MessageDelegate(QStyledItemDelegate):
+    """Рисует пузыри сообщений без создания виджетов на каждую строку"""
+    
+    MARGIN = 15
+    SPACING = 8
+    PADDING_H = 15
+    PADDING_V = 8
+    INNER_SPACING = 4
+    MAX_WIDTH = 400
+    MIN_WIDTH = 100
+    RADIUS = 18
+    SYSTEM_MAX_WIDTH = 300
+    SYSTEM_PADDING = 10
+    SYSTEM_RADIUS = 10
+    
+    # Ограничение кэша раскладок и оценка накладных расходов на запись
+    CACHE_BYTES = 16 * 1024 * 1024
+    CACHE_ENTRY_OVERHEAD = 320
+    
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.sender_font = self._font(13, bold=True)
+        self.text_font = self._font(14)
+        self.time_font = self._font(11)
+        self.system_font = self._font(12, italic=True)
+        self.font_key = self.text_font.key()
+        
+        text_metrics = QFontMetrics(self.text_font)
+        system_metrics = QFontMetrics(self.system_font)
+        self.text_char_width = max(1, text_metrics.averageCharWidth())
+        self.text_line_height = text_metrics.lineSpacing()
+        self.system_char_width = max(1, system_metrics.averageCharWidth())
+        self.system_line_height = system_metrics.lineSpacing()
+        self.sender_height = QFontMetrics(self.sender_font).height()
+        self.time_height = QFontMetrics(self.time_font).height()
+        
+        # Раскладки по (текст, шрифт, ширина); измеряем только при промахе
+        self.cache = LRUCache(self.CACHE_BYTES)
+        
+        self.sender_color = QColor('#0088cc')
+        self.text_color = QColor('white')
+        self.time_color = QColor('#aaaaaa')
+        self.other_color = QColor('#2b5278')
+        self.system_color = QColor('#ffb74d')
+        self.system_background = QColor(255, 183, 77, 25)
+        
+        # Номер записи истории, найденной поиском; её пузырь обводится
+        self.highlight = -1
+        self.highlight_pen = QPen(QColor('#ffb74d'), 2)
+        
+    def _font(self, pixel_size, bold=False, italic=False):
+        font = QFont()
+        font.setPixelSize(pixel_size)
+        font.setBold(bold)
+        font.setItalic(italic)
+        return font
+        
+    def measure(self, message, available):
+        """Расчёт размеров пузыря для доступной ширины строки"""
+        if message.kind == KIND_SYSTEM:
+            max_text = max(1, min(self.SYSTEM_MAX_WIDTH, available) - 2 * self.SYSTEM_PADDING)
+            text_rect = QFontMetrics(self.system_font).boundingRect(
+                QRect(0, 0, max_text, 0), Qt.AlignCenter | Qt.TextWordWrap, f"⚡ {message.text}")
+            return BubbleLayout(
+                text_rect.width() + 2 * self.SYSTEM_PADDING,
+                text_rect.height() + 2 * self.SYSTEM_PADDING,
+                0, text_rect.width(), text_rect.height(), 0
+            )
+        
+        max_text = max(1, min(self.MAX_WIDTH, available) - 2 * self.PADDING_H)
+        text_rect = QFontMetrics(self.text_font).boundingRect(
+            QRect(0, 0, max_text, 0), Qt.TextWordWrap, message.text)
+        time_metrics = QFontMetrics(self.time_font)
+        content_width = max(text_rect.width(), time_metrics.horizontalAdvance(message.time_text))
+        height = text_rect.height() + self.INNER_SPACING + time_metrics.height()
+        
+        sender_height = 0
+        if not message.is_own:
+            sender_metrics = QFontMetrics(self.sender_font)
+            sender_height = sender_metrics.height()
+            height += sender_height + self.INNER_SPACING
+            content_width = max(content_width, sender_metrics.horizontalAdvance(message.sender))
+        
+        width = min(max(content_width + 2 * self.PADDING_H, self.MIN_WIDTH), min(self.MAX_WIDTH, available))
+        return BubbleLayout(
+            width, height + 2 * self.PADDING_V, sender_height,
+            text_rect.width(), text_rect.height(), time_metrics.height()
+        )
+        
+    def cache_key(self, message, available):
+        return (message.kind, message.is_own, message.sender, message.text,
+                message.time_text, self.font_key, available)
+        
+    def cached_layout(self, message, available):
+        """Раскладка из кэша или измерение с сохранением в кэш"""
+        key = self.cache_key(message, available)
+        layout = self.cache.get(key)
+        if layout is None:
+            layout = self.measure(message, available)
+            size = sys.getsizeof(message.text) + sys.getsizeof(message.sender) + self.CACHE_ENTRY_OVERHEAD
+            self.cache.put(key, layout, size)
+        return layout
+        
+    def estimate_height(self, message, available):
+        """Оценка высоты без раскладки текста - для строк, которые ещё не рисовались"""
+        text = message.text
+        if message.kind == KIND_SYSTEM:
+            max_text = max(1, min(self.SYSTEM_MAX_WIDTH, available) - 2 * self.SYSTEM_PADDING)
+            per_line = max(1, max_text // self.system_char_width)
+            lines = text.count('\n') + 1 + (len(text) + 2) // per_line
+            return lines * self.system_line_height + 2 * self.SYSTEM_PADDING
+        
+        max_text = max(1, min(self.MAX_WIDTH, available) - 2 * self.PADDING_H)
+        per_line = max(1, max_text // self.text_char_width)
+        lines = text.count('\n') + 1 + len(text) // per_line
+        height = lines * self.text_line_height + self.INNER_SPACING + self.time_height
+        if not message.is_own:
+            height += self.sender_height + self.INNER_SPACING
+        return height + 2 * self.PADDING_V
+        
+    def sizeHint(self, option, index):
+        available = option.rect.width() - 2 * self.MARGIN
+        if available <= 0 and option.widget is not None:
+            available = option.widget.viewport().width() - 2 * self.MARGIN
+        height = self.row_height(index.data(MessageRole), available)
+        return QSize(available + 2 * self.MARGIN, height)
+        
+    def row_height(self, message, available):
+        # При промахе не раскладываем текст: точный размер посчитает paint,
+        # поэтому изменение ширины окна измеряет только видимые строки
+        width = max(available, self.MIN_WIDTH)
+        layout = self.cache.get(self.cache_key(message, width))
+        height = layout.height if layout is not None else self.estimate_height(message, width)
+        return height + self.SPACING
+        
+    def paint(self, painter, option, index):
+        message = index.data(MessageRole)
+        rect = option.rect.adjusted(self.MARGIN, self.SPACING // 2, -self.MARGIN, -(self.SPACING - self.SPACING // 2))
+        layout = self.cached_layout(message, max(rect.width(), self.MIN_WIDTH))
+        if layout.height != rect.height():
+            # Строка была разложена по оценке - просим вид пересчитать её
+            self.sizeHintChanged.emit(index)
+        
+        painter.save()
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(Qt.NoPen)
+        
+        if message.kind == KIND_SYSTEM:
+            bubble = QRect(0, rect.top(), layout.width, layout.height)
+            bubble.moveLeft(rect.left() + (rect.width() - layout.width) // 2)
+            painter.setBrush(self.system_background)
+            painter.drawRoundedRect(bubble, self.SYSTEM_RADIUS, self.SYSTEM_RADIUS)
+            painter.setPen(self.system_color)
+            painter.setFont(self.system_font)
+            painter.drawText(bubble.adjusted(self.SYSTEM_PADDING, self.SYSTEM_PADDING,
+                                             -self.SYSTEM_PADDING, -self.SYSTEM_PADDING),
+                             Qt.AlignCenter | Qt.TextWordWrap, f"⚡ {message.text}")
+            painter.restore()
+            return
+        
+        bubble = QRect(rect.left(), rect.top(), layout.width, layout.height)
+        if message.is_own:
+            bubble.moveRight(rect.right())
+            gradient = QLinearGradient(bubble.topLeft(), bubble.topRight())
+            gradient.setColorAt(0, QColor('#0088cc'))
+            gradient.setColorAt(1, QColor('#00a884'))
+            painter.setBrush(gradient)
+        else:
+            painter.setBrush(self.other_color)
+        radius = min(self.RADIUS, layout.height / 2)
+        if message.number >= 0 and message.number == self.highlight:
+            painter.setPen(self.highlight_pen)
+            painter.drawRoundedRect(bubble.adjusted(1, 1, -1, -1), radius, radius)
+            painter.setPen(Qt.NoPen)
+        else:
+            painter.drawRoundedRect(bubble, radius, radius)
+        
+        x = bubble.left() + self.PADDING_H
+        y = bubble.top() + self.PADDING_V
+        inner_width = bubble.width() - 2 * self.PADDING_H
+        
+        if layout.sender_height:
+            painter.setPen(self.sender_color)
+            painter.setFont(self.sender_font)
+            painter.drawText(QRect(x, y, inner_width, layout.sender_height),
+                             Qt.AlignLeft, message.sender)
+            y += layout.sender_height + self.INNER_SPACING
+            
+        painter.setPen(self.text_color)
+        painter.setFont(self.text_font)
+        painter.drawText(QRect(x, y, inner_width, layout.text_height),
+                         Qt.TextWordWrap, message.text)
+        y += layout.text_height + self.INNER_SPACING
+        
+        painter.setPen(self.time_color)
+        painter.setFont(self.time_font)
+        painter.drawText(QRect(x, y, inner_width, layout.time_height),
+                         Qt.AlignRight if message.is_own else Qt.AlignLeft, message.time_text)
+        painter.restore()
+
+class AnimatedButton(QPushButton):
+    def __init__(self, text, parent=None):
+        super().__init__(text, parent)
+        self._animation = QPropertyAnimation(self, b"geometry")
+        self._animation.setDuration(200)
+        self._animation.setEasingCurve(QEasingCurve.OutCubic)
+        
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            self.animate_click()
+        super().mousePressEvent(event)
+        
+    def animate_click(self):
+        original_geometry = self.geometry()
+        pressed_geometry = QRect(
+            original_geometry.x() + 2,
+            original_geometry.y() + 2,
+            original_geometry.width() - 4,
+            original_geometry.height() - 4
+        )
+        
+        self._animation.setStartValue(original_geometry)
+        self._animation.setEndValue(pressed_geometry)
+        self._animation.start()
+
+class LoginWindow(QMainWindow):
+    login_success = pyqtSignal(str)
+    
+    def __init__(self):
+        super().__init__()
+        self.setup_ui()
+        
+    def setup_ui(self):
+        self.setWindowTitle("Chim Messenger - Авторизация")
+        self.setFixedSize(400, 500)
+        self.setStyleSheet("""
+            QMainWindow {
+                background: qlineargradient(x1:0, y1:0, x2:1, y2:1,
+                stop:0 #1e3c72, stop:1 #2a5298);
+            }
+        """)
+        
+        central_widget = QWidget()
+        self.setCentralWidget(central_widget)
+        
+        layout = QVBoxLayout()
+        layout.setAlignment(Qt.AlignCenter)
+        layout.setSpacing(30)
+        
+        # Заголовок
+        title_label = QLabel("Chim Messenger")
+        title_label.setAlignment(Qt.AlignCenter)
+        title_label.setStyleSheet("""
+            QLabel {
+                color: white;
+                font-size: 32px;
+                font-weight: bold;
+                padding: 20px;
+            }
+        """)
+        layout.addWidget(title_label)
+        
+        # Иконка
+        icon_label = QLabel("💬")
+        icon_label.setAlignment(Qt.AlignCenter)
+        icon_label.setStyleSheet("""
+            QLabel {
+                color: white;
+                font-size: 64px;
+                padding: 20px;
+            }
+        """)
+        layout.addWidget(icon_label)
+        
+        # Подзаголовок
+        subtitle_label = QLabel("Современный локальный мессенджер")
+        subtitle_label.setAlignment(Qt.AlignCenter)
+        subtitle_label.setStyleSheet("""
+            QLabel {
+                color: #cccccc;
+                font-size: 16px;
+                padding: 10px;
+            }
+        """)
+        layout.addWidget(subtitle_label)
+        
+        # Поле ввода
+        input_widget = QWidget()
+        input_layout = QVBoxLayout()
+        input_layout.setSpacing(10)
+        
+        ip_label = QLabel("Ваш идентификатор:")
+        ip_label.setStyleSheet("""
+            QLabel {
+                color: white;
+                font-size: 14px;
+                font-weight: bold;
+            }
+        """)
+        input_layout.addWidget(ip_label)
+        
+        self.ip_entry = QLineEdit()
+        self.ip_entry.setText(get_local_ip())
+        self.ip_entry.setStyleSheet("""
+            QLineEdit {
+                background: rgba(255,255,255,0.1);
+                border: 2px solid rgba(255,255,255,0.3);
+                border-radius: 20px;
+                padding: 15px;
+                color: white;
+                font-size: 14px;
+                selection-background-color: #0088cc;
+            }
+            QLineEdit:focus {
+                border: 2px solid #0088cc;
+            }
+        """)
+        self.ip_entry.returnPressed.connect(self.login)
+        input_layout.addWidget(self.ip_entry)
+        
+        input_widget.setLayout(input_layout)
+        layout.addWidget(input_widget)
+        
+        # Кнопка входа
+        self.login_btn = AnimatedButton("Подключиться к чату")
+        self.login_btn.setStyleSheet("""
+            QPushButton {
+                background: qlineargradient(x1:0, y1:0, x2:1, y2:0,
+                stop:0 #0088cc, stop:1 #00a884);
+                color: white;
+                border: none;
+                border-radius: 25px;
+                padding: 15px;
+                font-size: 16px;
+                font-weight: bold;
+            }
+            QPushButton:hover {
+                background: qlineargradient(x1:0, y1:0, x2:1, y2:0,
+                stop:0 #0095e0, stop:1 #00b894);
+            }
+            QPushButton:pressed {
+                background: qlineargradient(x1:0, y1:0, x2:1, y2:0,
+                stop:0 #0077b3, stop:1 #009670);
+            }
+        """)
+        self.login_btn.setFixedHeight(50)
+        self.login_btn.clicked.connect(self.login)
+        layout.addWidget(self.login_btn)
+        
+        # Информация
+        info_label = QLabel("💡 Автоматически определен ваш IP-адрес")
+        info_label.setAlignment(Qt.AlignCenter)
+        info_label.setStyleSheet("""
+            QLabel {
+                color: #aaaaaa;
+                font-size: 12px;
+                padding: 10px;
+            }
+        """)
+        layout.addWidget(info_label)
+        
+        central_widget.setLayout(layout)
+        
+    def login(self):
+        username = self.ip_entry.text().strip()
+        if username:
+            self.login_success.emit(username)
+
+class DebugPanel(QWidget):
+    """Скрытая панель метрик (Ctrl+Shift+D); обновляется только пока видна"""
+    
+    REFRESH_MS = 500
+    DUMP_PATH = os.path.join(os.path.expanduser('~'), '.chim', 'metrics.json')
+    
+    def __init__(self, registry, dump_path=None, parent=None):
+        super().__init__(parent, Qt.Window)
+        self.registry = registry
+        self.dump_path = dump_path or self.DUMP_PATH
+        self.setWindowTitle("Chim - метрики")
+        self.resize(520, 600)
+        
+        layout = QVBoxLayout()
+        self.text = QPlainTextEdit()
+        self.text.setReadOnly(True)
+        font = QFont('monospace')
+        font.setStyleHint(QFont.Monospace)
+        self.text.setFont(font)
+        layout.addWidget(self.text)
+        
+        controls = QHBoxLayout()
+        self.timing = QCheckBox("Замер времени")
+        self.timing.setChecked(registry.enabled)
+        self.timing.toggled.connect(self.set_timing)
+        controls.addWidget(self.timing)
+        controls.addStretch()
+        self.status = QLabel("")
+        controls.addWidget(self.status)
+        save_btn = QPushButton("Сохранить")
+        save_btn.clicked.connect(self.save)
+        controls.addWidget(save_btn)
+        layout.addLayout(controls)
+        self.setLayout(layout)
+        
+        self.timer = QTimer(self)
+        self.timer.setInterval(self.REFRESH_MS)
+        self.timer.timeout.connect(self.refresh)
+        
+    def set_timing(self, enabled):
+        self.registry.enabled = enabled
+        
+    def showEvent(self, event):
+        self.refresh()
+        self.timer.start()
+        super().showEvent(event)
+        
+    def hideEvent(self, event):
+        self.timer.stop()
+        super().hideEvent(event)
+        
+    def refresh(self):
+        lines = []
+        for name, metric in sorted(self.registry.metrics.items()):
+            if isinstance(metric, Histogram):
+                if not metric.count:
+                    lines.append(f"{name:<40} -")
+                    continue
+                p50 = metric.quantile(0.50) * 1000
+                p99 = metric.quantile(0.99) * 1000
+                lines.append(f"{name:<40} n={metric.count} p50≤{p50:.2f}мс p99≤{p99:.2f}мс")
+            else:
+                value = metric.read() if isinstance(metric, Gauge) else metric.value
+                lines.append(f"{name:<40} {'-' if value is None else value}")
+        self.text.setPlainText('\n'.join(lines))
+        
+    def save(self):
+        try:
+            self.registry.dump(self.dump_path)
+            self.status.setText(f"Сохранено: {self.dump_path}")
+        except OSError as e:
+            self.status.setText(f"Ошибка: {e}")
+
+
+class ChatRoom:
+    """Канал в окне чата: своя модель, история, поиск, участники и непрочитанные"""
+    
+    def __init__(self, name, group, parent=None):
+        self.name = name
+        self.group = group
+        self.model = MessageListModel(parent)
+        self.history = None
+        self.history_start = 0
+        # Конец загруженного окна истории; None - окно доходит до живого хвоста
+        self.history_stop = None
+        self.search_index = None
+        # Об ошибке записи истории сообщается один раз
+        self.history_failed = False
+        self.presence = None
+        # Таймер или идущая догрузка истории у участников (modules/sync.py)
+        self.catchup = None
+        self.unread = 0
+        # Положение прокрутки, пока канал не на экране; None - у последнего сообщения
+        self.scroll_value = None
+        
+    @property
+    def title(self):
+        return "Групповой чат" if self.name == DEFAULT_CHANNEL else f"#{self.name}"
+
+
+class ChatWindow(QMainWindow):
+    # Интервал кадра и бюджет сообщений на кадр при разборе входящих
+    FRAME_INTERVAL_MS = 16
+    DRAIN_BUDGET = 200
+    ROSTER_UPDATE_MS = 250
+    
+    # Лимит сообщений одного отправителя и граница очереди входящих
+    SENDER_RATE = 20.0
+    SENDER_BURST = 100
+    INBOX_LIMIT = 10000
+    # Сводки о подавленных сообщениях: период обновления и пауза, после
+    # которой следующий всплеск получает новую строку
+    FLOOD_REPORT_MS = 1000
+    FLOOD_QUIET = 5.0
+    
+    # Бюджет отправки в сеть, байт в секунду
+    SEND_RATE = DEFAULT_SEND_RATE
+    # Управляющий сокет сетевого процесса (режим worker)
+    WORKER_CONTROL = CONTROL_PATH
+    
+    # Окно переупорядочения входящих по меткам часов (modules/reorder.py),
+    # секунды; 0 - сообщения показываются сразу
+    REORDER_DELAY = 0.15
+    
+    # Догрузка истории начинается, когда участники ответили на приветствие
+    CATCHUP_DELAY = Presence.HELLO_DELAY + 1.0
+    
+    # История: каталог (по подкаталогу на канал), размер страницы подгрузки
+    # и политика fsync. Список каналов хранится там же
+    HISTORY_DIR = HISTORY_ROOT
+    CHANNELS_FILE = 'channels'
+    # Принятые файлы
+    FILES_DIR = FILES_ROOT
+    HISTORY_PAGE = 200
+    HISTORY_FSYNC = FSYNC_INTERVAL
+    # Сколько поток интерфейса ждёт дозаписи истории перед её чтением
+    HISTORY_FLUSH_TIMEOUT = 1.0
+    
+    # Поиск: сколько совпадений показывать и когда сохранять индекс
+    SEARCH_LIMIT = 1000
+    SEARCH_SAVE_EVERY = 100000
+    # Повтор запроса, заданного до окончания загрузки индекса
+    SEARCH_RETRY_MS = 200
+    
+    def __init__(self, username, worker=False, hub=False):
+        super().__init__()
+        self.username = username
+        # Сокет и разбор кадров в отдельном процессе (modules/worker.py)
+        self.worker = worker
+        # Один сокет на все окна хоста (modules/hub.py)
+        self.hub = hub
+        self.messenger = None
+        self.loop = None
+        self.reorder = None
+        self.transfers = None
+        self.sync_server = None
+        # Каналы по имени и канал на экране
+        self.rooms = {}
+        self.room = None
+        self.search_query = None
+        self.search_results = []
+        self.search_position = 0
+        self.search_retry = False
+        
+        # Сообщения каналов не на экране теряются первыми при переполнении
+        self.inbox = Inbox(self.INBOX_LIMIT)
+        self.limiter = SenderLimiter(self.SENDER_RATE, self.SENDER_BURST)
+        # Ключ всплеска -> [строка уведомления, всего, время последнего, канал]
+        self.flood_notices = {}
+        self.inbox_dropped = 0
+        self.flood_timer = QTimer(self)
+        self.flood_timer.setInterval(self.FLOOD_REPORT_MS)
+        self.flood_timer.timeout.connect(self.report_floods)
+        self.flood_timer.start()
+        self.drain_timer = QTimer(self)
+        self.drain_timer.setSingleShot(True)
+        self.drain_timer.setInterval(self.FRAME_INTERVAL_MS)
+        self.drain_timer.timeout.connect(self.drain_inbox)
+        
+        self.roster_timer = QTimer(self)
+        self.roster_timer.setSingleShot(True)
+        self.roster_timer.setInterval(self.ROSTER_UPDATE_MS)
+        self.roster_timer.timeout.connect(self.update_status)
+        
+        self.setup_ui()
+        self.setup_metrics()
+        self.setup_rooms()
+        self.setup_chat()
+        
+    def setup_metrics(self):
+        self.metrics = REGISTRY
+        self.metrics_file = start_from_environment(self.metrics)
+        self.debug_panel = None
+        # Время приёма самого раннего ещё не нарисованного входящего: оно
+        # снимается в on_frame и едет с сообщением через окно переупорядочения
+        self.render_since = None
+        self.receive_to_render = self.metrics.histogram(
+            'chim_receive_to_render_seconds', "От приёма до отрисовки кадра")
+        self.insert_time = self.metrics.histogram(
+            'chim_gui_insert_seconds', "Вставка пачки входящих в список")
+        self.metrics.gauge('chim_inbox_depth', "Сообщения, ждущие разбора интерфейсом",
+                           lambda: len(self.inbox))
+        self.metrics.gauge('chim_inbox_dropped', "Входящие, вытесненные при переполнении очереди",
+                           lambda: self.inbox.dropped)
+        self.metrics.gauge('chim_reorder_pending', "Сообщения в окне переупорядочения",
+                           lambda: len(self.reorder) if self.reorder is not None else 0)
+        self.metrics.gauge('chim_reorder_late', "Сообщения, опоздавшие больше окна переупорядочения",
+                           lambda: self.reorder.late if self.reorder is not None else 0)
+        self.metrics.gauge('chim_history_backlog', "Сообщения в очереди записи истории",
+                           lambda: sum(room.history.submitted - room.history.written
+                                       for room in self.rooms.values() if room.history))
+        self.messages_view.viewport().installEventFilter(self)
+        QShortcut(QKeySequence("Ctrl+Shift+D"), self, self.toggle_debug_panel)
+        
+    def toggle_debug_panel(self):
+        if self.debug_panel is None:
+            self.debug_panel = DebugPanel(self.metrics, self.metrics_file, self)
+        self.debug_panel.setVisible(not self.debug_panel.isVisible())
+        
+    def eventFilter(self, watched, event):
+        if self.render_since is not None and event.type() == QEvent.Paint:
+            self.receive_to_render.observe(time.perf_counter() - self.render_since)
+            self.render_since = None
+        return super().eventFilter(watched, event)
+        
+    def setup_ui(self):
+        self.setWindowTitle(f"Chim Messenger - {self.username}")
+        self.setGeometry(100, 100, 400, 700)
+        self.setMinimumSize(350, 500)
+        
+        # Основной стиль
+        self.setStyleSheet("""
+            QMainWindow {
+                background: #0e1621;
+            }
+            QListView {
+                border: none;
+                background: transparent;
+            }
+            QScrollBar:vertical {
+                background: #1e2b3c;
+                width: 8px;
+                margin: 0px;
+                border-radius: 4px;
+            }
+            QScrollBar::handle:vertical {
+                background: #2b5278;
+                border-radius: 4px;
+                min-height: 20px;
+            }
+            QScrollBar::handle:vertical:hover {
+                background: #3d6b99;
+            }
+        """)
+        
+        central_widget = QWidget()
+        self.setCentralWidget(central_widget)
+        
+        self.main_layout = QVBoxLayout()
+        self.main_layout.setContentsMargins(0, 0, 0, 0)
+        self.main_layout.setSpacing(0)
+        
+        # Заголовок чата
+        self.create_header()
+        
+        # Вкладки каналов
+        self.create_channel_bar()
+        
+        # Строка поиска по истории (скрыта до Ctrl+F)
+        self.create_search_bar()
+        
+        # Область сообщений
+        self.create_messages_area()
+        
+        # Панель ввода
+        self.create_input_panel()
+        
+        central_widget.setLayout(self.main_layout)
+        
+    def create_header(self):
+        header = QWidget()
+        header.setFixedHeight(60)
+        header.setStyleSheet("""
+            QWidget {
+                background: #1e2b3c;
+                border-bottom: 1px solid #2b5278;
+            }
+        """)
+        
+        header_layout = QHBoxLayout()
+        header_layout.setContentsMargins(20, 10, 20, 10)
+        
+        self.title_label = QLabel("Групповой чат")
+        self.title_label.setStyleSheet("""
+            QLabel {
+                color: white;
+                font-size: 16px;
+                font-weight: bold;
+            }
+        """)
+        header_layout.addWidget(self.title_label)
+        
+        self.status_label = QLabel("● онлайн")
+        self.status_label.setStyleSheet("""
+            QLabel {
+                color: #00d465;
+                font-size: 12px;
+            }
+        """)
+        header_layout.addWidget(self.status_label)
+        header_layout.addStretch()
+        
+        # Участники комнаты по сигналам присутствия; список - по нажатию
+        self.members_btn = QToolButton()
+        self.members_btn.setText("👥 1")
+        self.members_btn.setToolTip("Участники в сети")
+        self.members_btn.setPopupMode(QToolButton.InstantPopup)
+        self.members_btn.setStyleSheet("""
+            QToolButton {
+                background: transparent;
+                border: none;
+                color: #aaaaaa;
+                font-size: 13px;
+                padding: 4px 8px;
+            }
+            QToolButton:hover {
+                background: #2b5278;
+                border-radius: 12px;
+            }
+            QToolButton::menu-indicator {
+                image: none;
+            }
+        """)
+        self.members_menu = QMenu(self.members_btn)
+        self.members_menu.aboutToShow.connect(self.fill_members_menu)
+        self.members_btn.setMenu(self.members_menu)
+        header_layout.addWidget(self.members_btn)
+        
+        search_btn = QPushButton("🔍")
+        search_btn.setFixedSize(32, 32)
+        search_btn.setToolTip("Поиск по истории (Ctrl+F)")
+        search_btn.setStyleSheet("""
+            QPushButton {
+                background: transparent;
+                border: none;
+                font-size: 16px;
+            }
+            QPushButton:hover {
+                background: #2b5278;
+                border-radius: 16px;
+            }
+        """)
+        search_btn.clicked.connect(self.toggle_search)
+        header_layout.addWidget(search_btn)
+        
+        header.setLayout(header_layout)
+        self.main_layout.addWidget(header)
+        
+    def create_channel_bar(self):
+        self.channel_bar = QWidget()
+        self.channel_bar.setStyleSheet("""
+            QWidget {
+                background: #17212b;
+                border-bottom: 1px solid #2b5278;
+            }
+        """)
+        
+        channel_layout = QHBoxLayout()
+        channel_layout.setContentsMargins(10, 0, 10, 0)
+        channel_layout.setSpacing(5)
+        
+        self.channel_tabs = QTabBar()
+        self.channel_tabs.setExpanding(False)
+        self.channel_tabs.setTabsClosable(True)
+        self.channel_tabs.setDrawBase(False)
+        self.channel_tabs.setStyleSheet("""
+            QTabBar::tab {
+                background: transparent;
+                color: #aaaaaa;
+                border: none;
+                padding: 8px 12px;
+                font-size: 13px;
+            }
+            QTabBar::tab:selected {
+                color: white;
+                border-bottom: 2px solid #0088cc;
+            }
+            QTabBar::tab:hover {
+                color: white;
+            }
+        """)
+        self.channel_tabs.currentChanged.connect(self.on_tab_changed)
+        self.channel_tabs.tabCloseRequested.connect(self.leave_room)
+        channel_layout.addWidget(self.channel_tabs)
+        channel_layout.addStretch()
+        
+        join_btn = QPushButton("+")
+        join_btn.setFixedSize(28, 28)
+        join_btn.setToolTip("Открыть канал")
+        join_btn.setStyleSheet("""
+            QPushButton {
+                background: transparent;
+                border: none;
+                color: #aaaaaa;
+                font-size: 18px;
+            }
+            QPushButton:hover {
+                background: #2b5278;
+                border-radius: 14px;
+                color: white;
+            }
+        """)
+        join_btn.clicked.connect(self.join_room)
+        channel_layout.addWidget(join_btn)
+        
+        self.channel_bar.setLayout(channel_layout)
+        self.main_layout.addWidget(self.channel_bar)
+        
+    def create_search_bar(self):
+        self.search_bar = QWidget()
+        self.search_bar.setFixedHeight(50)
+        self.search_bar.setStyleSheet("""
+            QWidget {
+                background: #17212b;
+                border-bottom: 1px solid #2b5278;
+            }
+        """)
+        
+        search_layout = QHBoxLayout()
+        search_layout.setContentsMargins(15, 8, 15, 8)
+        search_layout.setSpacing(10)
+        
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText("Поиск: слова, префикс*, \"фраза\"")
+        self.search_input.setStyleSheet("""
+            QLineEdit {
+                background: #2b5278;
+                border: none;
+                border-radius: 15px;
+                padding: 6px 15px;
+                color: white;
+                font-size: 13px;
+            }
+        """)
+        # Enter - поиск, повторный Enter - следующее (более старое) совпадение
+        self.search_input.returnPressed.connect(self.search_next)
+        search_layout.addWidget(self.search_input)
+        
+        self.search_status = QLabel("")
+        self.search_status.setStyleSheet("""
+            QLabel {
+                color: #aaaaaa;
+                font-size: 12px;
+                border: none;
+            }
+        """)
+        search_layout.addWidget(self.search_status)
+        
+        self.search_bar.setLayout(search_layout)
+        self.search_bar.hide()
+        self.main_layout.addWidget(self.search_bar)
+        
+        QShortcut(QKeySequence.Find, self, self.toggle_search)
+        escape = QShortcut(QKeySequence(Qt.Key_Escape), self.search_bar, self.close_search)
+        escape.setContext(Qt.WidgetWithChildrenShortcut)
+        
+    def create_messages_area(self):
+        # Виртуализированный список: рисуются только видимые строки.
+        # Модель у каждого канала своя и ставится при переключении
+        self.messages_view = QListView()
+        self.messages_view.setItemDelegate(MessageDelegate(self.messages_view))
+        self.messages_view.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.messages_view.setVerticalScrollBarPolicy(Qt.ScrollBarAsNeeded)
+        self.messages_view.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.messages_view.setSelectionMode(QAbstractItemView.NoSelection)
+        self.messages_view.setFocusPolicy(Qt.NoFocus)
+        self.messages_view.setResizeMode(QListView.Adjust)
+        self.messages_view.setLayoutMode(QListView.Batched)
+        self.messages_view.setBatchSize(200)
+        
+        # Пока пользователь внизу списка, держимся за последним сообщением
+        # и при пакетной раскладке, которая растягивает диапазон прокрутки
+        self.follow_bottom = True
+        self.scroll_target = None
+        self.clamping = False
+        scrollbar = self.messages_view.verticalScrollBar()
+        scrollbar.valueChanged.connect(self.on_scroll)
+        scrollbar.rangeChanged.connect(self.on_scroll_range)
+        
+        self.main_layout.addWidget(self.messages_view)
+        
+    def create_input_panel(self):
+        input_widget = QWidget()
+        input_widget.setFixedHeight(80)
+        input_widget.setStyleSheet("""
+            QWidget {
+                background: #1e2b3c;
+                border-top: 1px solid #2b5278;
+            }
+        """)
+        
+        input_layout = QHBoxLayout()
+        input_layout.setContentsMargins(15, 15, 15, 15)
+        input_layout.setSpacing(10)
+        
+        attach_btn = QPushButton("📎")
+        attach_btn.setFixedSize(40, 40)
+        attach_btn.setToolTip("Отправить файл в канал")
+        attach_btn.setStyleSheet("""
+            QPushButton {
+                background: transparent;
+                border: none;
+                font-size: 18px;
+            }
+            QPushButton:hover {
+                background: #2b5278;
+                border-radius: 20px;
+            }
+        """)
+        attach_btn.clicked.connect(self.send_file)
+        input_layout.addWidget(attach_btn)
+        
+        self.message_input = QLineEdit()
+        self.message_input.setPlaceholderText("Введите сообщение...")
+        self.message_input.setStyleSheet("""
+            QLineEdit {
+                background: #2b5278;
+                border: none;
+                border-radius: 20px;
+                padding: 12px 20px;
+                color: white;
+                font-size: 14px;
+                selection-background-color: #0088cc;
+            }
+            QLineEdit:focus {
+                border: none;
+            }
+        """)
+        self.message_input.returnPressed.connect(self.send_message)
+        input_layout.addWidget(self.message_input)
+        
+        self.send_btn = AnimatedButton("↑")
+        self.send_btn.setFixedSize(50, 50)
+        self.send_btn.setStyleSheet("""
+            QPushButton {
+                background: qlineargradient(x1:0, y1:0, x2:1, y2:0,
+                stop:0 #0088cc, stop:1 #00a884);
+                color: white;
+                border: none;
+                border-radius: 25px;
+                font-size: 18px;
+                font-weight: bold;
+            }
+            QPushButton:hover {
+                background: qlineargradient(x1:0, y1:0, x2:1, y2:0,
+                stop:0 #0095e0, stop:1 #00b894);
+            }
+            QPushButton:pressed {
+                background: qlineargradient(x1:0, y1:0, x2:1, y2:0,
+                stop:0 #0077b3, stop:1 #009670);
+            }
+        """)
+        self.send_btn.clicked.connect(self.send_message)
+        input_layout.addWidget(self.send_btn)
+        
+        input_widget.setLayout(input_layout)
+        self.main_layout.addWidget(input_widget)
+        
+    def setup_chat(self):
+        try:
+            # Сеть работает в цикле событий Qt, отдельный поток не нужен
+            self.loop = QtLoop(self)
+            self.reorder = ReorderBuffer(self.loop, self.on_reordered, self.REORDER_DELAY)
+            default = self.rooms[DEFAULT_CHANNEL]
+            if self.worker:
+                try:
+                    self.messenger = WorkerMessenger.connect(self.username, self.loop, self.on_frame,
+                                                             self.WORKER_CONTROL, default.group,
+                                                             default.name, files=self.FILES_DIR)
+                    self.messenger.on_disconnect = self.on_worker_lost
+                except Exception as e:
+                    self.add_system_message(f"Сетевой процесс недоступен, сеть в окне: {str(e)}")
+            if self.messenger is None and self.hub:
+                try:
+                    self.messenger = HubMessenger(self.username, self.loop, self.on_frame, default.group,
+                                                  channel=default.name, limiter=self.limiter,
+                                                  send_rate=self.SEND_RATE)
+                except Exception as e:
+                    self.add_system_message(f"Узел хоста недоступен, свой сокет: {str(e)}")
+            if self.messenger is None:
+                self.messenger = MulticastMessenger(self.username, self.loop, self.on_frame,
+                                                    default.group, channel=default.name,
+                                                    limiter=self.limiter, send_rate=self.SEND_RATE)
+            
+            self.metrics.gauge('chim_presence_members', "Участники канала в сети, включая себя",
+                               lambda: len(self.room.presence.peers) + 1 if self.room.presence else 1)
+            self.metrics.gauge('chim_presence_interval_seconds', "Текущий интервал сигналов",
+                               lambda: self.room.presence.interval() if self.room.presence else None)
+            if isinstance(self.messenger, WorkerMessenger):
+                # Блоки файлов разбирает и пишет сетевой процесс
+                self.transfers = WorkerTransfers(self.messenger, self.on_transfer)
+            else:
+                self.transfers = Transfers(self.messenger, self.loop, self.FILES_DIR, self.on_transfer)
+            # Раздача истории своих каналов участникам, подключившимся позже
+            try:
+                self.sync_server = SyncServer(self.loop, self.history_of)
+            except Exception as e:
+                self.add_system_message(str(e))
+            for room in list(self.rooms.values()):
+                try:
+                    self.connect_room(room)
+                except Exception as e:
+                    self.add_system_message(f"Канал недоступен: {str(e)}", room)
+            
+            # Добавляем приветственное сообщение
+            self.add_system_message("Вы подключились к чату")
+        except Exception as e:
+            self.add_system_message(f"Ошибка подключения: {str(e)}")
+            
+    def on_worker_lost(self, reason):
+        """Сетевой процесс завершился: сеть переносится в окно"""
+        lost = self.messenger
+        self.status_label.setText("● нет сети")
+        self.add_system_message(f"Связь с сетевым процессом потеряна: {reason}")
+        default = self.rooms[DEFAULT_CHANNEL]
+        try:
+            messenger = MulticastMessenger(self.username, self.loop, self.on_frame, default.group,
+                                           channel=default.name, limiter=self.limiter,
+                                           send_rate=self.SEND_RATE)
+        except Exception as e:
+            self.add_system_message(f"Сеть недоступна: {str(e)}")
+            return
+        # Метки своих сообщений не должны пойти назад
+        messenger.clock = lost.clock
+        lost.close()
+        self.messenger = messenger
+        if self.transfers is not None:
+            # Передачи погибли вместе с процессом; отправители предложат файлы снова
+            self.transfers.close()
+            self.transfers = Transfers(messenger, self.loop, self.FILES_DIR, self.on_transfer)
+        for room in list(self.rooms.values()):
+            try:
+                messenger.subscribe(room.name, room.group)
+            except Exception as e:
+                self.add_system_message(f"Канал недоступен: {str(e)}", room)
+        self.add_system_message("Сеть перенесена в окно")
+        self.update_status()
+        
+    def setup_rooms(self):
+        """Каналы из сохранённого списка; общий канал есть всегда"""
+        channels = [(DEFAULT_CHANNEL, DEFAULT_GROUP)]
+        try:
+            with open(os.path.join(self.HISTORY_DIR, self.CHANNELS_FILE), encoding='utf-8') as channels_file:
+                for line in channels_file:
+                    if line.strip():
+                        channel = parse_channel(line)
+                        if channel[0] != DEFAULT_CHANNEL:
+                            channels.append(channel)
+        except OSError:
+            pass
+        except Exception as e:
+            print(f"Список каналов повреждён: {e}", file=sys.stderr)
+        for name, group in channels:
+            self.add_room(name, group)
+        self.switch_room(DEFAULT_CHANNEL)
+        
+    def save_rooms(self):
+        path = os.path.join(self.HISTORY_DIR, self.CHANNELS_FILE)
+        try:
+            os.makedirs(self.HISTORY_DIR, exist_ok=True)
+            with open(path + '.tmp', 'w', encoding='utf-8') as channels_file:
+                for room in self.rooms.values():
+                    if room.name != DEFAULT_CHANNEL:
+                        channels_file.write(f"{room.name}={room.group}\n")
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            self.add_system_message(f"Список каналов не сохранён: {str(e)}")
+            
+    def add_room(self, name, group):
+        room = ChatRoom(name, group, self)
+        self.rooms[name] = room
+        self.setup_history(room)
+        index = self.channel_tabs.addTab(room.title)
+        self.channel_tabs.setTabData(index, name)
+        if name == DEFAULT_CHANNEL:
+            # Общий канал закрыть нельзя
+            self.channel_tabs.setTabButton(index, QTabBar.RightSide, None)
+        return room
+        
+    def connect_room(self, room):
+        """Подписка на группу канала и сигналы присутствия в нём"""
+        self.messenger.subscribe(room.name, room.group)
+        name = room.name
+        
+        def send_presence(payload):
+            self.messenger.send_presence(payload, name)
+            
+        # Изменения списка участников копятся и показываются раз в ROSTER_UPDATE_MS
+        sync_port = self.sync_server.port if self.sync_server is not None else 0
+        room.presence = Presence(self.username, self.loop, send_presence, self.schedule_roster_update,
+                                 sync_port=sync_port)
+        room.presence.start()
+        room.catchup = self.loop.call_later(self.CATCHUP_DELAY, lambda: self.catch_up(room))
+        
+    def history_of(self, name):
+        room = self.rooms.get(name)
+        return room.history if room is not None else None
+        
+    def known_messages(self, room):
+        """Пары (отправитель, номер) сообщений канала, которые уже есть"""
+        if room.history is not None:
+            self.flush_history(room)
+            messages = room.history.tail(SyncServer.WINDOW)
+        else:
+            messages = room.model.messages
+        return {(message.sender_id, message.seq) for message in messages if message.seq}
+        
+    def catch_up(self, room):
+        """Догрузка сообщений, отправленных в канал до подключения"""
+        room.catchup = None
+        if self.rooms.get(room.name) is not room or room.presence is None:
+            return
+        peers = room.presence.sync_peers()
+        if not peers:
+            return
+        room.catchup = CatchUp(self.loop, room.name, peers, self.known_messages(room),
+                               lambda messages: self.merge_catchup(room, messages))
+        room.catchup.start()
+        
+    def merge_catchup(self, room, messages):
+        room.catchup = None
+        if self.rooms.get(room.name) is not room:
+            return
+        # За время догрузки часть сообщений могла прийти по multicast
+        known = self.known_messages(room)
+        messages = [message for message in messages if (message.sender_id, message.seq) not in known]
+        if not messages:
+            return
+        self.add_system_message(f"Загружены сообщения, отправленные до подключения: {len(messages)}", room)
+        for message in messages:
+            self.record_history(room, message)
+        if room.history_stop is None:
+            room.model.merge(messages)
+            if room is self.room and self.follow_bottom:
+                self.scroll_to_bottom()
+        
+    def join_room(self):
+        spec, accepted = QInputDialog.getText(self, "Новый канал", "Имя канала или имя=группа:")
+        if not accepted or not spec.strip():
+            return
+        try:
+            name, group = parse_channel(spec)
+            if name not in self.rooms:
+                room = self.add_room(name, group)
+                if self.messenger is not None:
+                    self.connect_room(room)
+                self.save_rooms()
+            self.switch_room(name)
+        except Exception as e:
+            self.add_system_message(f"Не удалось открыть канал: {str(e)}")
+            
+    def leave_room(self, index):
+        name = self.channel_tabs.tabData(index)
+        room = self.rooms.get(name)
+        if room is None or name == DEFAULT_CHANNEL:
+            return
+        if room is self.room:
+            self.switch_room(DEFAULT_CHANNEL)
+        self.close_room(room)
+        if self.messenger is not None:
+            try:
+                self.messenger.unsubscribe(name)
+            except Exception as e:
+                self.add_system_message(f"Ошибка отписки: {str(e)}")
+        del self.rooms[name]
+        self.channel_tabs.removeTab(index)
+        self.save_rooms()
+        
+    def close_room(self, room):
+        if room.catchup is not None:
+            room.catchup.cancel()
+            room.catchup = None
+        if room.presence is not None:
+            room.presence.stop()
+            room.presence = None
+        if room.history is not None:
+            room.history.close()
+            if room.search_index is not None:
+                room.search_index.save(room.history.first())
+                room.search_index = None
+            room.history = None
+            
+    def switch_room(self, name):
+        room = self.rooms[name]
+        if room is self.room:
+            return
+        if self.room is not None:
+            scrollbar = self.messages_view.verticalScrollBar()
+            self.room.scroll_value = None if self.follow_bottom else scrollbar.value()
+        self.room = room
+        room.unread = 0
+        index = self.tab_index(name)
+        self.channel_tabs.setTabText(index, room.title)
+        if self.channel_tabs.currentIndex() != index:
+            self.channel_tabs.setCurrentIndex(index)
+        self.title_label.setText(room.title)
+        
+        # Результаты поиска относятся к истории прежнего канала
+        self.search_query = None
+        self.search_results = []
+        self.search_status.setText("")
+        self.set_highlight(-1)
+        
+        self.messages_view.setModel(room.model)
+        self.scroll_target = None
+        if room.scroll_value is None:
+            self.scroll_to_bottom()
+        else:
+            self.follow_bottom = False
+            self.scroll_target = room.scroll_value
+            self.restore_scroll_target()
+        self.update_status()
+        
+    def tab_index(self, name):
+        for index in range(self.channel_tabs.count()):
+            if self.channel_tabs.tabData(index) == name:
+                return index
+        return -1
+        
+    def on_tab_changed(self, index):
+        name = self.channel_tabs.tabData(index)
+        if name in self.rooms:
+            self.switch_room(name)
+            
+    def mark_unread(self, room, count):
+        room.unread += count
+        self.channel_tabs.setTabText(self.tab_index(room.name), f"{room.title} ({room.unread})")
+        
+    def setup_history(self, room):
+        """Открытие истории канала: читается только хвост, остальное - при прокрутке вверх"""
+        try:
+            room.history = HistoryStore(os.path.join(self.HISTORY_DIR, room.name),
+                                        fsync=self.HISTORY_FSYNC)
+            # Индекс поиска читается в фоне и догоняет историю сам
+            room.search_index = SearchIndex(os.path.join(room.history.directory, 'search.idx'),
+                                            room.history)
+            room.search_index.load_async()
+            messages = room.history.tail(self.HISTORY_PAGE)
+            room.history_start = room.history.end() - len(messages)
+            room.model.extend(stamp_order(messages))
+        except Exception as e:
+            room.history = None
+            room.search_index = None
+            self.add_system_message(f"История недоступна: {str(e)}", room)
+            
+    def record_history(self, room, message):
+        """Запись сообщения в историю канала и в индекс поиска"""
+        if room.history is None:
+            return
+        try:
+            number = room.history.append(message)
+        except Exception as e:
+            self.report_history_error(room, e)
+            return
+        if room.search_index is not None:
+            room.search_index.add(number, message.text)
+            if room.search_index.unsaved >= self.SEARCH_SAVE_EVERY:
+                room.search_index.save(room.history.first())
+            
+    def flush_history(self, room):
+        """Дозапись истории канала не дольше HISTORY_FLUSH_TIMEOUT
+
+        Не дождавшись, читаем то, что уже на диске: окно не должно
+        замирать из-за медленного или сломанного диска.
+        """
+        try:
+            room.history.flush(self.HISTORY_FLUSH_TIMEOUT)
+        except Exception as e:
+            self.report_history_error(room, e)
+            
+    def report_history_error(self, room, error):
+        if not room.history_failed:
+            room.history_failed = True
+            self.add_system_message(str(error), room)
+            
+    def load_older_history(self):
+        if self.room.history is None or self.room.history_start <= self.room.history.first():
+            return
+        start = max(self.room.history.first(), self.room.history_start - self.HISTORY_PAGE)
+        messages = self.room.history.read(start, self.room.history_start)
+        self.room.history_start = start
+        if messages:
+            self.room.model.prepend(stamp_order(messages))
+            # Оставляем на экране то сообщение, что было верхним до подгрузки.
+            # Раскладка отложенная, поэтому сдвиг применяется, когда диапазон
+            # прокрутки вырастет на высоту добавленных строк
+            delegate = self.messages_view.itemDelegate()
+            available = self.messages_view.viewport().width() - 2 * delegate.MARGIN
+            added = sum(delegate.row_height(message, available) for message in messages)
+            self.scroll_target = self.messages_view.verticalScrollBar().value() + added
+            self.restore_scroll_target()
+            
+    def load_newer_history(self):
+        """Подгрузка вниз, когда открыто окно истории вокруг найденного сообщения"""
+        if self.room.history is None or self.room.history_stop is None:
+            return
+        stop = self.room.history_stop + self.HISTORY_PAGE
+        if stop >= self.room.history.end():
+            # Дошли до хвоста: дожидаемся записи отложенных сообщений
+            # и возвращаемся к живому списку
+            self.flush_history(self.room)
+            stop = self.room.history.end()
+            messages = self.room.history.read(self.room.history_stop, stop)
+            self.room.history_stop = None
+            self.update_status()
+        else:
+            messages = self.room.history.read(self.room.history_stop, stop)
+            self.room.history_stop = stop
+        # Опоздавшие из новой страницы встают на место среди уже показанных
+        self.room.model.merge(messages)
+        
+    def open_history_window(self, number):
+        """Замена списка окном истории вокруг записи number"""
+        self.flush_history(self.room)
+        end = self.room.history.end()
+        start = max(self.room.history.first(), number - self.HISTORY_PAGE // 2)
+        stop = min(end, start + self.HISTORY_PAGE)
+        self.scroll_target = None
+        self.follow_bottom = False
+        self.room.model.reset(stamp_order(self.room.history.read(start, stop)))
+        self.room.history_start = start
+        self.room.history_stop = None if stop >= end else stop
+        if self.room.history_stop is not None:
+            self.status_label.setText("● история")
+        
+    def return_to_live(self):
+        if self.room.history_stop is None:
+            return
+        self.flush_history(self.room)
+        messages = self.room.history.tail(self.HISTORY_PAGE)
+        self.room.history_start = self.room.history.end() - len(messages)
+        self.room.history_stop = None
+        self.room.model.reset(stamp_order(messages))
+        self.update_status()
+        
+    def schedule_roster_update(self):
+        if not self.roster_timer.isActive():
+            self.roster_timer.start()
+            
+    def update_status(self):
+        members = len(self.room.presence.peers) + 1 if self.room.presence is not None else 1
+        self.members_btn.setText(f"👥 {members}")
+        if self.room.history_stop is None:
+            offline = self.messenger is not None and not self.messenger.running
+            self.status_label.setText("● нет сети" if offline else "● онлайн")
+            
+    def fill_members_menu(self):
+        self.members_menu.clear()
+        names = self.room.presence.members() if self.room.presence is not None else [self.username]
+        for name in names:
+            action = self.members_menu.addAction(f"● {name}" + (" (вы)" if name == self.username else ""))
+            action.setEnabled(False)
+            
+    def toggle_search(self):
+        if self.search_bar.isVisible():
+            self.close_search()
+            return
+        self.search_bar.show()
+        self.search_input.setFocus()
+        self.search_input.selectAll()
+        
+    def close_search(self):
+        self.search_bar.hide()
+        self.search_query = None
+        self.search_results = []
+        self.search_status.setText("")
+        self.set_highlight(-1)
+        self.message_input.setFocus()
+        
+    def search_next(self):
+        query = self.search_input.text().strip()
+        if not query or self.room.search_index is None:
+            return
+        if not self.room.search_index.is_loaded():
+            # Поток загрузки ещё читает индекс: запрос повторится сам
+            self.search_query = None
+            self.search_results = []
+            self.search_status.setText("индекс загружается")
+            self.set_highlight(-1)
+            if not self.search_retry:
+                self.search_retry = True
+                QTimer.singleShot(self.SEARCH_RETRY_MS, self.retry_search)
+            return
+        if query != self.search_query:
+            self.search_query = query
+            self.search_results = self.room.search_index.search(query, self.SEARCH_LIMIT,
+                                                           self.room.history.first())
+            self.search_position = 0
+        elif self.search_results:
+            self.search_position = (self.search_position + 1) % len(self.search_results)
+        if not self.search_results:
+            self.search_status.setText("не найдено")
+            self.set_highlight(-1)
+            return
+        total = len(self.search_results)
+        suffix = "+" if total >= self.SEARCH_LIMIT else ""
+        self.search_status.setText(f"{self.search_position + 1}/{total}{suffix}")
+        self.jump_to(self.search_results[self.search_position])
+        
+    def retry_search(self):
+        self.search_retry = False
+        # Строку закрыли или поиск уже прошёл - повторять нечего
+        if self.search_bar.isVisible() and self.search_query is None:
+            self.search_next()
+        
+    def jump_to(self, number):
+        """Показ записи истории без загрузки всего, что лежит между ней и хвостом"""
+        if self.room.history is None or number < self.room.history.first():
+            return
+        row = -1
+        if number >= self.room.history_start:
+            row = self.room.model.row_of(number, number - self.room.history_start)
+        if row < 0:
+            self.open_history_window(number)
+            row = self.room.model.row_of(number, number - self.room.history_start)
+        if row < 0:
+            return
+        self.set_highlight(number)
+        self.follow_bottom = False
+        self.messages_view.scrollTo(self.room.model.index(row),
+                                    QAbstractItemView.PositionAtCenter)
+        
+    def set_highlight(self, number):
+        self.messages_view.itemDelegate().highlight = number
+        self.messages_view.viewport().update()
+            
+    def restore_scroll_target(self):
+        scrollbar = self.messages_view.verticalScrollBar()
+        if scrollbar.maximum() >= self.scroll_target:
+            target = self.scroll_target
+            self.scroll_target = None
+            scrollbar.setValue(target)
+            
+    def send_message(self):
+        message = self.message_input.text().strip()
+        if message and self.messenger:
+            try:
+                # Своё сообщение всегда показываем внизу живого списка: его
+                # метка больше меток всего принятого
+                self.return_to_live()
+                timestamp = self.messenger.clock.now()
+                chat_message = self.add_message(self.username, message, True, timestamp)
+                chat_message.sender_id = self.messenger.sender_id
+                chat_message.seq = self.messenger.send_message(message, self.room.name, timestamp)
+                self.record_history(self.room, chat_message)
+                self.message_input.clear()
+            except Exception as e:
+                self.add_system_message(f"Ошибка отправки: {str(e)}")
+            
+    def on_frame(self, frame):
+        room = self.rooms.get(frame.channel)
+        if room is None:
+            return
+        if frame.msg_type == MSG_CHAT:
+            # Текст декодируется лениво, когда сообщение понадобится
+            message = ChatMessage.from_payload(bytes(frame.payload), False, frame.timestamp,
+                                               frame.sender, frame.seq)
+            received = time.perf_counter() if self.metrics.enabled else None
+            self.reorder.put((order_key(frame.timestamp), frame.sender, frame.seq),
+                             (room, message, received))
+        elif frame.msg_type == MSG_PRESENCE and room.presence is not None:
+            room.presence.on_payload(frame.sender, frame.payload, frame.address)
+        elif frame.msg_type in (MSG_FILE_OFFER, MSG_FILE_DATA, MSG_FILE_NACK) and self.transfers:
+            self.transfers.on_frame(frame)
+                
+    def on_reordered(self, items):
+        """Пачка из окна переупорядочения - в очередь интерфейса"""
+        for room, message, received in items:
+            if self.inbox.put((room, message), room is not self.room):
+                self.schedule_drain()
+                # Задержка окна переупорядочения входит в замер
+                if (received is not None and room is self.room and self.follow_bottom
+                        and (self.render_since is None or received < self.render_since)):
+                    self.render_since = received
+                
+    def send_file(self):
+        if self.transfers is None:
+            return
+        path, _ = QFileDialog.getOpenFileName(self, "Отправить файл")
+        if not path:
+            return
+        try:
+            sender = self.transfers.send_file(path, self.room.name)
+            self.add_system_message(f"Отправка файла {sender.name} ({format_size(sender.size)})")
+        except Exception as e:
+            self.add_system_message(f"Ошибка отправки файла: {str(e)}")
+            
+    def on_transfer(self, kind, transfer):
+        room = self.rooms.get(transfer.channel, self.room)
+        if kind == 'offer':
+            peer = room.presence.peers.get(transfer.sender) if room.presence else None
+            source = f" от {peer.name}" if peer is not None else ""
+            text = f"Предложен файл {transfer.name} ({format_size(transfer.size)}){source}"
+            self.ask_offer(transfer, text)
+        elif kind == 'accepted':
+            resumed = f", продолжение с {transfer.resumed * 100 // max(1, transfer.count)}%" if transfer.resumed else ""
+            text = f"Приём файла {transfer.name} ({format_size(transfer.size)}){resumed}"
+        elif kind == 'received':
+            text = f"Файл сохранён: {transfer.path}"
+        elif kind == 'failed':
+            reason = transfer.error or "раздача закончилась"
+            text = f"Файл {transfer.name} не получен: {reason}"
+        elif kind == 'paused':
+            text = f"Приём файла {transfer.name} приостановлен: отправитель не отвечает"
+        else:
+            text = f"Файл {transfer.name} отправлен"
+        self.add_system_message(text, room)
+        
+    def ask_offer(self, transfer, text):
+        """Вопрос о приёме файла; окно чата при этом не блокируется"""
+        box = QMessageBox(QMessageBox.Question, "Приём файла", text + "\n\nПринять?",
+                          QMessageBox.Yes | QMessageBox.No, self)
+        box.setAttribute(Qt.WA_DeleteOnClose)
+        box.setModal(False)
+        box.finished.connect(lambda result: self.answer_offer(transfer, result == QMessageBox.Yes))
+        box.show()
+
+    def answer_offer(self, transfer, accepted):
+        if self.transfers is None:
+            return
+        room = self.rooms.get(transfer.channel, self.room)
+        try:
+            if not accepted:
+                self.transfers.decline(transfer)
+                self.add_system_message(f"Файл {transfer.name} отклонён", room)
+            elif not self.transfers.accept(transfer):
+                self.add_system_message(f"Предложение файла {transfer.name} больше не действует", room)
+        except Exception as e:
+            self.add_system_message(f"Ошибка приёма файла: {str(e)}", room)
+
+    def add_message(self, sender, message, is_own, timestamp=None):
+        chat_message = ChatMessage(sender, message, is_own, self.stamp() if timestamp is None else timestamp)
+        self.room.model.append(chat_message)
+            
+        # Прокручиваем к низу сразу, как в drain_inbox
+        self.scroll_to_bottom()
+        return chat_message
+        
+    def stamp(self):
+        """Метка события окна: часы сети или, до подключения, время"""
+        return self.messenger.clock.now() if self.messenger is not None else now_ms()
+        
+    def schedule_drain(self):
+        if not self.drain_timer.isActive():
+            self.drain_timer.start()
+            
+    def drain_inbox(self):
+        """Разбор пачки входящих: по одной вставке в модель канала и одна прокрутка"""
+        batches = {}
+        for room, message in self.inbox.drain(self.DRAIN_BUDGET):
+            self.record_history(room, message)
+            batches.setdefault(room, []).append(message)
+        for room, messages in batches.items():
+            if self.rooms.get(room.name) is not room:
+                # Канал закрыт, пока сообщения ждали разбора
+                continue
+            if room is not self.room:
+                self.mark_unread(room, len(messages))
+            # Пока открыто окно старой истории, новые сообщения попадут
+            # в список при подгрузке вниз
+            if room.history_stop is None:
+                started = time.perf_counter() if self.metrics.enabled else None
+                room.model.merge(messages)
+                if room is self.room and self.follow_bottom:
+                    self.scroll_to_bottom()
+                if started is not None:
+                    self.insert_time.observe(time.perf_counter() - started)
+        # Остаток разбираем в следующем кадре, чтобы не блокировать ввод
+        if len(self.inbox):
+            self.drain_timer.start()
+        
+    def add_system_message(self, message, room=None):
+        room = self.room if room is None else room
+        chat_message = ChatMessage("", message, False, self.stamp(), KIND_SYSTEM)
+        room.model.append(chat_message)
+        return chat_message
+        
+    def report_floods(self):
+        """Сводные строки о подавленных и отброшенных сообщениях"""
+        for (sender, channel), count in self.limiter.take_suppressed().items():
+            room = self.rooms.get(channel)
+            if room is None:
+                continue
+            peer = room.presence.peers.get(sender) if room.presence else None
+            name = peer.name if peer is not None else f"{sender:016x}"[:8]
+            self.collapse_notice((sender, channel), room, count,
+                                 f"Скрыты сообщения {name} (слишком часто)")
+        dropped = self.inbox.dropped - self.inbox_dropped
+        if dropped:
+            self.inbox_dropped = self.inbox.dropped
+            self.collapse_notice(None, self.room, dropped, "Перегрузка: входящие пропущены")
+        now = time.monotonic()
+        for key, notice in list(self.flood_notices.items()):
+            if now - notice[2] > self.FLOOD_QUIET:
+                del self.flood_notices[key]
+                
+    def collapse_notice(self, key, room, count, label):
+        now = time.monotonic()
+        notice = self.flood_notices.get(key)
+        if notice is not None and notice[3] is room:
+            notice[1] += count
+            notice[2] = now
+            message = ChatMessage("", f"{label}: {notice[1]}", False, notice[0].timestamp, KIND_SYSTEM)
+            if room.model.replace(notice[0], message):
+                notice[0] = message
+                return
+        message = self.add_system_message(f"{label}: {count}", room)
+        self.flood_notices[key] = [message, count, now, room]
+        
+    def scroll_to_bottom(self):
+        self.follow_bottom = True
+        self.messages_view.scrollToBottom()
+        
+    def on_scroll(self, value):
+        if self.clamping:
+            self.clamping = False
+            return
+        scrollbar = self.messages_view.verticalScrollBar()
+        self.follow_bottom = value >= scrollbar.maximum() and self.room.history_stop is None
+        if value == scrollbar.minimum() and scrollbar.maximum() > 0:
+            self.load_older_history()
+        elif value >= scrollbar.maximum() and self.room.history_stop is not None:
+            self.load_newer_history()
+        
+    def on_scroll_range(self, minimum, maximum):
+        scrollbar = self.messages_view.verticalScrollBar()
+        if not self.follow_bottom and scrollbar.value() > maximum:
+            # Пакетная раскладка временно укоротила список: позицию
+            # запоминаем и восстанавливаем, когда раскладка догонит
+            self.clamping = True
+            if self.scroll_target is None:
+                self.scroll_target = scrollbar.value()
+        elif self.scroll_target is not None:
+            self.restore_scroll_target()
+        elif self.follow_bottom:
+            self.messages_view.verticalScrollBar().setValue(maximum)
+        
+    def closeEvent(self, event):
+        # Сигналы ухода уходят до закрытия сокета
+        for room in self.rooms.values():
+            if room.presence is not None:
+                room.presence.stop()
+                room.presence = None
+        if self.transfers is not None:
+            # Незаконченный приём сохраняет карту блоков для продолжения
+            self.transfers.close()
+            self.transfers = None
+        if self.sync_server is not None:
+            self.sync_server.close()
+            self.sync_server = None
+        if self.messenger:
+            self.messenger.close()
+        if self.reorder is not None:
+            # Сообщения из окна переупорядочения успевают попасть в историю
+            self.reorder.close()
+            while len(self.inbox):
+                self.drain_inbox()
+        if self.metrics_file:
+            try:
+                self.metrics.dump(self.metrics_file)
+            except OSError:
+                pass
+        for room in self.rooms.values():
+            self.close_room(room)
+        event.accept()
+
+
+class MessengerApp:
+    def __init__(self, worker=False, hub=False):
+        self.app = QApplication(sys.argv)
+        
+        # Устанавливаем стиль приложения
+        self.app.setStyle('Fusion')
+        
+        self.login_window = LoginWindow()
+        self.chat_window = None
+        self.worker = worker
+        self.hub = hub
+        
+        self.login_window.login_success.connect(self.open_chat)
+        
+    def run(self):
+        self.login_window.show()
+        return self.app.exec_()
+        
+    def open_chat(self, username):
+        self.login_window.close()
+        self.chat_window = ChatWindow(username, self.worker, self.hub)
+        self.chat_window.show()
+
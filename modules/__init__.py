@@ -0,0 +1 @@
+"""Модули ядра Chim Messenger, не зависящие от Qt"""
@@ -0,0 +1,29 @@
+"""Пул заранее выделенных буферов приёма
+
+Датаграмма читается через recv_into прямо в буфер из пула, заголовок
+разбирается через memoryview, и для чужих пакетов или собственного эха
+не создаётся ни bytes, ни str. Буфер возвращается в пул сразу после
+разбора, поэтому данные из него нужно копировать, если они нужны дольше.
+"""
+from collections import deque
+
+
+class BufferPool:
+    def __init__(self, count=16, size=65535):
+        self.size = size
+        self.free = deque(bytearray(size) for _ in range(count))
+
+        # Сколько раз пул был пуст и буфер пришлось выделить заново
+        self.misses = 0
+
+    def acquire(self):
+        if self.free:
+            return self.free.pop()
+        self.misses += 1
+        return bytearray(self.size)
+
+    def release(self, buffer):
+        self.free.append(buffer)
+
+    def __len__(self):
+        return len(self.free)
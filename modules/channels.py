@@ -0,0 +1,48 @@
+"""Каналы чата и их multicast-группы
+
+Каждый канал - отдельная multicast-группа на общем порту. Клиент
+подписывается только на свои каналы, поэтому трафик чужих каналов
+отсеивает сетевая карта или ядро, а не приложение.
+
+Группа канала выводится из имени хешем в диапазон 239.255.0.0/16
+(локальная область, RFC 2365) либо задаётся явно в виде "имя=группа".
+Общий канал занимает прежнюю группу 224.1.1.1, поэтому клиенты без
+поддержки каналов видят его как раньше.
+"""
+import hashlib
+import ipaddress
+
+DEFAULT_CHANNEL = 'general'
+DEFAULT_GROUP = '224.1.1.1'
+MAX_CHANNEL_NAME = 64
+
+
+def channel_group(name):
+    """Multicast-группа канала по его имени"""
+    if name == DEFAULT_CHANNEL:
+        return DEFAULT_GROUP
+    digest = hashlib.blake2s(name.casefold().encode('utf-8'), digest_size=4).digest()
+    value = int.from_bytes(digest, 'big')
+    # 239.255.255.x не используется: там SSDP и другие служебные группы
+    return f"239.255.{value % 255}.{1 + (value >> 8) % 254}"
+
+
+def parse_channel(spec):
+    """Разбор "имя" или "имя=группа": (имя, группа)"""
+    name, _, group = spec.partition('=')
+    name = name.strip().lstrip('#')
+    if not name:
+        raise Exception("Пустое имя канала")
+    if len(name) > MAX_CHANNEL_NAME:
+        raise Exception(f"Имя канала длиннее {MAX_CHANNEL_NAME} символов")
+    # Имя канала - ещё и имя каталога его истории
+    if name in ('.', '..') or any(char in name for char in '/\\:*?"<>|'):
+        raise Exception(f"Недопустимое имя канала: {name}")
+    group = group.strip() or channel_group(name)
+    try:
+        multicast = ipaddress.IPv4Address(group).is_multicast
+    except ValueError:
+        multicast = False
+    if not multicast:
+        raise Exception(f"{group} не является multicast-адресом IPv4")
+    return name, group
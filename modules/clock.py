@@ -0,0 +1,59 @@
+"""Гибридные логические часы для меток кадров
+
+Метка - 64-битное число: миллисекунды от эпохи в старших 48 битах и
+логический счётчик в младших 16 (Kulkarni et al., "Logical Physical
+Clocks"). Метка отправки всегда больше меток всего, что узел к этому
+моменту принял, поэтому ответ не окажется в списке раньше вопроса даже
+при расхождении часов, а в остальном метки следуют физическому времени
+и годятся для показа.
+
+Старые клиенты и записи истории несут просто миллисекунды; такие
+значения меньше LEGACY_LIMIT и сравниваются через order_key.
+"""
+from modules.protocol import now_ms
+
+LOGICAL_BITS = 16
+# Любая метка часов больше любого времени в миллисекундах до 10889 года
+LEGACY_LIMIT = 1 << 48
+
+
+def physical_ms(timestamp):
+    """Миллисекунды от эпохи из метки часов или старого времени"""
+    return timestamp >> LOGICAL_BITS if timestamp >= LEGACY_LIMIT else timestamp
+
+
+def order_key(timestamp):
+    """Ключ упорядочения, общий для меток часов и старого времени"""
+    return timestamp if timestamp >= LEGACY_LIMIT else timestamp << LOGICAL_BITS
+
+
+class HybridClock:
+    """Часы одного узла: now() для своих событий, update() для принятых
+
+    Метка отправителя, убежавшая вперёд больше чем на max_drift
+    миллисекунд, часы не двигает, а кадр получает локальную метку -
+    иначе одна машина с неверным временем увела бы вперёд всю сеть.
+    """
+
+    def __init__(self, max_drift=60000, wall=now_ms):
+        self.max_drift = max_drift << LOGICAL_BITS
+        self.wall = wall
+        self.last = 0
+        self.skewed = 0
+
+    def now(self):
+        """Метка своего события: не меньше физического времени и больше прошлой"""
+        wall = self.wall() << LOGICAL_BITS
+        self.last = wall if wall > self.last else self.last + 1
+        return self.last
+
+    def update(self, remote):
+        """Учёт метки принятого кадра; метка, по которой его упорядочивать"""
+        if remote < LEGACY_LIMIT:
+            return remote
+        wall = self.wall() << LOGICAL_BITS
+        if remote - wall > self.max_drift:
+            self.skewed += 1
+            return self.now()
+        self.last = max(wall, self.last + 1, remote + 1)
+        return remote
@@ -0,0 +1,58 @@
+"""Сжатие полезной нагрузки кадров общим словарём
+
+Сжатая нагрузка - это байт идентификатора словаря и поток raw deflate
+без заголовка и контрольной суммы zlib (целостность датаграммы уже
+проверяет UDP). Кадр со сжатой нагрузкой несёт флаг FLAG_COMPRESSED.
+
+Короткие сообщения чата почти не сжимаются сами по себе, поэтому
+компрессор каждый раз начинает с общего словаря из modules/dictionary.py.
+Если сжатие не экономит байты, нагрузка отправляется как есть.
+"""
+import zlib
+
+from modules.dictionary import PHRASES
+from modules.protocol import ProtocolError
+
+DICTIONARY_ID = 1
+DICTIONARY = ''.join(PHRASES).encode('utf-8')
+
+# Окно 4 КиБ вмещает словарь и сообщение; меньшее окно и memLevel
+# заметно удешевляют создание компрессора на каждое сообщение
+WINDOW_BITS = 12
+MEM_LEVEL = 5
+LEVEL = 6
+
+# Нагрузки короче этого не сжимаются: выигрыш меньше байта идентификатора
+MIN_SIZE = 16
+
+assert len(DICTIONARY) <= 1 << WINDOW_BITS, "Словарь не помещается в окно deflate"
+
+
+def compress(payload):
+    """Сжатая нагрузка или None, если сжатие не окупается"""
+    if len(payload) < MIN_SIZE:
+        return None
+    compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, -WINDOW_BITS, MEM_LEVEL,
+                                  zlib.Z_DEFAULT_STRATEGY, DICTIONARY)
+    data = bytes((DICTIONARY_ID,)) + compressor.compress(payload) + compressor.flush()
+    if len(data) >= len(payload):
+        return None
+    return data
+
+
+def decompress(data, max_size):
+    """Распаковка нагрузки не длиннее max_size байт"""
+    if not len(data):
+        raise ProtocolError("Пустая сжатая нагрузка")
+    if data[0] != DICTIONARY_ID:
+        raise ProtocolError(f"Неизвестный словарь сжатия: {data[0]}")
+    decompressor = zlib.decompressobj(-WINDOW_BITS, DICTIONARY)
+    try:
+        payload = decompressor.decompress(data[1:], max_size)
+    except zlib.error as e:
+        raise ProtocolError(f"Повреждённая сжатая нагрузка: {e}")
+    if decompressor.unconsumed_tail:
+        raise ProtocolError(f"Распакованная нагрузка длиннее {max_size} байт")
+    if not decompressor.eof:
+        raise ProtocolError("Сжатая нагрузка обрезана")
+    return payload
@@ -0,0 +1,142 @@
+"""Подавление повторных кадров с ограниченной памятью
+
+Копии одного кадра приходят через несколько интерфейсов, от
+ретрансляторов разных сегментов и как повторы по NACK. Кадр с номером
+опознаётся парой (отправитель, номер): идентификатор отправителя
+случаен для каждого запуска (modules/protocol.py), номера свои у каждого
+канала. SeenFilter хранит на отправителя старший номер и битовую маску
+предыдущих - проверка и отметка за O(1). Кадры вне последовательности
+(присутствие, NACK, блоки файлов) и отправители, вытесненные из таблицы,
+проверяются по RotatingBloom - фильтру Блума из двух поколений, который
+помнит ключи ограниченное время и занимает фиксированную память.
+"""
+import math
+import time
+from collections import OrderedDict
+
+HASH_MASK = (1 << 64) - 1
+
+
+class RotatingBloom:
+    """Фильтр Блума из двух поколений: ключ помнится от period до 2 * period
+
+    Поколение сменяется по времени или по заполнению до capacity ключей,
+    поэтому доля ложных срабатываний (новый ключ, принятый за повтор) не
+    превышает error_rate. Хеш-функций четыре: каждая - это проверка в
+    Python, и меньшее их число с большей битовой таблицей дешевле
+    оптимальных 17 при той же доле ошибок.
+    """
+
+    def __init__(self, capacity=16384, error_rate=1e-5, period=30.0, clock=time.monotonic):
+        self.capacity = capacity
+        self.size = math.ceil(-4 * capacity / math.log(1 - error_rate ** 0.25))
+        self.period = period
+        self.clock = clock
+        self.current = bytearray((self.size + 7) // 8)
+        self.previous = bytearray(len(self.current))
+        self.count = 0
+        self.rotated = clock()
+
+    def positions(self, key):
+        # Двойное хеширование: четыре позиции из двух половин 64-битного хеша
+        value = hash(key) & HASH_MASK
+        size = self.size
+        first = value % size
+        step = (value >> 32) % size | 1
+        return first, (first + step) % size, (first + 2 * step) % size, (first + 3 * step) % size
+
+    def rotate(self):
+        now = self.clock()
+        if now - self.rotated >= self.period or self.count >= self.capacity:
+            # После долгой тишины устарели оба поколения
+            self.previous = self.current if now - self.rotated < 2 * self.period else bytearray(len(self.current))
+            self.current = bytearray(len(self.previous))
+            self.count = 0
+            self.rotated = now
+
+    def add(self, key):
+        """Запоминание ключа; False, если он уже встречался"""
+        self.rotate()
+        a, b, c, d = self.positions(key)
+        bits = self.current
+        if bits[a >> 3] >> (a & 7) & bits[b >> 3] >> (b & 7) & \
+                bits[c >> 3] >> (c & 7) & bits[d >> 3] >> (d & 7) & 1:
+            return False
+        bits[a >> 3] |= 1 << (a & 7)
+        bits[b >> 3] |= 1 << (b & 7)
+        bits[c >> 3] |= 1 << (c & 7)
+        bits[d >> 3] |= 1 << (d & 7)
+        self.count += 1
+        bits = self.previous
+        return not bits[a >> 3] >> (a & 7) & bits[b >> 3] >> (b & 7) & \
+            bits[c >> 3] >> (c & 7) & bits[d >> 3] >> (d & 7) & 1
+
+    def __contains__(self, key):
+        self.rotate()
+        a, b, c, d = self.positions(key)
+        return any(bits[a >> 3] >> (a & 7) & bits[b >> 3] >> (b & 7) &
+                   bits[c >> 3] >> (c & 7) & bits[d >> 3] >> (d & 7) & 1
+                   for bits in (self.current, self.previous))
+
+
+class SeenFilter:
+    """Повторы кадров канала: окно номеров на отправителя и фильтр Блума
+
+    Номер старше окна считается повтором: отправитель хранит для повтора
+    по NACK столько же последних кадров (modules/reliability.py), новым
+    такой кадр быть не может. Отправителей не больше max_senders; давно
+    молчавший вытесняется, его отметки переходят в фильтр Блума, и номера
+    до начала нового окна этого отправителя проверяются по фильтру.
+    """
+
+    def __init__(self, window=1024, max_senders=4096, bloom=None):
+        self.window = window
+        self.mask = (1 << window) - 1
+        self.max_senders = max_senders
+        self.bloom = RotatingBloom() if bloom is None else bloom
+        # Отправитель -> [старший номер, маска, первый номер окна]
+        self.senders = OrderedDict()
+        self.duplicates = 0
+
+    def seen(self, sender, seq):
+        """Отметка номера отправителя; True, если он уже встречался"""
+        state = self.senders.get(sender)
+        if state is None:
+            if len(self.senders) >= self.max_senders:
+                self.evict()
+            self.senders[sender] = [seq, 1, seq]
+            return self.count((sender, seq) in self.bloom)
+        self.senders.move_to_end(sender)
+        top, bits, first = state
+        if seq > top:
+            shift = seq - top
+            state[0] = seq
+            state[1] = ((bits << shift) | 1) & self.mask if shift < self.window else 1
+            return False
+        offset = top - seq
+        if offset >= self.window or bits >> offset & 1:
+            return self.count(True)
+        state[1] = bits | (1 << offset)
+        # Номер из времени до вытеснения отправителя
+        if seq < first:
+            return self.count((sender, seq) in self.bloom)
+        return False
+
+    def seen_key(self, key):
+        """Отметка кадра вне последовательности; True для повтора"""
+        return self.count(not self.bloom.add(key))
+
+    def count(self, duplicate):
+        if duplicate:
+            self.duplicates += 1
+        return duplicate
+
+    def evict(self):
+        sender, (top, bits, _) = self.senders.popitem(last=False)
+        while bits:
+            low = bits & -bits
+            self.bloom.add((sender, top - low.bit_length() + 1))
+            bits ^= low
+
+    def __len__(self):
+        return len(self.senders)
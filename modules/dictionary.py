@@ -0,0 +1,126 @@
+"""Общий словарь сжатия сообщений чата
+
+Словарь - это готовая "предыстория" для deflate: фрагменты, которые
+чаще всего встречаются в переписке, кодируются ссылкой на словарь вместо
+самих байтов. Чем ближе фрагмент к концу словаря, тем короче ссылка,
+поэтому самые частые фразы стоят в конце.
+
+Словарь должен быть одинаковым у всех участников. Любое изменение
+списка требует нового DICTIONARY_ID в modules/compression.py.
+"""
+
+PHRASES = (
+    # Английский: редкие фразы в начале
+    "Could you please take a look at the pull request when you have a minute? ",
+    "The deployment to production is scheduled for tomorrow morning. ",
+    "I have pushed the fix to the repository, please pull the latest changes. ",
+    "Can someone review the merge request before the release? ",
+    "The build is failing on the integration tests again. ",
+    "I will be out of the office this afternoon. ",
+    "Let me know if you need anything else from me. ",
+    "The meeting has been moved to the conference room. ",
+    "Thanks for the update, I will check it now. ",
+    "Does anyone know why the server is not responding? ",
+    "Please restart the service and check the logs. ",
+    "I am working on it right now. ",
+    "Sounds good, thank you! ",
+    "Good morning everyone! ",
+    "Is everything working now? ",
+    "error: connection refused ",
+    "Traceback (most recent call last): ",
+    "File \"",
+    "http://",
+    "https://",
+    "localhost:",
+    "password ",
+    "database ",
+    "version ",
+    "update ",
+    "problem ",
+    "today ",
+    "tomorrow ",
+    "meeting ",
+    "server ",
+    "please ",
+    "thanks ",
+    "the ",
+    "and ",
+    "you ",
+    "is ",
+    "ok ",
+
+    # Русский: редкие фразы в начале
+    "Коллеги, напоминаю, что завтра в десять утра планёрка в переговорной. ",
+    "Пожалуйста, посмотрите запрос на слияние, когда будет минутка. ",
+    "Обновление на боевом сервере запланировано на вечер. ",
+    "Я залил исправление в репозиторий, подтяните последние изменения. ",
+    "Кто-нибудь знает, почему сервер не отвечает? ",
+    "Сборка опять падает на интеграционных тестах. ",
+    "Перезапустите, пожалуйста, службу и посмотрите логи. ",
+    "Сегодня после обеда меня не будет на месте. ",
+    "Если что-то понадобится, пишите в личку. ",
+    "Совещание перенесли на четыре часа. ",
+    "Спасибо, сейчас посмотрю. ",
+    "Уже разбираюсь, подождите немного. ",
+    "Всем доброе утро! ",
+    "Всем привет! ",
+    "Сейчас всё работает? ",
+    "Не работает принтер на втором этаже. ",
+    "Проверьте, пожалуйста, ",
+    "ошибка подключения ",
+    "перезагрузить ",
+    "компьютер ",
+    "программа ",
+    "обновление ",
+    "документ ",
+    "проблема ",
+    "таблица ",
+    "задача ",
+    "сегодня ",
+    "завтра ",
+    "сейчас ",
+    "сервер ",
+    "сеть ",
+    "файл ",
+    "папка ",
+    "почта ",
+    "обед ",
+    "пароль ",
+    "вопрос ",
+    "можно ",
+    "нужно ",
+    "надо ",
+    "пожалуйста ",
+    "спасибо ",
+    "хорошо ",
+    "понял ",
+    "привет ",
+    "коллеги ",
+    "кто ",
+    "что ",
+    "как ",
+    "где ",
+    "это ",
+    "уже ",
+    "ещё ",
+    "там ",
+    "тоже ",
+    "если ",
+    "когда ",
+    "все ",
+    "есть ",
+    "нет ",
+    "да ",
+    "не ",
+    "на ",
+    "по ",
+    "в ",
+    "и ",
+    "с ",
+
+    # Имена рабочих станций - IP-адреса локальной сети
+    "10.0.0.",
+    "172.16.",
+    "192.168.0.",
+    "192.168.1.",
+)
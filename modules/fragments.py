@@ -0,0 +1,144 @@
+"""Фрагментация и сборка сообщений, не помещающихся в одну датаграмму
+
+Каждый фрагмент - обычный кадр с флагом FLAG_FRAGMENT и собственным
+порядковым номером. Полезная нагрузка фрагмента начинается с индекса и
+общего числа фрагментов; номер первого фрагмента (seq - index) служит
+идентификатором сообщения.
+"""
+import struct
+import time
+from collections import OrderedDict
+
+from modules.protocol import (FLAG_FRAGMENT, HEADER_SIZE, MAX_DATAGRAM, Frame,
+                              ProtocolError, encode_frame)
+
+FRAGMENT = struct.Struct('!HH')
+FRAGMENT_CHUNK = MAX_DATAGRAM - HEADER_SIZE - FRAGMENT.size
+MAX_FRAGMENTS = 0xFFFF
+
+
+def fragment(msg_type, sender, first_seq, timestamp, payload, flags=0,
+             chunk_size=FRAGMENT_CHUNK):
+    """Разбиение полезной нагрузки на датаграммы не длиннее MAX_DATAGRAM
+
+    Короткие сообщения отправляются одним кадром без флага фрагмента.
+    Фрагменты получают номера first_seq, first_seq + 1, ...
+    """
+    if HEADER_SIZE + len(payload) <= MAX_DATAGRAM:
+        return [encode_frame(msg_type, sender, first_seq, timestamp, payload, flags)]
+
+    count = (len(payload) + chunk_size - 1) // chunk_size
+    if count > MAX_FRAGMENTS:
+        raise ProtocolError(f"Сообщение слишком большое: {len(payload)} байт")
+
+    view = memoryview(payload)
+    datagrams = []
+    for index in range(count):
+        chunk = view[index * chunk_size:(index + 1) * chunk_size]
+        datagrams.append(encode_frame(
+            msg_type, sender, first_seq + index, timestamp,
+            FRAGMENT.pack(index, count) + chunk, flags | FLAG_FRAGMENT
+        ))
+    return datagrams
+
+
+class _Partial:
+    __slots__ = ('frame', 'count', 'chunks', 'received', 'size', 'started')
+
+    def __init__(self, frame, count, started):
+        self.frame = frame
+        self.count = count
+        self.chunks = [None] * count
+        self.received = 0
+        self.size = 0
+        self.started = started
+
+
+class Reassembler:
+    """Ограниченный буфер сборки фрагментированных сообщений
+
+    Незавершённые сообщения удаляются по таймауту, а при превышении
+    лимита числа сообщений или суммарного объёма вытесняются самые старые.
+    """
+
+    def __init__(self, timeout=5.0, max_pending=64, max_bytes=8 * 1024 * 1024,
+                 max_message=1024 * 1024, clock=time.monotonic):
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.max_bytes = max_bytes
+        self.max_fragments = max(1, max_message // FRAGMENT_CHUNK + 1)
+        self.clock = clock
+        self.pending = OrderedDict()
+        self.pending_bytes = 0
+
+        # Статистика
+        self.completed = 0
+        self.expired = 0
+        self.evicted = 0
+        self.rejected = 0
+
+    def add(self, frame):
+        """Приём фрагмента; возвращает собранный кадр или None"""
+        payload = frame.payload
+        if len(payload) < FRAGMENT.size:
+            self.rejected += 1
+            return None
+        index, count = FRAGMENT.unpack_from(payload)
+        if index >= count or count > self.max_fragments:
+            self.rejected += 1
+            return None
+
+        now = self.clock()
+        self.expire(now)
+
+        key = (frame.sender, (frame.seq - index) & 0xFFFFFFFF)
+        partial = self.pending.get(key)
+        if partial is None:
+            partial = _Partial(frame, count, now)
+            self.pending[key] = partial
+        elif partial.count != count:
+            self.rejected += 1
+            return None
+
+        if partial.chunks[index] is None:
+            chunk = bytes(payload[FRAGMENT.size:])
+            partial.chunks[index] = chunk
+            partial.received += 1
+            partial.size += len(chunk)
+            self.pending_bytes += len(chunk)
+            if index == 0:
+                partial.frame = frame
+
+        if partial.received == partial.count:
+            del self.pending[key]
+            self.pending_bytes -= partial.size
+            self.completed += 1
+            first = partial.frame
+            return Frame(first.msg_type, first.flags & ~FLAG_FRAGMENT, first.sender,
+                         key[1], first.timestamp, b''.join(partial.chunks))
+
+        self.enforce_limits()
+        return None
+
+    def expire(self, now=None):
+        """Удаление сообщений, не собранных за timeout секунд"""
+        if now is None:
+            now = self.clock()
+        deadline = now - self.timeout
+        # Словарь упорядочен по времени первого фрагмента
+        while self.pending:
+            key, partial = next(iter(self.pending.items()))
+            if partial.started > deadline:
+                break
+            self._drop(key)
+            self.expired += 1
+
+    def enforce_limits(self):
+        while self.pending and (len(self.pending) > self.max_pending or
+                                self.pending_bytes > self.max_bytes):
+            self._drop(next(iter(self.pending)))
+            self.evicted += 1
+
+    def _drop(self, key):
+        partial = self.pending.pop(key)
+        self.pending_bytes -= partial.size
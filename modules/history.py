@@ -0,0 +1,408 @@
+"""Постоянная история сообщений: сегментированный журнал с индексом в mmap
+
+Каталог истории содержит пары файлов на сегмент, имя - номер первой
+записи сегмента:
+
+    00000000000000000000.log   записи подряд: заголовок RECORD и полезная
+                               нагрузка MSG_CHAT
+    00000000000000000000.idx   массив конечных смещений записей в .log
+                               (8 байт на запись), отображён в память
+
+Конец записи всегда больше нуля, поэтому число записей сегмента - это
+число ненулевых элементов индекса. Запись идёт только в конец последнего
+сегмента из фонового потока пачками (групповая фиксация); старые
+сегменты удаляются целиком, когда история превышает max_bytes.
+"""
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+from modules.messages import ChatMessage
+
+# длина полезной нагрузки, флаги, отправитель, номер, время
+RECORD = struct.Struct('!IBQIQ')
+RECORD_OWN = 0x01
+INDEX_ENTRY = struct.Struct('!Q')
+
+FSYNC_ALWAYS = 'always'
+FSYNC_INTERVAL = 'interval'
+FSYNC_NEVER = 'never'
+
+# Каталог историй по умолчанию, по подкаталогу на комнату
+HISTORY_ROOT = os.path.join(os.path.expanduser('~'), '.chim', 'history')
+
+
+def encode_record(message):
+    payload = message.payload
+    flags = RECORD_OWN if message.is_own else 0
+    return RECORD.pack(len(payload), flags, message.sender_id, message.seq,
+                       message.timestamp) + payload
+
+
+def decode_records(data, first_number):
+    """Разбор подряд идущих записей в сообщения с номерами от first_number"""
+    messages = []
+    offset = 0
+    view = memoryview(data)
+    while offset + RECORD.size <= len(data):
+        length, flags, sender_id, seq, timestamp = RECORD.unpack_from(data, offset)
+        start = offset + RECORD.size
+        payload = bytes(view[start:start + length])
+        message = ChatMessage.from_payload(
+            payload, bool(flags & RECORD_OWN), timestamp, sender_id, seq)
+        message.number = first_number + len(messages)
+        messages.append(message)
+        offset = start + length
+    return messages
+
+
+class Segment:
+    def __init__(self, directory, base, capacity):
+        self.base = base
+        name = f"{base:020d}"
+        self.log_path = os.path.join(directory, name + '.log')
+        self.index_path = os.path.join(directory, name + '.idx')
+
+        if not os.path.exists(self.log_path):
+            open(self.log_path, 'wb').close()
+        with open(self.index_path, 'ab') as index_file:
+            if index_file.tell() < capacity * INDEX_ENTRY.size:
+                index_file.truncate(capacity * INDEX_ENTRY.size)
+        self.index_file = open(self.index_path, 'r+b')
+        self.index = mmap.mmap(self.index_file.fileno(), 0)
+        self.capacity = len(self.index) // INDEX_ENTRY.size
+
+        self.count = self._count_entries()
+        self.size = self.end_of(self.count - 1) if self.count else 0
+        self.log = None
+
+    def _count_entries(self):
+        # Индекс заполнен возрастающими смещениями, за ними нули
+        low, high = 0, self.capacity
+        while low < high:
+            middle = (low + high) // 2
+            if INDEX_ENTRY.unpack_from(self.index, middle * INDEX_ENTRY.size)[0]:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def end_of(self, position):
+        return INDEX_ENTRY.unpack_from(self.index, position * INDEX_ENTRY.size)[0]
+
+    def start_of(self, position):
+        return self.end_of(position - 1) if position else 0
+
+    def recover(self):
+        """Сверка журнала с индексом после аварийного завершения"""
+        log_size = os.path.getsize(self.log_path)
+        while self.count and self.end_of(self.count - 1) > log_size:
+            self.count -= 1
+            INDEX_ENTRY.pack_into(self.index, self.count * INDEX_ENTRY.size, 0)
+        self.size = self.end_of(self.count - 1) if self.count else 0
+
+        # Записи, попавшие в журнал, но не в индекс
+        with open(self.log_path, 'rb') as log:
+            log.seek(self.size)
+            tail = log.read()
+        offset = 0
+        while offset + RECORD.size <= len(tail) and self.count < self.capacity:
+            length = RECORD.unpack_from(tail, offset)[0]
+            if offset + RECORD.size + length > len(tail):
+                break
+            offset += RECORD.size + length
+            INDEX_ENTRY.pack_into(self.index, self.count * INDEX_ENTRY.size, self.size + offset)
+            self.count += 1
+        self.size += offset
+        if self.size < log_size:
+            with open(self.log_path, 'r+b') as log:
+                log.truncate(self.size)
+
+    def open_for_append(self):
+        if self.log is None:
+            self.log = open(self.log_path, 'ab')
+
+    def read(self, first, last):
+        """Сырые байты записей first..last-1 (номера внутри сегмента)"""
+        start = self.start_of(first)
+        end = self.start_of(last)
+        with open(self.log_path, 'rb') as log:
+            log.seek(start)
+            return log.read(end - start)
+
+    def read_spans(self, spans):
+        """Как read() для нескольких (first, last) при одном открытии журнала"""
+        chunks = []
+        with open(self.log_path, 'rb') as log:
+            for first, last in spans:
+                start = self.start_of(first)
+                log.seek(start)
+                chunks.append(log.read(self.start_of(last) - start))
+        return chunks
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+        self.index.close()
+        self.index_file.close()
+
+    def remove(self):
+        self.close()
+        for path in (self.log_path, self.index_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class HistoryStore:
+    """История комнаты на диске
+
+    append() только ставит сообщение в очередь фонового писателя и не
+    блокирует интерфейс; read() и tail() читают уже записанные сообщения.
+    Записи нумеруются глобально: номера от first() до end() - 1.
+
+    Ошибка записи (нет места, EIO) сохраняется в error: писатель
+    отбрасывает остаток очереди, но продолжает отмечать её записанной,
+    чтобы flush() не ждал вечно, а append() и flush() поднимают ошибку.
+    Недописанный хвост журнала отрезается при следующем открытии.
+    """
+
+    def __init__(self, directory, segment_bytes=8 * 1024 * 1024, index_capacity=65536,
+                 max_bytes=256 * 1024 * 1024, fsync=FSYNC_INTERVAL, fsync_interval=1.0,
+                 batch_size=1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_capacity = index_capacity
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        bases = sorted(int(name[:-4]) for name in os.listdir(directory)
+                       if name.endswith('.log') and name[:-4].isdigit())
+        self.segments = [Segment(directory, base, index_capacity) for base in bases]
+        if self.segments:
+            self.segments[-1].recover()
+        else:
+            self.segments.append(Segment(directory, 0, index_capacity))
+        self.segments[-1].open_for_append()
+
+        last = self.segments[-1]
+        self.next_number = last.base + last.count
+        self.queue = queue.Queue()
+        self.flushed = threading.Condition(self.lock)
+        self.written = 0
+        self.submitted = 0
+        self.error = None
+        self.writer = threading.Thread(target=self._write_loop, name='history-writer', daemon=True)
+        self.writer.start()
+
+    def first(self):
+        with self.lock:
+            return self.segments[0].base
+
+    def end(self):
+        with self.lock:
+            last = self.segments[-1]
+            return last.base + last.count
+
+    def disk_usage(self):
+        with self.lock:
+            return sum(segment.size for segment in self.segments)
+
+    def append(self, message):
+        """Постановка в очередь записи; возвращает будущий номер записи"""
+        self.check()
+        # Писатель пишет строго в порядке очереди, поэтому номер известен сразу
+        number = self.next_number
+        self.next_number += 1
+        message.number = number
+        self.submitted += 1
+        self.queue.put(message)
+        return number
+
+    def tail(self, limit):
+        end = self.end()
+        return self.read(max(self.first(), end - limit), end)
+
+    def read(self, start, stop):
+        """Сообщения с номерами start..stop-1, уже попавшие на диск"""
+        with self.lock:
+            segments = list(self.segments)
+        messages = []
+        for segment in segments:
+            first = max(start, segment.base) - segment.base
+            last = min(stop, segment.base + segment.count) - segment.base
+            if first >= last:
+                continue
+            try:
+                messages.extend(decode_records(segment.read(first, last), segment.base + first))
+            except (OSError, ValueError):
+                # Сегмент удалён ротацией во время чтения
+                continue
+        return messages
+
+    def read_ranges(self, ranges):
+        """Сообщения нескольких диапазонов (start, stop) разом
+
+        Журнал каждого сегмента открывается один раз на все диапазоны.
+        Сообщения идут в порядке диапазонов; номер - в message.number.
+        """
+        with self.lock:
+            segments = list(self.segments)
+        messages = []
+        for segment in segments:
+            spans = []
+            for start, stop in ranges:
+                first = max(start, segment.base) - segment.base
+                last = min(stop, segment.base + segment.count) - segment.base
+                if first < last:
+                    spans.append((first, last))
+            if not spans:
+                continue
+            try:
+                chunks = segment.read_spans(spans)
+            except (OSError, ValueError):
+                # Сегмент удалён ротацией во время чтения
+                continue
+            for (first, _), data in zip(spans, chunks):
+                messages.extend(decode_records(data, segment.base + first))
+        return messages
+
+    def flush(self, timeout=None):
+        """Ожидание записи всех поставленных в очередь сообщений; False - не дождались"""
+        target = self.submitted
+        with self.flushed:
+            done = self.flushed.wait_for(lambda: self.written >= target, timeout)
+        self.check()
+        return done
+
+    def check(self):
+        if self.error is not None:
+            raise Exception(f"История не записывается: {str(self.error)}")
+
+    def close(self):
+        self.queue.put(None)
+        self.writer.join()
+        with self.lock:
+            for segment in self.segments:
+                segment.close()
+
+    def _write_loop(self):
+        dirty = False
+        last_sync = time.monotonic()
+        while True:
+            timeout = self.fsync_interval if dirty and self.fsync == FSYNC_INTERVAL else None
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                try:
+                    self._sync()
+                except Exception as e:
+                    self.error = e
+                dirty = False
+                last_sync = time.monotonic()
+                continue
+
+            batch = []
+            stop = item is None
+            if not stop:
+                batch.append(item)
+            while not stop and len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                else:
+                    batch.append(item)
+
+            try:
+                if batch and self.error is None:
+                    self._write_batch(batch)
+                    dirty = True
+                if self.fsync == FSYNC_ALWAYS or stop or (
+                        dirty and self.fsync == FSYNC_INTERVAL and
+                        time.monotonic() - last_sync >= self.fsync_interval):
+                    if self.fsync != FSYNC_NEVER and self.error is None:
+                        self._sync()
+                    dirty = False
+                    last_sync = time.monotonic()
+            except Exception as e:
+                # Номера в очереди уже выданы, поэтому после сбоя не пишется
+                # ничего: иначе записи на диске разошлись бы с номерами
+                self.error = e
+                dirty = False
+            with self.flushed:
+                self.written += len(batch)
+                self.flushed.notify_all()
+            if stop:
+                return
+
+    def _write_batch(self, batch):
+        records = [encode_record(message) for message in batch]
+        position = 0
+        while position < len(records):
+            segment = self.segments[-1]
+            if segment.count and (segment.count >= segment.capacity or
+                                  segment.size + len(records[position]) > self.segment_bytes):
+                segment = self._rotate()
+
+            # Сколько записей помещается в текущий сегмент
+            chunk_end = position
+            size = segment.size
+            count = segment.count
+            while chunk_end < len(records) and count < segment.capacity and (
+                    count == segment.count or size + len(records[chunk_end]) <= self.segment_bytes):
+                size += len(records[chunk_end])
+                count += 1
+                chunk_end += 1
+
+            chunk = records[position:chunk_end]
+            segment.log.write(b''.join(chunk))
+            segment.log.flush()
+
+            # Индекс обновляется после записи журнала, чтобы читатели
+            # никогда не видели смещение на ещё не записанные данные
+            end = segment.size
+            for offset, record in enumerate(chunk, segment.count):
+                end += len(record)
+                INDEX_ENTRY.pack_into(segment.index, offset * INDEX_ENTRY.size, end)
+            with self.lock:
+                segment.count += len(chunk)
+                segment.size = end
+            position = chunk_end
+
+    def _rotate(self):
+        self._sync()
+        old = self.segments[-1]
+        segment = Segment(self.directory, old.base + old.count, self.index_capacity)
+        segment.open_for_append()
+        with self.lock:
+            old.log.close()
+            old.log = None
+            self.segments.append(segment)
+            removed = []
+            total = sum(s.size for s in self.segments)
+            while total > self.max_bytes and len(self.segments) > 1:
+                oldest = self.segments.pop(0)
+                total -= oldest.size
+                removed.append(oldest)
+        for oldest in removed:
+            oldest.remove()
+        return segment
+
+    def _sync(self):
+        segment = self.segments[-1]
+        if segment.log is not None:
+            segment.log.flush()
+            os.fsync(segment.log.fileno())
+        segment.index.flush()
@@ -0,0 +1,560 @@
+"""Узел хоста: один multicast-сокет на все клиенты машины
+
+На терминальном сервере каждый клиент со своим сокетом заставляет ядро
+копировать каждую датаграмму в каждый сокет, а клиенты - разбирать её
+заново. В режиме узла первый клиент хоста владеет подпиской на группы и
+единственным MulticastMessenger, а следующие подключаются к нему по
+Unix-сокету. Узел один раз принимает, проверяет номера, собирает и
+распаковывает кадр и рассылает уже разобранные кадры тем клиентам,
+которые подписаны на их канал.
+
+Клиент узла остаётся отдельным отправителем: у него свой идентификатор,
+свои номера кадров и кольцо повторов, поэтому для остальной сети он не
+отличается от клиента со своим сокетом. Датаграммы клиент собирает сам
+и передаёт узлу на отправку, а узел пересылает ему NACK на его кадры.
+
+Когда узел завершается, клиенты видят закрытие соединения и снова
+занимают адрес узла. bind на адрес атомарен, поэтому узлом становится
+ровно один из них, а остальные подключаются к нему. Кадры, пришедшие в
+сеть за время смены узла, не восстанавливаются: новый узел начинает
+учёт номеров заново, как перезапущенный клиент.
+"""
+import os
+import random
+import select
+import socket
+import struct
+import sys
+import tempfile
+import time
+
+from modules.channels import DEFAULT_CHANNEL, DEFAULT_GROUP
+from modules.metrics import REGISTRY
+from modules.clock import HybridClock
+from modules.network import PRIORITY_OF, Channel, MulticastMessenger, encode_datagrams
+from modules.protocol import (MSG_CHAT, MSG_PRESENCE, ProtocolError, encode_chat, encode_frame,
+                              new_sender_id)
+from modules.reliability import NACK_HEADER, Reliability
+from modules.scheduler import DEFAULT_SEND_RATE, PRIORITY_BULK, PRIORITY_CONTROL
+from modules.sync import Connection
+from modules.worker import (CMD_HELLO, CMD_SUBSCRIBE, CMD_UNSUBSCRIBE, REPLY_ERROR, REPLY_OK, SEQ,
+                            connect_control, decode_frame_record, decode_name, encode_frame_record,
+                            encode_name)
+
+# Команда клиента: датаграмма на отправку
+CMD_DATAGRAM = 7
+# Сообщения узла клиенту
+HUB_FRAME = 21
+HUB_NACK = 22
+HUB_STATE = 23
+
+# Приоритет и группа датаграммы, переданной узлу
+DATAGRAM = struct.Struct('!B4s')
+BACKLOG = 64
+
+
+def hub_address(port=5007):
+    """Адрес узла хоста для порта
+
+    В Linux - абстрактное имя: оно общее для всех пользователей машины и
+    освобождается вместе с сокетом, даже если процесс узла убит.
+    """
+    if sys.platform.startswith('linux'):
+        return f'\0chim-hub-{port}'
+    return os.path.join(tempfile.gettempdir(), f'chim-hub-{port}.sock')
+
+
+def bind_hub(address):
+    """Слушающий сокет узла или None, если адрес занят"""
+    if not address.startswith('\0') and os.path.exists(address):
+        probe = connect_control(address)
+        if probe is not None:
+            probe.close()
+            return None
+        # Файл остался от узла, который не успел его удалить
+        try:
+            os.unlink(address)
+        except OSError:
+            pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(address)
+    except OSError:
+        sock.close()
+        return None
+    if not address.startswith('\0'):
+        os.chmod(address, 0o666)
+    sock.listen(BACKLOG)
+    sock.setblocking(False)
+    return sock
+
+
+class HubClient:
+    """Клиент на стороне узла: его отправитель и каналы"""
+
+    def __init__(self):
+        self.sender_id = None
+        self.channels = set()
+
+
+class HubMessenger:
+    """Заместитель MulticastMessenger, который делит сокет с клиентами хоста
+
+    Роль выбирается при создании и после ухода узла: узел, если адрес
+    address свободен, иначе клиент узла. Интерфейс и on_frame(frame) те
+    же, что у MulticastMessenger; у клиента узла frame.payload - bytes.
+    """
+
+    REPLY_TIMEOUT = 5.0
+    ATTACH_ATTEMPTS = 20
+    ATTACH_RETRY = 0.01
+    # Разброс момента смены узла, чтобы клиенты не ломились одновременно
+    TAKEOVER_DELAY = (0.0, 0.05)
+    REATTACH_INTERVAL = 1.0
+    # Непрочитанного клиентом сверх этого кадры ему не шлются
+    CLIENT_BACKLOG = 4 * 1024 * 1024
+    CONGESTION_CHECK = 0.005
+
+    def __init__(self, workstation_id, loop, on_frame, multicast_group=DEFAULT_GROUP, port=5007,
+                 compression=True, metrics=None, channel=DEFAULT_CHANNEL, limiter=None,
+                 send_rate=DEFAULT_SEND_RATE, address=None):
+        self.workstation_id = workstation_id
+        self.loop = loop
+        self.on_frame = on_frame
+        self.port = port
+        self.compression = compression
+        self.limiter = limiter
+        self.send_rate = send_rate
+        self.address = hub_address(port) if address is None else address
+        self.sender_id = new_sender_id()
+        # Часы меток общие с MulticastMessenger узла, пока процесс - узел
+        self.clock = HybridClock()
+        self.running = True
+        # Свои каналы: номера кадров и кольцо повторов при любой роли
+        self.channels = {}
+        self.default_channel = channel
+        # Перегружена очередь массовой отправки узла
+        self.congestion = False
+        # Роль узла
+        self.listener = None
+        self.messenger = None
+        self.clients = {}
+        self.flush_pending = set()
+        self.congestion_timer = None
+        # Роль клиента
+        self.connection = None
+        self.replies = []
+        self.waiting = False
+        self.deferred = []
+        self.setup_metrics(REGISTRY if metrics is None else metrics)
+
+        self.add_channel(channel, multicast_group)
+        try:
+            self.attach()
+        except Exception:
+            self.running = False
+            raise
+
+    def setup_metrics(self, metrics):
+        self.metrics = metrics
+        self.takeovers = metrics.counter('chim_hub_takeovers_total', "Клиент узла стал узлом после ухода прежнего")
+        self.forwarded = metrics.counter('chim_hub_frames_forwarded_total', "Кадры, разосланные клиентам узла")
+        self.handler_errors = metrics.counter(
+            'chim_handler_errors_total', "Исключения обработчика кадров, пропущенные без остановки приёма")
+        self.client_drops = metrics.counter(
+            'chim_hub_client_drops_total', "Кадры, не отправленные медленному клиенту узла")
+        self.detached_drops = metrics.counter(
+            'chim_hub_detached_drops_total', "Датаграммы, отброшенные во время смены узла")
+        metrics.gauge('chim_hub_role', "1 - процесс является узлом хоста, 0 - клиентом",
+                      lambda: int(self.listener is not None))
+        metrics.gauge('chim_hub_clients', "Клиенты, подключённые к узлу", lambda: len(self.clients))
+
+    def add_channel(self, name, group):
+        def resend(data):
+            self.send_datagram(data, group, PRIORITY_CONTROL)
+
+        # Только кольцо повторов: номера входящих кадров и NACK ведёт узел
+        channel = Channel(name, group, Reliability(self.sender_id, None, resend), None)
+        self.channels[name] = channel
+        return channel
+
+    def attach(self):
+        """Роль на хосте: узел, если адрес свободен, иначе клиент узла"""
+        for _ in range(self.ATTACH_ATTEMPTS):
+            listener = bind_hub(self.address)
+            if listener is not None:
+                self.become_hub(listener)
+                return
+            sock = connect_control(self.address)
+            if sock is not None:
+                self.join_hub(sock)
+                return
+            # Узел занял адрес, но ещё не слушает, или только что завершился
+            time.sleep(self.ATTACH_RETRY)
+        raise Exception("Узел хоста не отвечает")
+
+    def reattach(self):
+        """Смена узла: занять освободившийся адрес или подключиться к новому узлу"""
+        if not self.running or self.connection is not None or self.listener is not None:
+            return
+        try:
+            self.attach()
+        except Exception:
+            self.loop.call_later(self.REATTACH_INTERVAL, self.reattach)
+            return
+        if self.listener is not None:
+            self.takeovers.inc()
+
+    # Роль узла
+
+    def become_hub(self, listener):
+        default = self.channels[self.default_channel]
+        try:
+            messenger = MulticastMessenger(self.workstation_id, self.loop, self.on_hub_frame,
+                                           default.group, self.port, self.compression, self.metrics,
+                                           default.name, self.limiter, self.send_rate,
+                                           on_nack=self.on_nack)
+        except Exception:
+            listener.close()
+            raise
+        messenger.clock = self.clock
+        self.messenger = messenger
+        self.listener = listener
+        for channel in list(self.channels.values()):
+            try:
+                self.hub_subscribe(channel.name, channel.group)
+            except Exception:
+                pass
+        self.loop.add_reader(listener.fileno(), self.on_accept)
+
+    def hub_subscribe(self, name, group):
+        channel = self.messenger.subscribe(name, group)
+        if channel.group != group:
+            raise Exception(f"Канал {name} на этом хосте уже связан с группой {channel.group}")
+
+    def release(self, name):
+        """Отписка узла от канала, который больше не нужен никому на хосте"""
+        if name in self.channels or any(name in client.channels for client in self.clients.values()):
+            return
+        if name in self.messenger.channels and len(self.messenger.channels) > 1:
+            self.messenger.unsubscribe(name)
+
+    def on_accept(self):
+        try:
+            sock, _ = self.listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        sock.setblocking(False)
+        connection = Connection(self.loop, sock, self.on_command, self.on_client_closed, None)
+        self.clients[connection] = HubClient()
+
+    def on_client_closed(self, connection):
+        client = self.clients.pop(connection, None)
+        self.flush_pending.discard(connection)
+        if client is not None and self.running:
+            for name in client.channels:
+                self.release(name)
+
+    def on_command(self, connection, kind, body):
+        client = self.clients.get(connection)
+        if client is None:
+            return
+        try:
+            if kind == CMD_DATAGRAM:
+                priority, group = DATAGRAM.unpack_from(body)
+                self.messenger.send_datagram(body[DATAGRAM.size:], socket.inet_ntoa(group), priority)
+                if priority == PRIORITY_BULK:
+                    self.check_congestion()
+            elif kind == CMD_HELLO:
+                client.sender_id = SEQ.unpack_from(body)[0]
+                connection.send(HUB_STATE, bytes((self.congestion,)))
+            elif kind == CMD_SUBSCRIBE:
+                name, end = decode_name(body)
+                group, _ = decode_name(body, end)
+                self.hub_subscribe(name, group)
+                client.channels.add(name)
+                connection.send(REPLY_OK)
+            elif kind == CMD_UNSUBSCRIBE:
+                name, _ = decode_name(body)
+                client.channels.discard(name)
+                self.release(name)
+        except Exception as e:
+            if kind == CMD_SUBSCRIBE:
+                connection.send(REPLY_ERROR, str(e).encode('utf-8'))
+
+    def on_hub_frame(self, frame):
+        """Кадр из сети: клиентам, подписанным на канал, кроме отправителя, и себе"""
+        record = None
+        for connection, client in list(self.clients.items()):
+            if frame.channel not in client.channels or frame.sender == client.sender_id:
+                continue
+            if connection.backlog() > self.CLIENT_BACKLOG:
+                self.client_drops.inc()
+                continue
+            if record is None:
+                record = encode_frame_record(frame)
+            # Запись в сокет - одна на клиента за пачку датаграмм
+            connection.send(HUB_FRAME, record, flush=False)
+            if not self.flush_pending:
+                self.loop.call_later(0, self.flush_clients)
+            self.flush_pending.add(connection)
+            self.forwarded.inc()
+        if frame.sender != self.sender_id and frame.channel in self.channels:
+            self.on_frame(frame)
+
+    def flush_clients(self):
+        connections, self.flush_pending = self.flush_pending, set()
+        for connection in connections:
+            connection.on_writable()
+
+    def on_nack(self, channel, payload):
+        """NACK на свои кадры или кадры клиента: повтор - из кольца отправителя"""
+        if len(payload) < NACK_HEADER.size:
+            return
+        target = NACK_HEADER.unpack_from(payload)[0]
+        if target == self.sender_id:
+            own = self.channels.get(channel)
+            if own is not None:
+                own.reliability.on_nack(payload)
+            return
+        for connection, client in list(self.clients.items()):
+            if client.sender_id == target:
+                connection.send(HUB_NACK, encode_name(channel) + bytes(payload))
+                return
+
+    def check_congestion(self):
+        """Состояние очереди массовой отправки для congested() клиентов"""
+        congested = self.messenger.congested(PRIORITY_BULK)
+        if congested != self.congestion:
+            self.congestion = congested
+            for connection in list(self.clients):
+                connection.send(HUB_STATE, bytes((congested,)))
+        if congested and self.congestion_timer is None:
+            self.congestion_timer = self.loop.call_later(self.CONGESTION_CHECK, self.on_congestion_timer)
+
+    def on_congestion_timer(self):
+        self.congestion_timer = None
+        if self.running:
+            self.check_congestion()
+
+    # Роль клиента
+
+    def join_hub(self, sock):
+        sock.setblocking(False)
+        connection = self.connection = Connection(self.loop, sock, self.on_hub_message,
+                                                  self.on_hub_closed, None)
+        self.congestion = False
+        try:
+            connection.send(CMD_HELLO, SEQ.pack(self.sender_id) + self.workstation_id.encode('utf-8'))
+            for channel in list(self.channels.values()):
+                reply, body = self.call(CMD_SUBSCRIBE, encode_name(channel.name) + encode_name(channel.group))
+                # Конфликт группы у дополнительного канала не мешает остальным
+                if reply == REPLY_ERROR and channel.name == self.default_channel:
+                    raise Exception(str(body, 'utf-8', 'replace'))
+        except Exception:
+            self.connection = None
+            connection.close()
+            raise
+
+    def call(self, kind, body):
+        """Команда узлу и ожидание ответа: (вид ответа, тело)
+
+        Кадры, пришедшие до ответа, доставляются после возврата в цикл.
+        """
+        connection = self.connection
+        connection.send(kind, body)
+        deadline = time.monotonic() + self.REPLY_TIMEOUT
+        self.waiting = True
+        try:
+            while not self.replies:
+                remaining = deadline - time.monotonic()
+                if connection.closed or remaining <= 0:
+                    raise Exception("Узел хоста не отвечает")
+                writers = (connection.sock,) if connection.backlog() else ()
+                readable, writable, _ = select.select((connection.sock,), writers, (), remaining)
+                if writable:
+                    connection.on_writable()
+                if readable:
+                    connection.on_readable()
+        finally:
+            self.waiting = False
+            if self.deferred:
+                self.loop.call_later(0, self.deliver_deferred)
+        return self.replies.pop(0)
+
+    def check(self, kind, body):
+        reply, body = self.call(kind, body)
+        if reply == REPLY_ERROR:
+            raise Exception(str(body, 'utf-8', 'replace'))
+
+    def on_hub_message(self, connection, kind, body):
+        if kind == HUB_FRAME:
+            try:
+                frame = decode_frame_record(body)
+            except (ProtocolError, struct.error):
+                return
+            # Метку уже проверил узел; свои часы должны её учесть
+            self.clock.update(frame.timestamp)
+            if self.waiting or self.deferred:
+                self.deferred.append(frame)
+            elif frame.channel in self.channels:
+                self.deliver(frame)
+        elif kind == HUB_NACK:
+            try:
+                name, end = decode_name(body)
+                channel = self.channels.get(name)
+                if channel is not None:
+                    channel.reliability.on_nack(body[end:])
+            except ProtocolError:
+                pass
+        elif kind == HUB_STATE:
+            self.congestion = body[:1] == b'\x01'
+        elif kind in (REPLY_OK, REPLY_ERROR):
+            self.replies.append((kind, body))
+
+    def deliver_deferred(self):
+        frames, self.deferred = self.deferred, []
+        for frame in frames:
+            if self.running and frame.channel in self.channels:
+                self.deliver(frame)
+
+    def deliver(self, frame):
+        """Кадр от узла в on_frame; ошибка обработчика не рвёт поток узла"""
+        try:
+            self.on_frame(frame)
+        except Exception:
+            self.handler_errors.inc()
+
+    def on_hub_closed(self, connection):
+        if connection is not self.connection:
+            return
+        self.connection = None
+        self.replies.clear()
+        if self.running:
+            self.loop.call_later(random.uniform(*self.TAKEOVER_DELAY), self.reattach)
+
+    # Интерфейс MulticastMessenger
+
+    @property
+    def multicast_group(self):
+        return self.channels[self.default_channel].group
+
+    def channel(self, name=None):
+        channel = self.channels.get(self.default_channel if name is None else name)
+        if channel is None:
+            raise Exception(f"Нет подписки на канал {name}")
+        return channel
+
+    def subscribe(self, name, group):
+        """Подписка на канал; повторная подписка возвращает тот же канал"""
+        channel = self.channels.get(name)
+        if channel is not None:
+            return channel
+        address = socket.inet_aton(group)
+        for other in self.channels.values():
+            if other.address == address:
+                raise Exception(f"Группа {group} уже занята каналом {other.name}")
+        if self.messenger is not None:
+            self.hub_subscribe(name, group)
+        elif self.connection is not None:
+            self.check(CMD_SUBSCRIBE, encode_name(name) + encode_name(group))
+        # Без узла подписка передаётся новому узлу при подключении к нему
+        return self.add_channel(name, group)
+
+    def unsubscribe(self, name):
+        """Отписка от канала; последний канал оставить нельзя"""
+        if name not in self.channels:
+            return
+        if len(self.channels) == 1:
+            raise Exception("Нельзя покинуть единственный канал")
+        del self.channels[name]
+        if name == self.default_channel:
+            self.default_channel = next(iter(self.channels))
+        if self.messenger is not None:
+            self.release(name)
+        elif self.connection is not None:
+            self.connection.send(CMD_UNSUBSCRIBE, encode_name(name))
+
+    def send_message(self, message, channel=None, timestamp=None):
+        """Отправка текста в канал; возвращает порядковый номер кадра"""
+        try:
+            return self.send_frame(MSG_CHAT, encode_chat(self.workstation_id, message), channel, timestamp)
+        except Exception as e:
+            raise Exception(f"Ошибка отправки сообщения: {str(e)}")
+
+    def send_frame(self, msg_type, payload, channel=None, timestamp=None):
+        """Отправка кадра, при необходимости разбитого на фрагменты"""
+        channel = self.channel(channel)
+        priority = PRIORITY_OF.get(msg_type, PRIORITY_CONTROL)
+        first_seq = channel.seq + 1
+        if timestamp is None:
+            timestamp = self.clock.now()
+        datagrams = encode_datagrams(self.sender_id, first_seq, msg_type, payload, timestamp,
+                                     self.compression)
+        if self.messenger is not None and self.messenger.scheduler.free(priority) < len(datagrams):
+            self.messenger.scheduler.rejected.inc(len(datagrams))
+            raise Exception("Очередь отправки переполнена")
+        channel.seq += len(datagrams)
+        for index, data in enumerate(datagrams):
+            channel.reliability.sent(first_seq + index, data)
+            self.send_datagram(data, channel.group, priority)
+        return first_seq
+
+    def send_unsequenced(self, msg_type, payload, channel=None):
+        """Одна датаграмма вне последовательности: без NACK и повторов"""
+        return self.send_datagram(encode_frame(msg_type, self.sender_id, 0, self.clock.now(), payload),
+                                  self.channel(channel).group, PRIORITY_OF.get(msg_type, PRIORITY_CONTROL))
+
+    def send_presence(self, payload, channel=None):
+        self.send_unsequenced(MSG_PRESENCE, payload, channel)
+
+    def send_datagram(self, data, group=None, priority=PRIORITY_CONTROL):
+        group = self.multicast_group if group is None else group
+        if self.messenger is not None:
+            sent = self.messenger.send_datagram(data, group, priority)
+            if priority == PRIORITY_BULK:
+                self.check_congestion()
+            return sent
+        if self.connection is None:
+            # Пропуск в номерах получатели запросят NACK уже у нового узла
+            self.detached_drops.inc()
+            return False
+        self.connection.send(CMD_DATAGRAM, DATAGRAM.pack(priority, socket.inet_aton(group)) + data)
+        return True
+
+    def congested(self, priority=PRIORITY_BULK):
+        """Очередь приоритета перегружена: массовой отправке стоит подождать"""
+        if self.messenger is not None:
+            return self.messenger.congested(priority)
+        connection = self.connection
+        return connection is None or self.congestion or connection.backlog() > self.CLIENT_BACKLOG
+
+    def pending(self):
+        """Датаграммы узла или байты клиента, ещё не переданные дальше"""
+        if self.messenger is not None:
+            return self.messenger.pending()
+        return self.connection.backlog() if self.connection is not None else 0
+
+    def close(self):
+        """Выход; клиенты узла сами выбирают новый узел"""
+        self.running = False
+        if self.congestion_timer is not None:
+            self.congestion_timer.cancel()
+            self.congestion_timer = None
+        if self.listener is not None:
+            # Адрес освобождается первым: клиенты, увидевшие закрытие, сразу его займут
+            self.loop.remove_reader(self.listener.fileno())
+            self.listener.close()
+            self.listener = None
+            if not self.address.startswith('\0'):
+                try:
+                    os.unlink(self.address)
+                except OSError:
+                    pass
+            for connection in list(self.clients):
+                connection.close()
+            self.clients.clear()
+            self.messenger.close()
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            connection.finish()
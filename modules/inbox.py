@@ -0,0 +1,49 @@
+"""Очередь входящих сообщений между сетевым потоком и интерфейсом
+
+Сетевой поток кладёт сообщения в deque без блокировок (append и
+popleft атомарны), а интерфейс забирает их пачками раз в кадр. Сигнал
+пробуждения нужен только при переходе очереди из пустого состояния,
+поэтому поток сообщений не порождает поток межпоточных вызовов.
+
+Очередь может быть ограничена: при переполнении элемент низкого
+приоритета отбрасывается сам, а обычный вытесняет самый старый.
+Отброшенные считаются в dropped.
+"""
+from collections import deque
+
+
+class Inbox:
+    def __init__(self, capacity=None):
+        self.items = deque()
+        self.capacity = capacity
+        self.wakeup_pending = False
+        self.dropped = 0
+
+    def put(self, item, low_priority=False):
+        """Добавление из сетевого потока; True, если нужно разбудить интерфейс"""
+        if self.capacity is not None and len(self.items) >= self.capacity:
+            self.dropped += 1
+            if low_priority:
+                return False
+            self.items.popleft()
+        self.items.append(item)
+        if self.wakeup_pending:
+            return False
+        self.wakeup_pending = True
+        return True
+
+    def drain(self, budget):
+        """Извлечение не более budget элементов в порядке поступления"""
+        # Сбрасываем флаг до извлечения: элемент, пришедший во время
+        # разбора, либо попадёт в эту пачку, либо вызовет новое пробуждение
+        self.wakeup_pending = False
+        items = self.items
+        batch = []
+        while items and len(batch) < budget:
+            batch.append(items.popleft())
+        if items:
+            self.wakeup_pending = True
+        return batch
+
+    def __len__(self):
+        return len(self.items)
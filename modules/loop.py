@@ -0,0 +1,159 @@
+"""Однопоточный цикл событий на selectors для работы без Qt
+
+Интерфейс совпадает с мостом к циклу Qt (QtLoop в gui.py), поэтому
+сетевое ядро одинаково работает и в окне чата, и в консольных утилитах:
+
+    add_reader(fd, callback)    вызывать callback(), когда fd готов к чтению
+    remove_reader(fd)
+    add_writer(fd, callback)    вызывать callback(), когда fd готов к записи
+    remove_writer(fd)
+    call_later(delay, callback) однократный таймер; возвращает объект с cancel()
+"""
+import heapq
+import itertools
+import selectors
+import socket
+import time
+from collections import deque
+
+
+class TimerHandle:
+    __slots__ = ('when', 'callback', 'cancelled')
+
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class SelectorLoop:
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.selector = selectors.DefaultSelector()
+        # fd -> [обработчик чтения, обработчик записи]
+        self.handlers = {}
+        self.timers = []
+        self.counter = itertools.count()
+        self.ready = deque()
+        self.running = False
+
+        # Пара сокетов будит цикл из других потоков без опроса
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.add_reader(self.wakeup_recv.fileno(), self._drain_wakeup)
+
+    def add_reader(self, fd, callback):
+        self._set_handler(fd, 0, callback)
+
+    def remove_reader(self, fd):
+        self._set_handler(fd, 0, None)
+
+    def add_writer(self, fd, callback):
+        self._set_handler(fd, 1, callback)
+
+    def remove_writer(self, fd):
+        self._set_handler(fd, 1, None)
+
+    def _set_handler(self, fd, slot, callback):
+        handlers = self.handlers.get(fd)
+        if handlers is None:
+            if callback is None:
+                return
+            handlers = self.handlers[fd] = [None, None]
+            handlers[slot] = callback
+            self.selector.register(fd, self._events(handlers), handlers)
+            return
+        handlers[slot] = callback
+        events = self._events(handlers)
+        try:
+            if events:
+                self.selector.modify(fd, events, handlers)
+            else:
+                del self.handlers[fd]
+                self.selector.unregister(fd)
+        except (KeyError, ValueError):
+            self.handlers.pop(fd, None)
+
+    @staticmethod
+    def _events(handlers):
+        events = 0
+        if handlers[0] is not None:
+            events |= selectors.EVENT_READ
+        if handlers[1] is not None:
+            events |= selectors.EVENT_WRITE
+        return events
+
+    def call_later(self, delay, callback):
+        handle = TimerHandle(self.clock() + max(0.0, delay), callback)
+        heapq.heappush(self.timers, (handle.when, next(self.counter), handle))
+        return handle
+
+    def call_soon_threadsafe(self, callback):
+        """Выполнение callback в потоке цикла; можно вызывать из любого потока"""
+        self.ready.append(callback)
+        self._wakeup()
+
+    def stop(self):
+        self.running = False
+        self._wakeup()
+
+    def run(self):
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def run_once(self, max_timeout=None):
+        timeout = self._next_timeout()
+        if max_timeout is not None:
+            timeout = max_timeout if timeout is None else min(timeout, max_timeout)
+        for key, events in self.selector.select(timeout):
+            reader, writer = key.data
+            if events & selectors.EVENT_READ and reader is not None:
+                reader()
+            if events & selectors.EVENT_WRITE and key.data[1] is not None:
+                key.data[1]()
+        self._run_ready()
+        self._run_timers()
+
+    def close(self):
+        self.running = False
+        self.selector.close()
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
+
+    def _next_timeout(self):
+        if self.ready:
+            return 0
+        while self.timers and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)
+        if not self.timers:
+            return None
+        return max(0.0, self.timers[0][0] - self.clock())
+
+    def _run_ready(self):
+        for _ in range(len(self.ready)):
+            self.ready.popleft()()
+
+    def _run_timers(self):
+        now = self.clock()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, handle = heapq.heappop(self.timers)
+            if not handle.cancelled:
+                handle.callback()
+
+    def _wakeup(self):
+        try:
+            self.wakeup_send.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def _drain_wakeup(self):
+        try:
+            while self.wakeup_recv.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
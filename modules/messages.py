@@ -0,0 +1,81 @@
+"""Записи сообщений чата, общие для сети, истории и интерфейса"""
+from datetime import datetime
+
+from modules.clock import physical_ms
+from modules.protocol import chat_name_end, encode_chat
+
+KIND_CHAT = 0
+KIND_SYSTEM = 1
+
+
+class ChatMessage:
+    """Сообщение чата
+
+    Принятые из сети сообщения хранят сырую полезную нагрузку и
+    декодируют имя и текст только при первом обращении - например, когда
+    строка попадает на экран или в историю.
+    """
+    __slots__ = ('_sender', '_text', '_payload', 'is_own', 'timestamp', 'kind',
+                 'sender_id', 'seq', 'number', '_time_text')
+
+    def __init__(self, sender, text, is_own, timestamp, kind=KIND_CHAT, sender_id=0, seq=0):
+        self._sender = sender
+        self._text = text
+        self._payload = None
+        self.is_own = is_own
+        # Метка гибридных часов (modules/clock.py) или, у старых записей,
+        # миллисекунды от эпохи
+        self.timestamp = timestamp
+        self.kind = kind
+        # Идентификатор экземпляра отправителя и номер кадра
+        self.sender_id = sender_id
+        self.seq = seq
+        # Номер записи в истории или -1, если сообщение туда не попало
+        self.number = -1
+        self._time_text = None
+
+    @classmethod
+    def from_payload(cls, payload, is_own, timestamp, sender_id=0, seq=0):
+        """Сообщение из полезной нагрузки MSG_CHAT без её декодирования"""
+        chat_name_end(payload)
+        message = cls(None, None, is_own, timestamp, KIND_CHAT, sender_id, seq)
+        message._payload = payload
+        return message
+
+    def _decode(self):
+        payload = self._payload
+        name_end = 1 + payload[0]
+        self._sender = str(payload[1:name_end], 'utf-8', 'replace')
+        self._text = str(payload[name_end:], 'utf-8', 'replace')
+        # Имя и текст присваиваются раньше сброса нагрузки: свойство payload
+        # можно читать из потока записи истории без блокировок
+        self._payload = None
+
+    @property
+    def payload(self):
+        """Полезная нагрузка MSG_CHAT; для декодированных кодируется заново"""
+        payload = self._payload
+        if payload is None:
+            payload = encode_chat(self._sender, self._text)
+        return payload
+
+    @property
+    def sender(self):
+        if self._payload is not None:
+            self._decode()
+        return self._sender
+
+    @property
+    def text(self):
+        if self._payload is not None:
+            self._decode()
+        return self._text
+
+    @property
+    def time_text(self):
+        if self._time_text is None:
+            self._time_text = datetime.fromtimestamp(physical_ms(self.timestamp) / 1000).strftime('%H:%M')
+        return self._time_text
+
+    def __repr__(self):
+        return f"ChatMessage({self.sender!r}, {self.text!r}, own={self.is_own}, kind={self.kind})"
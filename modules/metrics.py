@@ -0,0 +1,222 @@
+"""Метрики работы сети и интерфейса
+
+Реестр хранит счётчики, мгновенные значения и гистограммы в памяти
+процесса. Счётчик - это одно целое в __slots__, его увеличение стоит
+столько же, сколько пустой вызов метода, поэтому счётчики работают
+всегда. Замеры времени требуют вызовов perf_counter, поэтому места,
+где они делаются, проверяют registry.enabled и без него ничего не
+измеряют.
+
+Снимок метрик доступен как словарь (snapshot), в формате Prometheus
+(text), в файле JSON (dump) и по HTTP на локальном адресе (serve).
+Включение из окружения:
+
+    CHIM_METRICS=1              замеры времени
+    CHIM_METRICS_FILE=path      запись снимка в файл при выходе
+    CHIM_METRICS_PORT=9477      HTTP на 127.0.0.1:9477/metrics
+"""
+import bisect
+import json
+import os
+import threading
+
+# Границы гистограмм времени: от 10 мкс до ~20 с, шаг x2
+TIME_BUCKETS = tuple(0.00001 * 2 ** power for power in range(22))
+
+
+class Counter:
+    __slots__ = ('name', 'help', 'value')
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    """Мгновенное значение: задаётся set() или вычисляется функцией при снимке"""
+    __slots__ = ('name', 'help', 'value', 'function')
+
+    def __init__(self, name, help='', function=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def read(self):
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception:
+                return None
+        return self.value
+
+
+class Histogram:
+    __slots__ = ('name', 'help', 'bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, name, help='', bounds=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = bounds
+        # Последняя ячейка - значения больше верхней границы
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction):
+        """Оценка квантиля по верхней границе ячейки"""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.bounds[index] if index < len(self.bounds) else float('inf')
+        return float('inf')
+
+
+class Registry:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.metrics = {}
+        self.server = None
+
+    def counter(self, name, help=''):
+        return self._get(name, Counter, help)
+
+    def histogram(self, name, help='', bounds=TIME_BUCKETS):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = Histogram(name, help, bounds)
+        return metric
+
+    def gauge(self, name, help='', function=None):
+        """Мгновенное значение; повторная регистрация заменяет функцию"""
+        metric = self._get(name, Gauge, help)
+        if function is not None:
+            metric.function = function
+        return metric
+
+    def _get(self, name, cls, help):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, help)
+        elif not isinstance(metric, cls):
+            raise Exception(f"Метрика {name} уже зарегистрирована другого типа")
+        return metric
+
+    def snapshot(self):
+        """Значения всех метрик; для гистограмм - число, сумма и квантили"""
+        values = {}
+        for name, metric in sorted(self.metrics.items()):
+            if isinstance(metric, Histogram):
+                values[name] = {
+                    'count': metric.count,
+                    'sum': metric.sum,
+                    'p50': metric.quantile(0.50),
+                    'p99': metric.quantile(0.99),
+                }
+            elif isinstance(metric, Gauge):
+                values[name] = metric.read()
+            else:
+                values[name] = metric.value
+        return values
+
+    def text(self):
+        """Снимок в текстовом формате Prometheus"""
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            if metric.help:
+                lines.append(f"# HELP {name} {metric.help}")
+            if isinstance(metric, Histogram):
+                lines.append(f"# TYPE {name} histogram")
+                cumulative = 0
+                for bound, count in zip(metric.bounds, metric.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{le="{bound:g}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{le="+Inf"}} {metric.count}')
+                lines.append(f"{name}_sum {metric.sum}")
+                lines.append(f"{name}_count {metric.count}")
+            elif isinstance(metric, Gauge):
+                value = metric.read()
+                lines.append(f"# TYPE {name} gauge")
+                if value is not None:
+                    lines.append(f"{name} {value}")
+            else:
+                lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name} {metric.value}")
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """Атомарная запись снимка в JSON"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as dump_file:
+            json.dump(self.snapshot(), dump_file, ensure_ascii=False, indent=2)
+        os.replace(temp_path, path)
+
+    def serve(self, port, host='127.0.0.1'):
+        """HTTP-эндпоинт /metrics в фоновом потоке; возвращает фактический порт"""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] == '/metrics':
+                    body = registry.text().encode('utf-8')
+                    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+                elif self.path.split('?')[0] == '/metrics.json':
+                    body = json.dumps(registry.snapshot(), ensure_ascii=False).encode('utf-8')
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='metrics-http', daemon=True).start()
+        return self.server.server_address[1]
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+REGISTRY = Registry(enabled=bool(os.environ.get('CHIM_METRICS')))
+
+
+def start_from_environment(registry=REGISTRY):
+    """Запуск эндпоинта по CHIM_METRICS_PORT; путь для снимка или None"""
+    port = os.environ.get('CHIM_METRICS_PORT')
+    if port and registry.server is None:
+        try:
+            registry.serve(int(port))
+        except (OSError, ValueError):
+            pass
+    return os.environ.get('CHIM_METRICS_FILE')
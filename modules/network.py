@@ -0,0 +1,477 @@
+"""Сетевое ядро чата без зависимости от Qt
+
+MulticastMessenger работает в любом цикле событий с интерфейсом
+modules/loop.py: в окне чата это мост к циклу Qt, в консольной утилите
+chim.py - SelectorLoop.
+
+Каналы (modules/channels.py) делят один сокет: подписка и отписка -
+IP_ADD_MEMBERSHIP и IP_DROP_MEMBERSHIP, а принятая датаграмма
+относится к каналу по адресу назначения из IP_PKTINFO. У каждого
+канала свои порядковые номера, учёт потерь и сборка фрагментов, поэтому
+подписчик одного канала не запрашивает кадры другого.
+
+Датаграммы отправляет поток SendScheduler (modules/scheduler.py) по
+приоритетам: служебные кадры и повторы, затем чат, затем файлы.
+"""
+import os
+import socket
+import struct
+import sys
+import time
+import zlib
+
+from modules.buffers import BufferPool
+from modules.channels import DEFAULT_CHANNEL, DEFAULT_GROUP
+from modules.clock import HybridClock
+from modules.compression import compress, decompress
+from modules.dedup import SeenFilter
+from modules.fragments import Reassembler, fragment
+from modules.metrics import REGISTRY
+from modules.protocol import (FLAG_COMPRESSED, FLAG_FRAGMENT, MSG_CHAT, MSG_FILE_DATA,
+                              MSG_FILE_OFFER, MSG_NACK, MSG_PRESENCE, RECV_BUFFER, ProtocolError,
+                              TruncatedFrame, decode_frame, encode_chat, encode_frame,
+                              new_sender_id, peek_sender)
+from modules.reliability import STAT_KEYS, Reliability
+from modules.scheduler import (DEFAULT_SEND_RATE, PRIORITY_BULK, PRIORITY_CHAT, PRIORITY_CONTROL,
+                               SendScheduler)
+
+# Константы Linux, которых нет в модуле socket старых версий Python
+IP_PKTINFO = getattr(socket, 'IP_PKTINFO', 8 if sys.platform.startswith('linux') else None)
+IP_MULTICAST_ALL = getattr(socket, 'IP_MULTICAST_ALL', 49 if sys.platform.startswith('linux') else None)
+# Адрес назначения в struct in_pktinfo: ifindex (4), spec_dst (4), addr (4)
+PKTINFO_ADDR = slice(8, 12)
+PKTINFO_SPACE = socket.CMSG_SPACE(12) if hasattr(socket, 'CMSG_SPACE') else 0
+CAN_DEMUX = IP_PKTINFO is not None and hasattr(socket.socket, 'recvmsg_into')
+
+# Приоритет отправки по типу кадра; остальные кадры вне последовательности - служебные
+PRIORITY_OF = {MSG_CHAT: PRIORITY_CHAT, MSG_FILE_OFFER: PRIORITY_BULK, MSG_FILE_DATA: PRIORITY_BULK}
+
+
+def get_local_ip():
+    """Получение локального IP-адреса компьютера"""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("8.8.8.8", 80))
+            return s.getsockname()[0]
+    except Exception:
+        return "unknown"
+
+
+def encode_datagrams(sender_id, first_seq, msg_type, payload, timestamp, compression=True):
+    """Датаграммы кадра с номерами от first_seq и меткой timestamp: сжатие чата и фрагменты"""
+    flags = 0
+    if compression and msg_type == MSG_CHAT:
+        compressed = compress(payload)
+        if compressed is not None:
+            payload = compressed
+            flags = FLAG_COMPRESSED
+    return fragment(msg_type, sender_id, first_seq, timestamp, payload, flags)
+
+
+def socket_drops(sock):
+    """Датаграммы, отброшенные ядром из-за переполнения буфера сокета (Linux)"""
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    for path in ('/proc/net/udp', '/proc/net/udp6'):
+        try:
+            with open(path) as table:
+                next(table)
+                for line in table:
+                    fields = line.split()
+                    if fields[9] == inode:
+                        return int(fields[-1])
+        except (OSError, IndexError, ValueError, StopIteration):
+            continue
+    return None
+
+
+class Channel:
+    """Подписка на канал: группа, свои номера кадров, учёт потерь, сборка и повторы"""
+
+    def __init__(self, name, group, reliability, reassembler, seen=None):
+        self.name = name
+        self.group = group
+        self.address = socket.inet_aton(group)
+        self.seq = 0
+        self.reliability = reliability
+        self.reassembler = reassembler
+        self.seen = seen
+
+
+class MulticastMessenger:
+    """Multicast-чат поверх цикла событий
+
+    Сокет неблокирующий и зарегистрирован в loop (QtLoop или SelectorLoop):
+    приём, NACK и таймеры выполняются в потоке цикла без опроса, а
+    отправка - в потоке SendScheduler с бюджетом send_rate байт в секунду.
+    Готовые кадры передаются в on_frame(frame), frame.channel - имя
+    канала, frame.address - IP-адрес отправителя. Полезная нагрузка
+    кадра - memoryview на буфер приёма и действительна только внутри
+    on_frame; всё, что нужно сохранить, следует скопировать.
+
+    on_nack(channel, payload) получает полезную нагрузку каждого NACK -
+    для отправителей, чьи кадры ушли в сеть не через этот объект
+    (клиенты узла, modules/hub.py).
+    """
+
+    # Максимум датаграмм за одно пробуждение, чтобы не задерживать цикл
+    RECV_BATCH = 64
+    RCVBUF = 1024 * 1024
+    POOL_SIZE = 4
+    # Предел собранного и распакованного сообщения
+    MAX_MESSAGE = 1024 * 1024
+
+    def __init__(self, workstation_id, loop, on_frame, multicast_group=DEFAULT_GROUP, port=5007,
+                 compression=True, metrics=None, channel=DEFAULT_CHANNEL, limiter=None,
+                 send_rate=DEFAULT_SEND_RATE, on_nack=None):
+        self.workstation_id = workstation_id
+        self.loop = loop
+        self.on_frame = on_frame
+        self.on_nack = on_nack
+        self.port = port
+        self.running = True
+        self.sender_id = new_sender_id()
+        # Метки кадров (modules/clock.py); принятые кадры получают метку, по
+        # которой их упорядочивать, в frame.timestamp
+        self.clock = HybridClock()
+        # Сжатие исходящих сообщений чата; входящие распаковываются всегда
+        self.compression = compression
+        # Ограничение частоты сообщений чата по отправителям (modules/ratelimit.py)
+        self.limiter = limiter
+        self.pool = BufferPool(self.POOL_SIZE, RECV_BUFFER)
+        # Таблица разбора: имя канала и адрес группы (4 байта) -> Channel
+        self.channels = {}
+        self.groups = {}
+        self.default_channel = channel
+        # Разбор по адресу назначения включается со второго канала
+        self.demux = False
+        self.ancillary_size = PKTINFO_SPACE
+        self.timer = None
+        self.timer_due = None
+        self.setup_metrics(REGISTRY if metrics is None else metrics)
+
+        # Создаем UDP сокет
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setblocking(False)
+
+        # Запас в буфере ядра на время, пока цикл занят отрисовкой
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RCVBUF)
+
+        # Устанавливаем TTL для multicast
+        ttl = struct.pack('b', 1)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+
+        # Присоединяемся к multicast группе
+        self.join_multicast_group(channel, multicast_group)
+        self.scheduler = SendScheduler(self.sock, send_rate, self.metrics)
+        self.loop.add_reader(self.sock.fileno(), self.on_readable)
+
+    def setup_metrics(self, metrics):
+        self.metrics = metrics
+        self.datagrams_received = metrics.counter('chim_datagrams_received_total', "Принято датаграмм")
+        self.bytes_received = metrics.counter('chim_bytes_received_total', "Принято байт")
+        self.receive_errors = metrics.counter('chim_receive_errors_total', "Ошибки чтения сокета")
+        self.decode_errors = metrics.counter('chim_decode_errors_total', "Некорректные кадры")
+        self.truncated = metrics.counter('chim_truncated_total', "Обрезанные кадры")
+        self.foreign = metrics.counter('chim_foreign_total', "Датаграммы не в формате Chim")
+        self.own_echo = metrics.counter('chim_own_echo_total', "Отброшенное собственное эхо")
+        self.duplicates = metrics.counter(
+            'chim_duplicates_total', "Повторные кадры (интерфейсы, ретрансляторы, повторы по NACK)")
+        self.frames_delivered = metrics.counter('chim_frames_delivered_total', "Кадры, переданные в on_frame")
+        self.handler_errors = metrics.counter(
+            'chim_handler_errors_total', "Исключения обработчика кадров, пропущенные без остановки приёма")
+        self.unsubscribed = metrics.counter(
+            'chim_unsubscribed_total', "Датаграммы групп, на которые нет подписки")
+        self.rate_limited = metrics.counter(
+            'chim_rate_limited_total', "Сообщения чата сверх лимита отправителя")
+
+        # Значения, которые дешевле вычислить при снимке, чем поддерживать
+        metrics.gauge('chim_outbox_depth', "Датаграммы в очереди отправки", lambda: self.scheduler.pending())
+        metrics.gauge('chim_kernel_drops', "Отброшено ядром при переполнении буфера приёма",
+                      lambda: socket_drops(self.sock))
+        metrics.gauge('chim_channels', "Каналы, на которые есть подписка", lambda: len(self.channels))
+        metrics.gauge('chim_clock_skewed', "Кадры с меткой дальше max_drift впереди своих часов",
+                      lambda: self.clock.skewed)
+        for key in STAT_KEYS:
+            metrics.gauge(f'chim_reliability_{key}', function=lambda key=key: self.reliability_stats()[key])
+        for key in ('completed', 'expired', 'evicted', 'rejected'):
+            metrics.gauge(f'chim_reassembly_{key}', function=lambda key=key: sum(
+                getattr(channel.reassembler, key) for channel in self.channels.values()))
+
+    def reliability_stats(self):
+        """Счётчики учёта потерь, сложенные по всем каналам"""
+        totals = dict.fromkeys(STAT_KEYS, 0)
+        for channel in self.channels.values():
+            for key, value in channel.reliability.stats().items():
+                totals[key] += value
+        return totals
+
+    @property
+    def multicast_group(self):
+        return self.channels[self.default_channel].group
+
+    def join_multicast_group(self, name, group):
+        try:
+            self.sock.bind(('', self.port))
+            # Ядро Linux по умолчанию отдаёт сокету группы, на которые
+            # подписаны другие сокеты того же порта; оставляем только свои
+            if IP_MULTICAST_ALL is not None:
+                try:
+                    self.sock.setsockopt(socket.IPPROTO_IP, IP_MULTICAST_ALL, 0)
+                except OSError:
+                    pass
+            self.subscribe(name, group)
+        except Exception as e:
+            raise Exception(f"Не удалось присоединиться к multicast группе: {str(e)}")
+
+    def subscribe(self, name, group):
+        """Подписка на канал; повторная подписка возвращает тот же канал"""
+        channel = self.channels.get(name)
+        if channel is not None:
+            return channel
+        address = socket.inet_aton(group)
+        if address in self.groups:
+            raise Exception(f"Группа {group} уже занята каналом {self.groups[address].name}")
+        if self.channels and not CAN_DEMUX:
+            raise Exception("Несколько каналов на этой платформе не поддерживаются")
+        mreq = struct.pack('4sL', address, socket.INADDR_ANY)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+
+        def send_nack(payload):
+            self.send_nack(payload, name)
+
+        def resend(data):
+            # Повтор закрывает чужую дыру, поэтому идёт вперёд нового чата
+            self.send_datagram(data, group, PRIORITY_CONTROL)
+
+        channel = Channel(name, group, Reliability(self.sender_id, send_nack, resend),
+                          Reassembler(max_message=self.MAX_MESSAGE),
+                          SeenFilter())
+        self.channels[name] = channel
+        self.groups[address] = channel
+        self.update_demux()
+        return channel
+
+    def unsubscribe(self, name):
+        """Отписка от канала; последний канал оставить нельзя"""
+        channel = self.channels.get(name)
+        if channel is None:
+            return
+        if len(self.channels) == 1:
+            raise Exception("Нельзя покинуть единственный канал")
+        mreq = struct.pack('4sL', channel.address, socket.INADDR_ANY)
+        try:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, mreq)
+        except OSError:
+            pass
+        del self.channels[name]
+        del self.groups[channel.address]
+        if name == self.default_channel:
+            self.default_channel = next(iter(self.channels))
+        self.update_demux()
+
+    def update_demux(self):
+        demux = len(self.channels) > 1
+        if demux != self.demux:
+            self.sock.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, int(demux))
+            self.demux = demux
+
+    def channel(self, name=None):
+        channel = self.channels.get(self.default_channel if name is None else name)
+        if channel is None:
+            raise Exception(f"Нет подписки на канал {name}")
+        return channel
+
+    def send_message(self, message, channel=None, timestamp=None):
+        """Отправка текста в канал; возвращает порядковый номер кадра"""
+        try:
+            return self.send_frame(MSG_CHAT, encode_chat(self.workstation_id, message), channel, timestamp)
+        except Exception as e:
+            raise Exception(f"Ошибка отправки сообщения: {str(e)}")
+
+    def send_frame(self, msg_type, payload, channel=None, timestamp=None):
+        """Отправка кадра, при необходимости разбитого на фрагменты
+
+        timestamp - метка часов self.clock, уже выданная, например, для
+        показа своего сообщения; по умолчанию берётся новая.
+        """
+        channel = self.channel(channel)
+        priority = PRIORITY_OF.get(msg_type, PRIORITY_CONTROL)
+        first_seq = channel.seq + 1
+        if timestamp is None:
+            timestamp = self.clock.now()
+        datagrams = encode_datagrams(self.sender_id, first_seq, msg_type, payload, timestamp,
+                                     self.compression)
+        # Номера не расходуются на кадр, который не поместится в очередь целиком
+        if self.scheduler.free(priority) < len(datagrams):
+            self.scheduler.rejected.inc(len(datagrams))
+            raise Exception("Очередь отправки переполнена")
+        channel.seq += len(datagrams)
+        for index, data in enumerate(datagrams):
+            channel.reliability.sent(first_seq + index, data)
+            self.send_datagram(data, channel.group, priority)
+        return first_seq
+
+    def send_unsequenced(self, msg_type, payload, channel=None):
+        """Одна датаграмма вне последовательности: без NACK и повторов
+
+        False - очередь отправки переполнена и датаграмма отброшена.
+        """
+        return self.send_datagram(encode_frame(msg_type, self.sender_id, 0, self.clock.now(), payload),
+                                  self.channel(channel).group, PRIORITY_OF.get(msg_type, PRIORITY_CONTROL))
+
+    def send_nack(self, payload, channel=None):
+        # NACK идёт вне последовательности, чтобы его потеря не порождала новых NACK
+        self.send_unsequenced(MSG_NACK, payload, channel)
+
+    def send_presence(self, payload, channel=None):
+        # Сигналы присутствия тоже вне последовательности: потерянный
+        # сигнал заменит следующий, повторная передача не нужна
+        self.send_unsequenced(MSG_PRESENCE, payload, channel)
+
+    def send_datagram(self, data, group=None, priority=PRIORITY_CONTROL):
+        group = self.multicast_group if group is None else group
+        return self.scheduler.put(data, (group, self.port), priority)
+
+    def congested(self, priority=PRIORITY_BULK):
+        """Очередь приоритета перегружена: массовой отправке стоит подождать"""
+        return self.scheduler.congested(priority)
+
+    def pending(self):
+        """Датаграммы, ещё не переданные ядру"""
+        return self.scheduler.pending()
+
+    def on_readable(self):
+        """Разбор накопившихся датаграмм; вызывается циклом событий"""
+        buffer = self.pool.acquire()
+        view = memoryview(buffer)
+        buffers = [buffer]
+        # Пока канал один, адрес назначения не нужен и читается без IP_PKTINFO
+        channel = None if self.demux else self.channels[self.default_channel]
+        try:
+            for _ in range(self.RECV_BATCH):
+                try:
+                    if channel is None:
+                        size, ancillary, _, address = self.sock.recvmsg_into(buffers, self.ancillary_size)
+                    else:
+                        size, address = self.sock.recvfrom_into(buffer)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError:
+                    if not self.running:
+                        return
+                    self.receive_errors.inc()
+                    break
+                self.datagrams_received.inc()
+                self.bytes_received.inc(size)
+                target = channel if channel is not None else self.channel_of(ancillary)
+                if target is None:
+                    self.unsubscribed.inc()
+                    continue
+                try:
+                    frame = self.decode(view[:size], target, address[0])
+                    if frame is not None:
+                        self.frames_delivered.inc()
+                        self.on_frame(frame)
+                except TruncatedFrame:
+                    self.truncated.inc()
+                except ProtocolError:
+                    self.decode_errors.inc()
+                except Exception:
+                    # Ошибка в обработчике одного кадра не должна останавливать
+                    # приём остальных датаграмм пачки
+                    self.handler_errors.inc()
+        finally:
+            self.pool.release(buffer)
+        self.arm_timer()
+
+    def channel_of(self, ancillary):
+        """Канал по адресу назначения из IP_PKTINFO"""
+        for level, kind, data in ancillary:
+            if level == socket.IPPROTO_IP and kind == IP_PKTINFO:
+                return self.groups.get(bytes(data[PKTINFO_ADDR]))
+        return None
+
+    def arm_timer(self):
+        """Таймер на ближайший срок NACK; без пропусков таймер не заводится"""
+        delay = None
+        for channel in self.channels.values():
+            timeout = channel.reliability.next_timeout()
+            if timeout is not None and (delay is None or timeout < delay):
+                delay = timeout
+        if delay is None:
+            return
+        due = time.monotonic() + delay
+        if self.timer is not None:
+            if self.timer_due <= due:
+                return
+            self.timer.cancel()
+        self.timer = self.loop.call_later(delay, self.on_timer)
+        self.timer_due = due
+
+    def on_timer(self):
+        self.timer = None
+        for channel in list(self.channels.values()):
+            channel.reliability.tick()
+        self.arm_timer()
+
+    def decode(self, data, channel, address=None):
+        """Разбор датаграммы канала; None для чужих пакетов и собственного эха"""
+        sender = peek_sender(data)
+        if sender is None:
+            self.foreign.inc()
+            return None
+        if sender == self.sender_id:
+            self.own_echo.inc()
+            return None
+        frame = decode_frame(data)
+        # Повтор отбрасывается до учёта потерь и разбора. Кадр вне
+        # последовательности опознаётся по времени отправки и содержимому
+        if frame.seq:
+            duplicate = channel.seen.seen(sender, frame.seq)
+        else:
+            duplicate = channel.seen.seen_key(
+                (sender, frame.msg_type, frame.timestamp, zlib.crc32(frame.payload)))
+        if duplicate:
+            self.duplicates.inc()
+            return None
+        frame.timestamp = self.clock.update(frame.timestamp)
+        if frame.msg_type == MSG_NACK:
+            channel.reliability.on_nack(frame.payload)
+            if self.on_nack is not None:
+                self.on_nack(channel.name, frame.payload)
+            return None
+        if frame.seq and not channel.reliability.accept(frame.sender, frame.seq):
+            return None
+        if frame.flags & FLAG_FRAGMENT:
+            frame = channel.reassembler.add(frame)
+            if frame is None:
+                return None
+        # Номер кадра уже учтён, поэтому подавленное сообщение не вызовет NACK;
+        # распаковка и разбор ему не достаются
+        if frame.msg_type == MSG_CHAT and self.limiter is not None and \
+                not self.limiter.allow(frame.sender, channel.name):
+            self.rate_limited.inc()
+            return None
+        if frame.flags & FLAG_COMPRESSED:
+            frame.payload = decompress(frame.payload, self.MAX_MESSAGE)
+            frame.flags &= ~FLAG_COMPRESSED
+        frame.channel = channel.name
+        frame.address = address
+        return frame
+
+    def close(self):
+        # Закрытие в потоке цикла: сокет снимается с регистрации до закрытия,
+        # поэтому гонки с приёмом нет и выход не ждёт таймаута. Служебные
+        # кадры (уход, NACK) досылаются до закрытия сокета, чат и файлы - нет
+        self.running = False
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.scheduler.close()
+        try:
+            self.loop.remove_reader(self.sock.fileno())
+            self.sock.close()
+        except:
+            pass
+
@@ -0,0 +1,260 @@
+"""Присутствие участников: периодические сигналы и список комнаты
+
+Каждый клиент рассылает короткий кадр MSG_PRESENCE вне
+последовательности: состояние, свой интервал сигналов и имя. Участник
+считается ушедшим, если от него нет сигнала EXPIRY_FACTOR интервалов,
+или сразу по кадру ухода.
+
+Сроки участников хранятся в хешированном колесе таймеров: каждый такт
+просматривается только одна ячейка, а не весь список. Продление срока
+при очередном сигнале не трогает колесо - запись переносится в нужную
+ячейку, только когда до неё доходит очередь.
+
+Клиент, раздающий историю (modules/sync.py), дописывает в конец
+сигнала свой TCP-порт. Старые клиенты читают только имя и хвост
+игнорируют.
+
+Интервал сигналов растёт с размером комнаты так, чтобы вся комната
+вместе отправляла не больше ROOM_RATE сигналов в секунду, и получает
+случайный разброс, чтобы клиенты, запущенные одновременно, не слали
+сигналы синхронно.
+"""
+import random
+import struct
+import time
+
+from modules.protocol import MAX_NAME, ProtocolError
+
+PRESENCE = struct.Struct('!BHB')
+SYNC_PORT = struct.Struct('!H')
+
+STATE_LEAVE = 0
+STATE_ONLINE = 1
+# Сигнал нового участника: часть комнаты отвечает, не дожидаясь интервала
+STATE_HELLO = 2
+
+
+def encode_presence(state, interval, name, sync_port=0):
+    """Полезная нагрузка MSG_PRESENCE; интервал в секундах"""
+    name_data = name.encode('utf-8')[:MAX_NAME]
+    deciseconds = min(0xFFFF, int(interval * 10))
+    payload = PRESENCE.pack(state, deciseconds, len(name_data)) + name_data
+    if sync_port:
+        payload += SYNC_PORT.pack(sync_port)
+    return payload
+
+
+def decode_presence(payload):
+    """Разбор MSG_PRESENCE: (состояние, интервал в секундах, имя, порт истории или 0)"""
+    if len(payload) < PRESENCE.size:
+        raise ProtocolError("Кадр присутствия обрезан")
+    state, deciseconds, name_size = PRESENCE.unpack_from(payload)
+    end = PRESENCE.size + name_size
+    if end > len(payload):
+        raise ProtocolError("Имя в кадре присутствия обрезано")
+    name = str(payload[PRESENCE.size:end], 'utf-8', 'replace')
+    sync_port = SYNC_PORT.unpack_from(payload, end)[0] if len(payload) >= end + SYNC_PORT.size else 0
+    return state, deciseconds / 10, name, sync_port
+
+
+class TimingWheel:
+    """Хешированное колесо таймеров с ленивым переносом записей
+
+    schedule(key, when) кладёт ключ в ячейку своего такта. advance(now)
+    обходит ячейки прошедших тактов и вызывает deadline(key): функция
+    возвращает актуальный срок ключа или None, если ключ уже не нужен.
+    Наступившие сроки возвращаются списком, остальные переносятся.
+    """
+
+    def __init__(self, tick=0.5, slots=512, clock=time.monotonic):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.clock = clock
+        self.current = int(clock() / tick)
+
+    def _slot_for(self, when):
+        # Ключ не может сработать раньше следующего такта
+        return max(int(when / self.tick), self.current + 1)
+
+    def schedule(self, key, when):
+        self.slots[self._slot_for(when) % len(self.slots)].add(key)
+
+    def advance(self, deadline, now=None):
+        now = self.clock() if now is None else now
+        target = int(now / self.tick)
+        expired = []
+        # Не больше одного оборота: дальше ячейки повторяются
+        start = max(self.current + 1, target - len(self.slots) + 1)
+        self.current = target
+        for tick in range(start, target + 1):
+            slot = self.slots[tick % len(self.slots)]
+            if not slot:
+                continue
+            keys = list(slot)
+            slot.clear()
+            for key in keys:
+                when = deadline(key)
+                if when is None:
+                    continue
+                if when <= now:
+                    expired.append(key)
+                else:
+                    self.schedule(key, when)
+        return expired
+
+
+class Peer:
+    __slots__ = ('sender', 'name', 'interval', 'expires', 'joined', 'address', 'sync_port')
+
+    def __init__(self, sender, name, interval, expires, joined, address=None, sync_port=0):
+        self.sender = sender
+        self.name = name
+        self.interval = interval
+        self.expires = expires
+        self.joined = joined
+        # IP-адрес участника и порт, на котором он раздаёт историю
+        self.address = address
+        self.sync_port = sync_port
+
+
+class Presence:
+    """Сигналы присутствия и список участников поверх MulticastMessenger
+
+    send(payload) - отправка кадра MSG_PRESENCE, on_change() вызывается
+    при появлении, уходе или переименовании участника. sync_port - порт
+    раздачи истории, объявляемый в сигналах. Все вызовы - из потока
+    цикла событий loop.
+    """
+
+    # Базовый и предельный интервалы сигналов, секунды
+    MIN_INTERVAL = 5.0
+    MAX_INTERVAL = 120.0
+    # Сигналов в секунду от всей комнаты
+    ROOM_RATE = 50.0
+    JITTER = 0.25
+    EXPIRY_FACTOR = 3.2
+    # Сколько участников в среднем отвечает на приветствие новичка
+    HELLO_REPLIES = 16
+    HELLO_DELAY = 2.0
+    TICK = 0.5
+
+    def __init__(self, name, loop, send, on_change=None, clock=time.monotonic, rng=None,
+                 sync_port=0):
+        self.name = name
+        self.sync_port = sync_port
+        self.loop = loop
+        self.send = send
+        self.on_change = on_change
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self.peers = {}
+        self.wheel = TimingWheel(self.TICK, clock=clock)
+        self.heartbeat_timer = None
+        self.tick_timer = None
+        self.reply_timer = None
+
+        # Статистика
+        self.heartbeats_sent = 0
+        self.heartbeats_received = 0
+        self.expired = 0
+
+    def start(self):
+        self._send(STATE_HELLO)
+        self._schedule_heartbeat()
+        self.tick_timer = self.loop.call_later(self.TICK, self.on_tick)
+
+    def stop(self):
+        """Кадр ухода и остановка таймеров"""
+        for timer in (self.heartbeat_timer, self.tick_timer, self.reply_timer):
+            if timer is not None:
+                timer.cancel()
+        self.heartbeat_timer = self.tick_timer = self.reply_timer = None
+        try:
+            self._send(STATE_LEAVE)
+        except Exception:
+            pass
+
+    def interval(self):
+        """Интервал сигналов для текущего размера комнаты"""
+        room = len(self.peers) + 1
+        return min(self.MAX_INTERVAL, max(self.MIN_INTERVAL, room / self.ROOM_RATE))
+
+    def members(self):
+        """Имена участников, включая себя, по алфавиту"""
+        return sorted([self.name] + [peer.name for peer in self.peers.values()], key=str.casefold)
+
+    def sync_peers(self):
+        """Адреса (IP, порт) участников, раздающих историю"""
+        return [(peer.address, peer.sync_port) for peer in self.peers.values()
+                if peer.address and peer.sync_port]
+
+    def on_payload(self, sender, payload, address=None):
+        state, interval, name, sync_port = decode_presence(payload)
+        self.heartbeats_received += 1
+        if state == STATE_LEAVE:
+            if self.peers.pop(sender, None) is not None:
+                self._changed()
+            return
+
+        now = self.clock()
+        expires = now + max(interval, self.MIN_INTERVAL) * self.EXPIRY_FACTOR
+        peer = self.peers.get(sender)
+        if peer is None:
+            self.peers[sender] = Peer(sender, name, interval, expires, now, address, sync_port)
+            self.wheel.schedule(sender, expires)
+            self._changed()
+        else:
+            # Колесо не трогаем: срок перечитается, когда дойдёт до ячейки
+            peer.expires = expires
+            peer.interval = interval
+            peer.address = address or peer.address
+            peer.sync_port = sync_port
+            if peer.name != name:
+                peer.name = name
+                self._changed()
+        if state == STATE_HELLO:
+            self._maybe_reply()
+
+    def on_tick(self):
+        self.tick_timer = self.loop.call_later(self.TICK, self.on_tick)
+        removed = 0
+        for sender in self.wheel.advance(self._deadline):
+            if self.peers.pop(sender, None) is not None:
+                removed += 1
+        if removed:
+            self.expired += removed
+            self._changed()
+
+    def on_heartbeat(self):
+        self.heartbeat_timer = None
+        self._send(STATE_ONLINE)
+        self._schedule_heartbeat()
+
+    def _deadline(self, sender):
+        peer = self.peers.get(sender)
+        return peer.expires if peer is not None else None
+
+    def _maybe_reply(self):
+        # В большой комнате отвечает лишь случайная часть участников
+        if self.reply_timer is not None:
+            return
+        if self.rng.random() >= self.HELLO_REPLIES / (len(self.peers) + 1):
+            return
+        self.reply_timer = self.loop.call_later(self.rng.uniform(0, self.HELLO_DELAY), self._reply)
+
+    def _reply(self):
+        self.reply_timer = None
+        self._send(STATE_ONLINE)
+
+    def _schedule_heartbeat(self):
+        interval = self.interval()
+        delay = interval * self.rng.uniform(1 - self.JITTER, 1 + self.JITTER)
+        self.heartbeat_timer = self.loop.call_later(delay, self.on_heartbeat)
+
+    def _send(self, state):
+        self.heartbeats_sent += 1
+        self.send(encode_presence(state, self.interval(), self.name, self.sync_port))
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
@@ -0,0 +1,160 @@
+"""Бинарный протокол кадров Chim Messenger
+
+Каждая датаграмма начинается с заголовка фиксированной длины:
+
+    смещение  размер  поле
+    0         1       магия (старшие 4 бита) и версия (младшие 4 бита)
+    1         1       тип сообщения
+    2         1       флаги
+    3         8       идентификатор экземпляра отправителя
+    11        4       порядковый номер (0 - кадр вне последовательности)
+    15        8       метка гибридных часов отправителя (modules/clock.py)
+    23        2       длина полезной нагрузки
+
+Все поля в сетевом порядке байт. Заголовок разбирается одним вызовом
+struct без декодирования полезной нагрузки. Старые клиенты пишут в поле
+времени миллисекунды; modules/clock.py различает оба вида.
+"""
+import os
+import struct
+import time
+
+MAGIC = 0xC0
+VERSION = 1
+MAGIC_VERSION = MAGIC | VERSION
+
+# Типы сообщений
+MSG_CHAT = 1
+MSG_NACK = 2
+MSG_PRESENCE = 3
+# Передача файлов (modules/transfer.py)
+MSG_FILE_OFFER = 4
+MSG_FILE_DATA = 5
+MSG_FILE_NACK = 6
+
+# Флаги кадра
+FLAG_FRAGMENT = 0x01
+# Полезная нагрузка сжата общим словарём (modules/compression.py)
+FLAG_COMPRESSED = 0x02
+
+HEADER = struct.Struct('!BBBQIQH')
+HEADER_SIZE = HEADER.size
+SENDER = struct.Struct('!Q')
+SENDER_OFFSET = 3
+
+MAX_PAYLOAD = 0xFFFF
+MAX_NAME = 0xFF
+
+# Датаграмма должна помещаться в Ethernet MTU без IP-фрагментации
+MAX_DATAGRAM = 1400
+# Буфер приёма с запасом, чтобы обнаруживать слишком длинные датаграммы
+RECV_BUFFER = 65535
+
+
+class ProtocolError(ValueError):
+    """Датаграмма не является корректным кадром Chim"""
+
+
+class TruncatedFrame(ProtocolError):
+    """Датаграмма короче, чем указано в заголовке"""
+
+
+class Frame:
+    __slots__ = ('msg_type', 'flags', 'sender', 'seq', 'timestamp', 'payload', 'channel', 'address')
+
+    def __init__(self, msg_type, flags, sender, seq, timestamp, payload):
+        self.msg_type = msg_type
+        self.flags = flags
+        self.sender = sender
+        self.seq = seq
+        self.timestamp = timestamp
+        self.payload = payload
+        # Имя канала, заполняется при приёме по группе назначения
+        self.channel = None
+        # IP-адрес отправителя датаграммы, заполняется при приёме
+        self.address = None
+
+    def __repr__(self):
+        return (f"Frame(type={self.msg_type}, flags={self.flags:#x}, "
+                f"sender={self.sender:#018x}, seq={self.seq}, "
+                f"timestamp={self.timestamp}, payload={len(self.payload)}b)")
+
+
+def new_sender_id():
+    """Случайный 64-битный идентификатор экземпляра клиента"""
+    return SENDER.unpack(os.urandom(SENDER.size))[0] or 1
+
+
+def now_ms():
+    return time.time_ns() // 1000000
+
+
+def encode_frame(msg_type, sender, seq, timestamp, payload, flags=0):
+    """Сборка кадра из заголовка и полезной нагрузки"""
+    length = len(payload)
+    if length > MAX_PAYLOAD:
+        raise ProtocolError(f"Слишком большая полезная нагрузка: {length} байт")
+    return HEADER.pack(MAGIC_VERSION, msg_type, flags, sender,
+                       seq & 0xFFFFFFFF, timestamp, length) + payload
+
+
+def peek_sender(data):
+    """Быстрая проверка кадра: отправитель или None для чужих пакетов
+
+    Читает только первый байт и поле отправителя, полезная нагрузка
+    не затрагивается.
+    """
+    if len(data) < HEADER_SIZE or data[0] != MAGIC_VERSION:
+        return None
+    return SENDER.unpack_from(data, SENDER_OFFSET)[0]
+
+
+def decode_header(data):
+    """Разбор заголовка: (тип, флаги, отправитель, номер, время, длина)"""
+    if len(data) < HEADER_SIZE:
+        raise TruncatedFrame("Датаграмма короче заголовка")
+    magic_version, msg_type, flags, sender, seq, timestamp, length = HEADER.unpack_from(data)
+    if magic_version != MAGIC_VERSION:
+        raise ProtocolError(f"Неизвестная магия или версия: {magic_version:#x}")
+    if HEADER_SIZE + length > len(data):
+        raise TruncatedFrame("Полезная нагрузка обрезана")
+    return msg_type, flags, sender, seq, timestamp, length
+
+
+def decode_frame(data):
+    """Разбор кадра; полезная нагрузка возвращается как memoryview"""
+    # Проверки decode_header повторены здесь: это путь каждой принятой датаграммы
+    size = len(data)
+    if size < HEADER_SIZE:
+        raise TruncatedFrame("Датаграмма короче заголовка")
+    magic_version, msg_type, flags, sender, seq, timestamp, length = HEADER.unpack_from(data)
+    if magic_version != MAGIC_VERSION:
+        raise ProtocolError(f"Неизвестная магия или версия: {magic_version:#x}")
+    end = HEADER_SIZE + length
+    if end > size:
+        raise TruncatedFrame("Полезная нагрузка обрезана")
+    return Frame(msg_type, flags, sender, seq, timestamp, memoryview(data)[HEADER_SIZE:end])
+
+
+def encode_chat(name, text):
+    """Полезная нагрузка текстового сообщения: имя с длиной и текст"""
+    name_data = name.encode('utf-8')[:MAX_NAME]
+    return bytes((len(name_data),)) + name_data + text.encode('utf-8')
+
+
+def chat_name_end(payload):
+    """Проверка текстового сообщения без декодирования; конец поля имени"""
+    if not len(payload):
+        raise ProtocolError("Пустое текстовое сообщение")
+    name_end = 1 + payload[0]
+    if name_end > len(payload):
+        raise ProtocolError("Имя отправителя обрезано")
+    return name_end
+
+
+def decode_chat(payload):
+    """Разбор текстового сообщения: (имя, текст)"""
+    name_end = chat_name_end(payload)
+    name = str(payload[1:name_end], 'utf-8', 'replace')
+    text = str(payload[name_end:], 'utf-8', 'replace')
+    return name, text
@@ -0,0 +1,61 @@
+"""Ограничение частоты входящих сообщений по отправителям
+
+У каждого отправителя своя корзина токенов: burst сообщений подряд и
+дальше rate в секунду. Сообщения сверх лимита не разбираются, а только
+подсчитываются, чтобы интерфейс показал одно сводное уведомление вместо
+потока строк. Корзины хранятся в порядке последнего обращения, и при
+превышении max_senders вытесняется самая давняя - поток кадров со
+случайными идентификаторами не раздувает таблицу.
+"""
+import time
+from collections import OrderedDict
+
+
+class _Bucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class SenderLimiter:
+    def __init__(self, rate=20.0, burst=100, max_senders=4096, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_senders = max_senders
+        self.clock = clock
+        self.buckets = OrderedDict()
+        # (отправитель, метка) -> подавлено с последнего take_suppressed
+        self.suppressed = {}
+
+        # Статистика
+        self.allowed = 0
+        self.total_suppressed = 0
+
+    def allow(self, sender, tag=None):
+        """Списание токена; False - сообщение сверх лимита"""
+        now = self.clock()
+        bucket = self.buckets.get(sender)
+        if bucket is None:
+            if len(self.buckets) >= self.max_senders:
+                self.buckets.popitem(last=False)
+            bucket = self.buckets[sender] = _Bucket(self.burst, now)
+        else:
+            self.buckets.move_to_end(sender)
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            self.allowed += 1
+            return True
+        key = (sender, tag)
+        self.suppressed[key] = self.suppressed.get(key, 0) + 1
+        self.total_suppressed += 1
+        return False
+
+    def take_suppressed(self):
+        """Подавленное с прошлого вызова: {(отправитель, метка): количество}"""
+        suppressed = self.suppressed
+        self.suppressed = {}
+        return suppressed
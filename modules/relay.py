@@ -0,0 +1,331 @@
+"""Ретранслятор кадров между сегментами сети
+
+TTL multicast-кадров Chim - 1, поэтому чат не выходит за пределы
+сегмента (VLAN). Ретранслятор подписывается на группы каналов в своём
+сегменте, пересылает кадры Chim ретрансляторам других сегментов по TCP
+и рассылает принятые от них кадры в свой сегмент с тем же TTL 1.
+
+Кадры не разбираются: читается только заголовок, датаграмма уходит как
+есть. Поэтому номера, NACK и повторы между сегментами работают так же,
+как внутри одного.
+
+Петли и дубликаты подавляются так:
+- датаграмма, вошедшая в сеть ретрансляторов, получает метку
+  (ретранслятор, его номер) и рассылается всем соседям. Повторно
+  пришедшая метка отбрасывается по окну номеров источника
+  (modules/dedup.py), поэтому ретрансляторы можно соединять
+  любой сеткой, а не только деревом; число пересылок ограничено MAX_HOPS;
+- кадр (группа, отправитель, номер) попадает в сегмент или уходит из
+  него не чаще раза за DUPLICATE_WINDOW. Копии, пришедшие разными путями,
+  не размножаются, а собственная рассылка, вернувшаяся на сокет приёма
+  через multicast loopback, не уходит обратно к соседям.
+
+Соседи не проверяются криптографически: кто подключился к порту
+соседей, тот может рассылать кадры в сегмент. Поэтому ретранслятор
+рассылает только в свои группы и на свой порт, а входящие соединения
+принимает лишь с адресов allow, если он задан. Без allow порт соседей
+должен слушать только доверенный интерфейс (адрес в --listen, а не :порт
+на всех интерфейсах).
+
+Цикл - SelectorLoop (epoll в Linux). Приём идёт пачками до RECV_BATCH
+датаграмм за пробуждение, и каждому соседу за пачку - одна запись.
+
+    python chim.py relay --listen 10.1.0.5:7007 --peer 10.2.0.5:7007 --allow 10.2.0.5
+"""
+import socket
+import struct
+
+from modules.dedup import RotatingBloom, SeenFilter
+from modules.metrics import REGISTRY
+from modules.network import IP_MULTICAST_ALL, IP_PKTINFO, PKTINFO_ADDR, PKTINFO_SPACE, PRIORITY_OF
+from modules.protocol import RECV_BUFFER, SENDER_OFFSET, new_sender_id, peek_sender
+from modules.scheduler import PRIORITY_CONTROL, SendScheduler
+from modules.sync import Connection
+
+RELAY_HELLO = 1
+RELAY_DATAGRAM = 2
+
+RELAY_ID = struct.Struct('!Q')
+# Метка датаграммы: ретранслятор-источник, его номер, число пересылок, группа
+RELAY_HEADER = struct.Struct('!QIB4s')
+# Порядковый номер в заголовке кадра (modules/protocol.py)
+SEQ_FIELD = struct.Struct('!I')
+SEQ_OFFSET = SENDER_OFFSET + 8
+
+
+def frame_key(data, group):
+    """Ключ кадра для подавления дубликатов или None для чужих датаграмм"""
+    sender = peek_sender(data)
+    if sender is None:
+        return None
+    seq = SEQ_FIELD.unpack_from(data, SEQ_OFFSET)[0]
+    if seq:
+        return group, sender, seq
+    # Кадры вне последовательности (NACK, присутствие, блоки файлов) - по содержимому
+    return group, sender, 0, hash(data)
+
+
+def parse_address(text, default_port=7007):
+    """Адрес "хост:порт", ":порт" или "хост" -> (хост, порт)"""
+    host, _, port = text.rpartition(':')
+    if not _:
+        host, port = text, ''
+    try:
+        return host.strip('[]'), int(port) if port else default_port
+    except ValueError:
+        raise Exception(f"Некорректный адрес: {text}")
+
+
+class Relay:
+    """Ретранслятор одного сегмента: его группы на port и TCP-соседи
+
+    listen - (хост, порт) для входящих соединений соседей, peers - адреса,
+    к которым ретранслятор подключается сам и переподключается после
+    обрыва. Достаточно, чтобы соединение было задано на одной стороне.
+    allow - IP-адреса, с которых принимаются входящие соединения; None -
+    с любых.
+    """
+
+    MAX_HOPS = 8
+    # Не дольше holdoff повторов у отправителя (modules/reliability.py):
+    # более поздняя копия - уже повтор по NACK, и его нужно доставить
+    DUPLICATE_WINDOW = 0.2
+    # Метки одного источника приходят по разным путям не по порядку
+    FLOOD_WINDOW = 8192
+    SEEN_CAPACITY = 1 << 16
+    RECV_BATCH = 256
+    RCVBUF = 4 * 1024 * 1024
+    RECONNECT = 2.0
+    # Неотправленного соседу сверх этого новые кадры ему не ставятся
+    PEER_BACKLOG = 8 * 1024 * 1024
+    BACKLOG = 16
+
+    def __init__(self, loop, groups, port=5007, listen=None, peers=(), metrics=None, allow=None):
+        self.loop = loop
+        self.port = port
+        self.relay_id = new_sender_id()
+        self.seq = 0
+        self.running = True
+        # Адрес группы (4 байта) -> группа
+        self.groups = {socket.inet_aton(group): group for group in groups}
+        self.single = next(iter(self.groups)) if len(self.groups) == 1 else None
+        self.allow = None
+        if allow is not None:
+            try:
+                self.allow = {socket.gethostbyname(host) for host in allow}
+            except OSError as e:
+                raise Exception(f"Неизвестный адрес в списке соседей: {str(e)}")
+        # Соединение с соседом -> его идентификатор (после RELAY_HELLO)
+        self.connections = {}
+        self.flush_pending = set()
+        self.flood_seen = SeenFilter(window=self.FLOOD_WINDOW)
+        # Два поколения по половине окна: ключ помнится от 0.1 до 0.2 с
+        self.recent = RotatingBloom(self.SEEN_CAPACITY, period=self.DUPLICATE_WINDOW / 2)
+        self.buffer = bytearray(RECV_BUFFER)
+        self.view = memoryview(self.buffer)
+        self.setup_metrics(REGISTRY if metrics is None else metrics)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RCVBUF)
+        self.sock.setblocking(False)
+        try:
+            self.sock.bind(('', port))
+            if IP_MULTICAST_ALL is not None:
+                try:
+                    self.sock.setsockopt(socket.IPPROTO_IP, IP_MULTICAST_ALL, 0)
+                except OSError:
+                    pass
+            for address in self.groups:
+                mreq = struct.pack('4sL', address, socket.INADDR_ANY)
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+            if self.single is None:
+                if IP_PKTINFO is None:
+                    raise Exception("Несколько групп на этой платформе не поддерживаются")
+                self.sock.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, 1)
+        except Exception as e:
+            self.sock.close()
+            raise Exception(f"Не удалось присоединиться к multicast группам: {str(e)}")
+
+        # Рассылка в сегмент - с отдельного сокета и в потоке отправки
+        self.out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.out.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, struct.pack('b', 1))
+        self.out.setblocking(False)
+        self.scheduler = SendScheduler(self.out, None, self.metrics)
+        self.loop.add_reader(self.sock.fileno(), self.on_readable)
+
+        self.listener = None
+        if listen is not None:
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listener.bind(listen)
+            self.listener.listen(self.BACKLOG)
+            self.listener.setblocking(False)
+            self.loop.add_reader(self.listener.fileno(), self.on_accept)
+        for address in peers:
+            self.dial(address)
+
+    def setup_metrics(self, metrics):
+        self.metrics = metrics
+        self.received = metrics.counter('chim_relay_received_total', "Кадры из своего сегмента")
+        self.relayed = metrics.counter('chim_relay_relayed_total', "Кадры от соседей")
+        self.injected = metrics.counter('chim_relay_injected_total', "Кадры соседей, разосланные в сегмент")
+        self.duplicates = metrics.counter(
+            'chim_relay_duplicates_total', "Повторные кадры: своё эхо и копии, пришедшие разными путями")
+        self.loops = metrics.counter('chim_relay_loops_total', "Кадры, вернувшиеся по петле соседей")
+        self.peer_drops = metrics.counter('chim_relay_peer_drops_total', "Кадры, не поставленные медленному соседу")
+        self.foreign = metrics.counter(
+            'chim_relay_foreign_total', "Датаграммы не в формате Chim или для чужих групп")
+        self.rejected = metrics.counter('chim_relay_rejected_total', "Соединения с адресов вне allow")
+        self.receive_errors = metrics.counter('chim_relay_receive_errors_total', "Ошибки чтения сокета")
+        metrics.gauge('chim_relay_peers', "Соединения с соседями", lambda: len(self.connections))
+
+    # Соседи
+
+    def on_accept(self):
+        try:
+            sock, address = self.listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        if self.allow is not None and address[0] not in self.allow:
+            self.rejected.inc()
+            sock.close()
+            return
+        sock.setblocking(False)
+        self.add_connection(Connection(self.loop, sock, self.on_peer_message, self.on_peer_closed, None))
+
+    def dial(self, address):
+        if not self.running:
+            return
+        try:
+            connection = Connection.connect(self.loop, address, self.on_peer_message,
+                                            lambda connection: self.on_peer_closed(connection, address), None)
+        except OSError:
+            self.loop.call_later(self.RECONNECT, lambda: self.dial(address))
+            return
+        self.add_connection(connection)
+
+    def add_connection(self, connection):
+        connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connections[connection] = None
+        connection.send(RELAY_HELLO, RELAY_ID.pack(self.relay_id))
+
+    def on_peer_closed(self, connection, address=None):
+        self.connections.pop(connection, None)
+        self.flush_pending.discard(connection)
+        if address is not None and self.running:
+            self.loop.call_later(self.RECONNECT, lambda: self.dial(address))
+
+    def on_peer_message(self, connection, kind, body):
+        try:
+            if kind == RELAY_DATAGRAM:
+                self.on_relayed(connection, body)
+            elif kind == RELAY_HELLO:
+                peer = RELAY_ID.unpack_from(body)[0]
+                # Адрес в peers указал на этот же ретранслятор
+                if peer == self.relay_id:
+                    connection.close()
+                    return
+                self.connections[connection] = peer
+        except struct.error:
+            connection.close()
+
+    def on_relayed(self, source, body):
+        origin, seq, hops, address = RELAY_HEADER.unpack_from(body)
+        # Группа приходит от соседа: рассылка только в свои группы, иначе
+        # порт соседей превращается в отправку UDP на любой адрес
+        if address not in self.groups:
+            self.foreign.inc()
+            return
+        if origin == self.relay_id or self.flood_seen.seen(origin, seq):
+            self.loops.inc()
+            return
+        self.relayed.inc()
+        data = body[RELAY_HEADER.size:]
+        if hops < self.MAX_HOPS and len(self.connections) > 1:
+            self.forward(RELAY_HEADER.pack(origin, seq, hops + 1, address) + data, source)
+        key = frame_key(data, address)
+        if key is None:
+            self.foreign.inc()
+            return
+        if not self.recent.add(key):
+            self.duplicates.inc()
+            return
+        self.scheduler.put(data, (socket.inet_ntoa(address), self.port),
+                           PRIORITY_OF.get(data[1], PRIORITY_CONTROL))
+        self.injected.inc()
+
+    def forward(self, message, source=None):
+        """Постановка метки с датаграммой всем соседям, кроме source"""
+        for connection in self.connections:
+            if connection is source:
+                continue
+            if connection.backlog() > self.PEER_BACKLOG:
+                self.peer_drops.inc()
+                continue
+            connection.send(RELAY_DATAGRAM, message, flush=False)
+            if not self.flush_pending:
+                self.loop.call_later(0, self.flush_peers)
+            self.flush_pending.add(connection)
+
+    def flush_peers(self):
+        connections, self.flush_pending = self.flush_pending, set()
+        for connection in connections:
+            # До установки соединения буфер допишет обработчик записи Connection
+            if not connection.closed and not connection.connecting:
+                connection.on_writable()
+
+    # Свой сегмент
+
+    def on_readable(self):
+        buffer = self.buffer
+        view = self.view
+        address = self.single
+        for _ in range(self.RECV_BATCH):
+            try:
+                if address is None:
+                    size, ancillary, _, _ = self.sock.recvmsg_into([buffer], PKTINFO_SPACE)
+                    group = self.group_of(ancillary)
+                else:
+                    size = self.sock.recv_into(buffer)
+                    group = address
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                if not self.running:
+                    return
+                self.receive_errors.inc()
+                break
+            if group is None:
+                continue
+            data = bytes(view[:size])
+            key = frame_key(data, group)
+            if key is None:
+                self.foreign.inc()
+                continue
+            if not self.recent.add(key):
+                self.duplicates.inc()
+                continue
+            self.received.inc()
+            if self.connections:
+                self.seq = (self.seq + 1) & 0xFFFFFFFF
+                self.forward(RELAY_HEADER.pack(self.relay_id, self.seq, 1, group) + data)
+
+    def group_of(self, ancillary):
+        for level, kind, data in ancillary:
+            if level == socket.IPPROTO_IP and kind == IP_PKTINFO:
+                group = bytes(data[PKTINFO_ADDR])
+                return group if group in self.groups else None
+        return None
+
+    def close(self):
+        self.running = False
+        for connection in list(self.connections):
+            connection.close()
+        if self.listener is not None:
+            self.loop.remove_reader(self.listener.fileno())
+            self.listener.close()
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        self.scheduler.close()
+        self.out.close()
@@ -0,0 +1,250 @@
+"""Надёжная доставка поверх multicast на основе NACK
+
+Отправитель хранит последние кадры в кольцевом буфере фиксированного
+размера. Получатель отслеживает порядковые номера каждого отправителя и
+при обнаружении пропуска через случайную задержку рассылает NACK в группу.
+Услышав чужой NACK на те же номера, получатель откладывает свой, а
+отправитель отвечает на повторные запросы одного номера не чаще раза за
+holdoff секунд - поэтому сотня получателей, потерявших один пакет,
+вызывает одну повторную передачу.
+"""
+import random
+import struct
+import time
+
+from modules.protocol import ProtocolError
+
+NACK_HEADER = struct.Struct('!QB')
+NACK_RANGE = struct.Struct('!IH')
+MAX_NACK_RANGES = 64
+
+# Счётчики Reliability.stats()
+STAT_KEYS = ('gaps', 'recovered', 'lost', 'duplicates', 'nacks_sent', 'nacks_suppressed',
+             'nacks_received', 'retransmits', 'retransmits_suppressed', 'unrecoverable')
+
+
+def encode_nack(target, ranges):
+    """Полезная нагрузка NACK: отправитель и диапазоны (начало, количество)"""
+    ranges = ranges[:MAX_NACK_RANGES]
+    parts = [NACK_HEADER.pack(target, len(ranges))]
+    for start, count in ranges:
+        parts.append(NACK_RANGE.pack(start, count))
+    return b''.join(parts)
+
+
+def decode_nack(payload):
+    if len(payload) < NACK_HEADER.size:
+        raise ProtocolError("NACK обрезан")
+    target, count = NACK_HEADER.unpack_from(payload)
+    offset = NACK_HEADER.size
+    if offset + count * NACK_RANGE.size > len(payload):
+        raise ProtocolError("NACK обрезан")
+    ranges = []
+    for _ in range(count):
+        ranges.append(NACK_RANGE.unpack_from(payload, offset))
+        offset += NACK_RANGE.size
+    return target, ranges
+
+
+def to_ranges(seqs):
+    """Сжатие отсортированных номеров в диапазоны (начало, количество)"""
+    ranges = []
+    for seq in seqs:
+        if ranges and ranges[-1][0] + ranges[-1][1] == seq and ranges[-1][1] < 0xFFFF:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([seq, 1])
+    return [tuple(r) for r in ranges]
+
+
+class RetransmitRing:
+    """Кольцо последних отправленных датаграмм с предвыделенными слотами"""
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.seqs = [0] * capacity
+        self.datagrams = [None] * capacity
+        self.resent_at = [float('-inf')] * capacity
+
+    def store(self, seq, datagram):
+        slot = seq % self.capacity
+        self.seqs[slot] = seq
+        self.datagrams[slot] = datagram
+        self.resent_at[slot] = float('-inf')
+
+    def get(self, seq):
+        slot = seq % self.capacity
+        if self.seqs[slot] != seq:
+            return None
+        return self.datagrams[slot]
+
+
+class _SenderState:
+    __slots__ = ('expected', 'missing', 'nack_due', 'last_seen')
+
+    def __init__(self, expected, now):
+        self.expected = expected
+        # номер -> число уже отправленных NACK
+        self.missing = {}
+        self.nack_due = None
+        self.last_seen = now
+
+
+class Reliability:
+    """Учёт потерь, рассылка NACK и ответы на них
+
+    send_nack(payload) отправляет NACK в группу, resend(datagram) -
+    сохранённую датаграмму.
+    """
+
+    def __init__(self, sender_id, send_nack, resend, ring_size=1024,
+                 nack_delay=(0.01, 0.1), retry_interval=0.25, max_retries=5,
+                 holdoff=0.2, max_gap=512, max_senders=4096,
+                 clock=time.monotonic, rng=None):
+        self.sender_id = sender_id
+        self.send_nack = send_nack
+        self.resend = resend
+        self.ring = RetransmitRing(ring_size)
+        self.nack_delay = nack_delay
+        self.retry_interval = retry_interval
+        self.max_retries = max_retries
+        self.holdoff = holdoff
+        self.max_gap = max_gap
+        self.max_senders = max_senders
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self.senders = {}
+        self.pending = set()
+
+        # Счётчики для настройки
+        self.gaps = 0
+        self.recovered = 0
+        self.lost = 0
+        self.duplicates = 0
+        self.nacks_sent = 0
+        self.nacks_suppressed = 0
+        self.nacks_received = 0
+        self.retransmits = 0
+        self.retransmits_suppressed = 0
+        self.unrecoverable = 0
+
+    def stats(self):
+        return {key: getattr(self, key) for key in STAT_KEYS}
+
+    def sent(self, seq, datagram):
+        """Запоминание отправленной датаграммы для повторной передачи"""
+        self.ring.store(seq, datagram)
+
+    def accept(self, sender, seq):
+        """Учёт принятого номера; False для дубликата"""
+        now = self.clock()
+        state = self.senders.get(sender)
+        if state is None:
+            if len(self.senders) >= self.max_senders:
+                self._forget_oldest()
+            # История до подключения не запрашивается
+            self.senders[sender] = _SenderState(seq + 1, now)
+            return True
+        state.last_seen = now
+
+        if seq == state.expected:
+            state.expected += 1
+            return True
+
+        if seq > state.expected:
+            gap_start = max(state.expected, seq - self.max_gap)
+            self.lost += gap_start - state.expected
+            for missing in range(gap_start, seq):
+                state.missing[missing] = 0
+            self.gaps += seq - gap_start
+            state.expected = seq + 1
+            if len(state.missing) > self.max_gap:
+                for old in sorted(state.missing)[:len(state.missing) - self.max_gap]:
+                    del state.missing[old]
+                    self.lost += 1
+            if state.missing and state.nack_due is None:
+                state.nack_due = now + self.rng.uniform(*self.nack_delay)
+                self.pending.add(sender)
+            return True
+
+        if state.missing.pop(seq, None) is not None:
+            self.recovered += 1
+            if not state.missing:
+                state.nack_due = None
+                self.pending.discard(sender)
+            return True
+
+        self.duplicates += 1
+        return False
+
+    def on_nack(self, payload):
+        """Обработка NACK: ответ на свой или подавление собственного"""
+        target, ranges = decode_nack(payload)
+        now = self.clock()
+        if target == self.sender_id:
+            self.nacks_received += 1
+            ring = self.ring
+            for start, count in ranges:
+                for seq in range(start, start + count):
+                    datagram = ring.get(seq)
+                    if datagram is None:
+                        self.unrecoverable += 1
+                        continue
+                    slot = seq % ring.capacity
+                    if now - ring.resent_at[slot] < self.holdoff:
+                        self.retransmits_suppressed += 1
+                        continue
+                    ring.resent_at[slot] = now
+                    self.resend(datagram)
+                    self.retransmits += 1
+            return
+
+        # Чужой NACK: если он покрывает все наши пропуски, ждём повтора
+        state = self.senders.get(target)
+        if state is None or state.nack_due is None:
+            return
+        covered = 0
+        for start, count in ranges:
+            for seq in range(start, start + count):
+                if seq in state.missing:
+                    covered += 1
+        if covered == len(state.missing):
+            state.nack_due = now + self.retry_interval
+            for seq in state.missing:
+                state.missing[seq] += 1
+            self.nacks_suppressed += 1
+
+    def next_timeout(self):
+        """Время до ближайшего NACK или None, если ждать нечего"""
+        if not self.pending:
+            return None
+        due = min(self.senders[sender].nack_due for sender in self.pending)
+        return max(0.0, due - self.clock())
+
+    def tick(self):
+        """Рассылка NACK, срок которых наступил"""
+        if not self.pending:
+            return
+        now = self.clock()
+        for sender in list(self.pending):
+            state = self.senders[sender]
+            if state.nack_due > now:
+                continue
+            for seq, retries in list(state.missing.items()):
+                if retries >= self.max_retries:
+                    del state.missing[seq]
+                    self.lost += 1
+                else:
+                    state.missing[seq] = retries + 1
+            if not state.missing:
+                state.nack_due = None
+                self.pending.discard(sender)
+                continue
+            self.send_nack(encode_nack(sender, to_ranges(sorted(state.missing))))
+            self.nacks_sent += 1
+            state.nack_due = now + self.retry_interval
+
+    def _forget_oldest(self):
+        sender = min(self.senders, key=lambda s: self.senders[s].last_seen)
+        del self.senders[sender]
+        self.pending.discard(sender)
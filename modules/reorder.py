@@ -0,0 +1,77 @@
+"""Окно переупорядочения входящих сообщений
+
+Кадр, восстановленный повтором по NACK или пришедший через
+ретранслятор, опаздывает на десятки миллисекунд и обгоняется более
+поздними. ReorderBuffer держит каждое сообщение delay секунд с прихода
+и выпускает пачками по возрастанию ключа - метки гибридных часов
+(modules/clock.py), поэтому порядок выпуска не нарушает причинности.
+
+Сообщение не выходит раньше меньшего по ключу, пришедшего позже, так что
+ожидание не превышает 2 * delay. Опоздавшие сверх окна выпускаются как
+есть и считаются в late: место в списке им находит получатель.
+"""
+import heapq
+import itertools
+import time
+
+
+class ReorderBuffer:
+    """Выпуск элементов release(пачка) по возрастанию ключа через delay секунд
+
+    Работает в цикле событий loop (modules/loop.py или QtLoop). delay=0
+    выключает окно; при limit ожидающих самые ранние выпускаются сразу.
+    """
+
+    def __init__(self, loop, release, delay=0.15, limit=4096, clock=time.monotonic):
+        self.loop = loop
+        self.release = release
+        self.delay = delay
+        self.limit = limit
+        self.clock = clock
+        # (ключ, срок, порядок прихода, элемент)
+        self.heap = []
+        self.order = itertools.count()
+        self.timer = None
+        self.released = None
+        self.late = 0
+
+    def put(self, key, item):
+        if self.released is not None and key < self.released:
+            self.late += 1
+        if not self.delay:
+            self.released = key
+            self.release([item])
+            return
+        heapq.heappush(self.heap, (key, self.clock() + self.delay, next(self.order), item))
+        if len(self.heap) > self.limit:
+            self.flush()
+        elif self.timer is None:
+            self.schedule()
+
+    def schedule(self):
+        if self.heap:
+            self.timer = self.loop.call_later(max(0.0, self.heap[0][1] - self.clock()), self.flush)
+
+    def flush(self, everything=False):
+        """Выпуск сообщений, чей срок истёк и перед которыми нет ждущих"""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        now = self.clock()
+        heap = self.heap
+        batch = []
+        while heap and (everything or heap[0][1] <= now or len(heap) > self.limit):
+            key, _, _, item = heapq.heappop(heap)
+            if self.released is None or key > self.released:
+                self.released = key
+            batch.append(item)
+        if batch:
+            self.release(batch)
+        self.schedule()
+
+    def close(self):
+        """Выпуск всего ожидающего, например перед закрытием истории"""
+        self.flush(everything=True)
+
+    def __len__(self):
+        return len(self.heap)
@@ -0,0 +1,116 @@
+"""Кольцевой буфер в разделяемой памяти: один писатель, один читатель
+
+Заголовок сегмента - позиция записи, позиция чтения (всего байт с начала
+работы) и размер области данных, за ним байт состояния писателя.
+Запись - длина (4 байта) и тело. Запись, которая не помещается до конца
+области, начинается с её начала, а остаток помечается WRAP.
+
+Писатель публикует позицию записи только после того, как тело записано,
+читатель - позицию чтения после того, как тело скопировано, поэтому
+блокировки не нужны: каждая позиция меняется только одной стороной, а
+выровненная 8-байтовая запись позиции на x86-64 и ARM64 атомарна.
+"""
+import struct
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+HEADER = struct.Struct('=QQQ')
+STATE_OFFSET = HEADER.size
+DATA_OFFSET = 64
+LENGTH = struct.Struct('=I')
+WRAP = 0xFFFFFFFF
+
+
+class SharedRing:
+    """Кольцо в сегменте name; без name создаётся новый сегмент
+
+    Создатель сегмента удаляет его в close(), подключившийся - только
+    отключается.
+    """
+
+    def __init__(self, name=None, capacity=8 * 1024 * 1024):
+        if name is None:
+            self.shm = SharedMemory(create=True, size=DATA_OFFSET + capacity)
+            HEADER.pack_into(self.shm.buf, 0, 0, 0, capacity)
+            self.shm.buf[STATE_OFFSET] = 0
+            self.owner = True
+        else:
+            self.shm = SharedMemory(name=name)
+            # До Python 3.13 подключение регистрирует сегмент в resource_tracker
+            # этого процесса, и тот удалил бы его при выходе, хотя сегмент
+            # принадлежит другому процессу
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+            self.owner = False
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        self.capacity = HEADER.unpack_from(self.buf)[2]
+        self.dropped = 0
+
+    @property
+    def state(self):
+        """Байт состояния, который писатель сообщает читателю"""
+        return self.buf[STATE_OFFSET]
+
+    @state.setter
+    def state(self, value):
+        self.buf[STATE_OFFSET] = value
+
+    def __len__(self):
+        head, tail, _ = HEADER.unpack_from(self.buf)
+        return head - tail
+
+    def put(self, data):
+        """Запись (писатель); True, если читатель всё прочитал и его нужно разбудить
+
+        Если места нет, запись отбрасывается и учитывается в dropped.
+        """
+        buf = self.buf
+        capacity = self.capacity
+        head, tail, _ = HEADER.unpack_from(buf)
+        size = LENGTH.size + len(data)
+        position = head % capacity
+        skip = capacity - position if capacity - position < size else 0
+        if skip + size > capacity - (head - tail):
+            self.dropped += 1
+            return False
+        start = head
+        if skip:
+            if skip >= LENGTH.size:
+                LENGTH.pack_into(buf, DATA_OFFSET + position, WRAP)
+            head += skip
+            position = 0
+        offset = DATA_OFFSET + position
+        LENGTH.pack_into(buf, offset, len(data))
+        buf[offset + LENGTH.size:offset + size] = data
+        struct.pack_into('=Q', buf, 0, head + size)
+        # Позиция чтения перечитывается после публикации: читатель, который
+        # сдвинул её раньше, увидит и новую запись или получит пробуждение
+        return struct.unpack_from('=Q', buf, 8)[0] == start
+
+    def get(self):
+        """Следующая запись (читатель) или None, если кольцо пусто"""
+        buf = self.buf
+        capacity = self.capacity
+        while True:
+            head, tail, _ = HEADER.unpack_from(buf)
+            if tail >= head:
+                return None
+            position = tail % capacity
+            remaining = capacity - position
+            if remaining >= LENGTH.size:
+                length = LENGTH.unpack_from(buf, DATA_OFFSET + position)[0]
+                if length != WRAP:
+                    offset = DATA_OFFSET + position + LENGTH.size
+                    data = bytes(buf[offset:offset + length])
+                    struct.pack_into('=Q', buf, 8, tail + LENGTH.size + length)
+                    return data
+            struct.pack_into('=Q', buf, 8, tail + remaining)
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,199 @@
+"""Очередь отправки с приоритетами и ограничением скорости
+
+Датаграммы отправляет отдельный поток, а не поток цикла событий (в окне
+чата - поток интерфейса): вызывающий только кладёт датаграмму в очередь
+её приоритета. Поток выбирает очереди строго по порядку - служебные
+кадры (NACK, повторы, сигналы присутствия), затем чат, затем массовые
+данные (файлы) - и расходует общую корзину токенов rate байт в секунду,
+чтобы клиент не занимал сеть сверх заданного бюджета.
+
+Пока очереди пусты и бюджет позволяет, датаграмма уходит сразу из
+вызывающего потока неблокирующим sendto - без передачи GIL потоку
+отправки. Когда буфер ядра полон, ждёт поток отправки, а не интерфейс. О
+перегрузке вызывающий узнаёт из congested() и free(): передача файла
+притормаживает сама, а переполненная очередь отвергает новые датаграммы.
+
+В модуле socket нет sendmmsg, поэтому системный вызов остаётся на каждую
+датаграмму; за одно пробуждение поток отправляет всё, что накопилось и
+позволяет корзина, без возврата к ожиданию.
+"""
+import select
+import threading
+import time
+from collections import deque
+
+from modules.metrics import REGISTRY
+
+PRIORITY_CONTROL = 0
+PRIORITY_CHAT = 1
+PRIORITY_BULK = 2
+PRIORITY_NAMES = ('control', 'chat', 'bulk')
+
+# Бюджет отправки по умолчанию, байт в секунду (100 Мбит/с)
+DEFAULT_SEND_RATE = 100 * 1000 * 1000 // 8
+
+
+class SendScheduler:
+    """Поток отправки датаграмм sock по очередям приоритетов
+
+    put() можно вызывать из любого потока. rate=None отключает
+    ограничение скорости.
+    """
+
+    # Предел очереди, датаграмм
+    LIMITS = (65536, 16384, 4096)
+    # Очередь считается перегруженной с этой длины
+    HIGH_WATER = (4096, 1024, 64)
+    BURST = 64 * 1024
+    # Ожидание места в буфере ядра
+    WRITABLE_TIMEOUT = 0.1
+    # Сколько close() ждёт поток, досылающий служебные кадры
+    CLOSE_TIMEOUT = 0.05
+
+    def __init__(self, sock, rate=DEFAULT_SEND_RATE, metrics=None):
+        self.sock = sock
+        self.rate = rate
+        self.queues = tuple(deque() for _ in PRIORITY_NAMES)
+        self.tokens = self.BURST
+        self.updated = time.monotonic()
+        self.running = True
+        self.wakeup = threading.Event()
+        # Поток отправки держит датаграмму: прямая отправка её бы обогнала.
+        # Корзину трогает только тот, кто держит lock при busy=False, или поток
+        self.busy = False
+        self.lock = threading.Lock()
+
+        metrics = REGISTRY if metrics is None else metrics
+        self.datagrams_sent = metrics.counter('chim_datagrams_sent_total', "Отправлено датаграмм")
+        self.bytes_sent = metrics.counter('chim_bytes_sent_total', "Отправлено байт")
+        self.send_deferred = metrics.counter(
+            'chim_send_deferred_total', "Датаграммы, ждавшие места в буфере отправки")
+        self.send_errors = metrics.counter('chim_send_errors_total', "Ошибки отправки")
+        self.rejected = metrics.counter('chim_send_rejected_total', "Датаграммы, не принятые в переполненную очередь")
+        self.dropped = metrics.counter('chim_send_dropped_total', "Датаграммы чата и данных, отброшенные при закрытии")
+        self.paced = metrics.counter('chim_send_paced_seconds_total', "Ожидание по бюджету скорости, секунды")
+        for priority, name in enumerate(PRIORITY_NAMES):
+            metrics.gauge(f'chim_send_queue_{name}', f"Датаграммы в очереди отправки ({name})",
+                          lambda priority=priority: len(self.queues[priority]))
+
+        self.thread = threading.Thread(target=self._run, name='send-scheduler', daemon=True)
+        self.thread.start()
+
+    def put(self, data, address, priority=PRIORITY_CONTROL):
+        """Постановка датаграммы в очередь; False - очередь переполнена"""
+        queue = self.queues[priority]
+        if len(queue) >= self.LIMITS[priority]:
+            self.rejected.inc()
+            return False
+        with self.lock:
+            if not self.busy and not self.pending() and self._take(len(data)):
+                try:
+                    self.sock.sendto(data, address)
+                    self.datagrams_sent.inc()
+                    self.bytes_sent.inc(len(data))
+                    return True
+                except (BlockingIOError, InterruptedError):
+                    self.tokens += len(data)
+                    self.send_deferred.inc()
+                except OSError:
+                    self.send_errors.inc()
+                    return True
+            queue.append((data, address))
+        self.wakeup.set()
+        return True
+
+    def free(self, priority):
+        """Сколько датаграмм ещё примет очередь"""
+        return self.LIMITS[priority] - len(self.queues[priority])
+
+    def congested(self, priority):
+        return len(self.queues[priority]) >= self.HIGH_WATER[priority]
+
+    def pending(self):
+        return sum(len(queue) for queue in self.queues)
+
+    def close(self, timeout=None):
+        """Остановка потока
+
+        Досылаются только служебные кадры (NACK, повторы, уход) и без
+        ограничения скорости; очереди чата и массовых данных отбрасываются.
+        Закрытие идёт из потока интерфейса, поэтому поток ждём не дольше
+        timeout (по умолчанию CLOSE_TIMEOUT).
+        """
+        with self.lock:
+            self.running = False
+            for queue in self.queues[PRIORITY_CONTROL + 1:]:
+                self.dropped.inc(len(queue))
+                queue.clear()
+        self.wakeup.set()
+        self.thread.join(self.CLOSE_TIMEOUT if timeout is None else timeout)
+
+    def _run(self):
+        while True:
+            self.wakeup.wait()
+            # Флаг сбрасывается до разбора: датаграмма, поставленная во время
+            # разбора, либо уйдёт в этом проходе, либо разбудит поток снова
+            self.wakeup.clear()
+            while True:
+                item = self._next()
+                if item is None:
+                    break
+                data, address = item
+                if self.running:
+                    self._pace(len(data))
+                if not self._send(data, address):
+                    return
+            if not self.running:
+                return
+
+    def _next(self):
+        with self.lock:
+            # После close() остаются только служебные кадры
+            for queue in self.queues if self.running else self.queues[:PRIORITY_CONTROL + 1]:
+                if queue:
+                    self.busy = True
+                    return queue.popleft()
+            self.busy = False
+            return None
+
+    def _take(self, size):
+        """Списание size байт из корзины, если они там есть"""
+        if self.rate is None:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.BURST, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= size:
+            self.tokens -= size
+            return True
+        return False
+
+    def _pace(self, size):
+        while self.running and not self._take(size):
+            # Пересчёт по часам после сна учитывает и пересып
+            delay = (size - self.tokens) / self.rate
+            self.paced.inc(delay)
+            time.sleep(delay)
+
+    def _send(self, data, address):
+        """Отправка с ожиданием места в буфере; False - сокет закрыт"""
+        deferred = False
+        while True:
+            try:
+                self.sock.sendto(data, address)
+                self.datagrams_sent.inc()
+                self.bytes_sent.inc(len(data))
+                return True
+            except (BlockingIOError, InterruptedError):
+                if not deferred:
+                    deferred = True
+                    self.send_deferred.inc()
+                try:
+                    select.select((), (self.sock,), (), self.WRITABLE_TIMEOUT)
+                except (OSError, ValueError):
+                    return False
+            except OSError:
+                if not self.running or self.sock.fileno() < 0:
+                    return False
+                self.send_errors.inc()
+                return True
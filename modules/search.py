@@ -0,0 +1,387 @@
+"""Инкрементальный полнотекстовый индекс по истории сообщений
+
+Инвертированный индекс хранит для каждого слова отсортированный массив
+номеров записей истории. Слова выделяются по \\w+ (кириллица, латиница,
+цифры), приводятся через casefold, а "ё" заменяется на "е". Позиции слов
+не хранятся: фразы проверяются по тексту только у кандидатов, прошедших
+пересечение массивов, начиная с самых новых.
+
+Пересечение идёт от новых номеров к старым: самый короткий массив ведёт,
+в остальных следующий номер ищется галопом и двоичным поиском, и обход
+останавливается, как только набрано limit результатов. Стоимость
+запроса зависит от limit и от того, насколько редко слова встречаются
+вместе, а не от длины массивов.
+
+Синтаксис запроса:
+
+    сервер упал        оба слова
+    перезап*           слова с префиксом
+    "сервер упал"      фраза
+    10.0.0.15          то же, что фраза "10 0 0 15"
+
+Индекс сохраняется в один файл рядом с историей. Загрузка идёт в фоновом
+потоке; там же индексируются записи, добавленные в историю после
+последнего сохранения, а сообщения, пришедшие до окончания загрузки,
+ставятся в очередь. Сохранение тоже фоновое: вызывающий поток только
+запоминает массивы и их длины, а кодирует и пишет файл поток записи.
+"""
+import bisect
+import itertools
+import os
+import re
+import struct
+import threading
+from array import array
+
+WORD = re.compile(r'\w+')
+QUERY = re.compile(r'"([^"]*)"|(\S+)')
+
+MAGIC = b'CHIMIDX1'
+FILE_HEADER = struct.Struct('<8sQI')
+TERM_HEADER = struct.Struct('<HI')
+
+# Более длинные "слова" (base64, мусор) не индексируются
+MAX_TERM = 64
+# Сколько терминов раскрывает один префикс и сколько кандидатов проверяется
+MAX_PREFIX_TERMS = 2048
+MAX_VERIFY = 5000
+# Кандидаты фразы читаются из истории пачками от VERIFY_FIRST до
+# VERIFY_BATCH за одно открытие сегмента, соседние номера - одним куском
+VERIFY_FIRST = 16
+VERIFY_BATCH = 256
+# Больше любого номера записи в array('I')
+NO_LIMIT = 1 << 32
+
+
+def normalize(text):
+    return text.casefold().replace('ё', 'е')
+
+
+def tokenize(text):
+    return [word for word in WORD.findall(normalize(text)) if len(word) <= MAX_TERM]
+
+
+def contains_phrase(tokens, phrase):
+    size = len(phrase)
+    first = phrase[0]
+    for index in range(len(tokens) - size + 1):
+        if tokens[index] == first and tokens[index:index + size] == phrase:
+            return True
+    return False
+
+
+def index_text(postings, number, text):
+    """Номер записи в массивы её слов; список впервые встреченных слов"""
+    created = []
+    for term in set(tokenize(text)):
+        ids = postings.get(term)
+        if ids is None:
+            ids = postings[term] = array('I')
+            created.append(term)
+        ids.append(number)
+    return created
+
+
+class Cursor:
+    """Отсортированный массив номеров, читаемый от новых к старым"""
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.hi = len(ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def floor(self, number):
+        """Наибольший номер не больше number или -1; number не должен расти"""
+        ids = self.ids
+        hi = self.hi
+        if not hi:
+            return -1
+        if ids[hi - 1] <= number:
+            return ids[hi - 1]
+        # Галоп назад от прошлой позиции, затем двоичный поиск в найденном отрезке
+        bound = hi - 1
+        step = 1
+        while bound - step >= 0 and ids[bound - step] > number:
+            bound -= step
+            step <<= 1
+        index = bisect.bisect_right(ids, number, max(0, bound - step), bound)
+        self.hi = index
+        return ids[index - 1] if index else -1
+
+
+class UnionCursor:
+    """Объединение массивов слов одного префикса без слияния в память"""
+
+    def __init__(self, lists):
+        self.cursors = [Cursor(ids) for ids in lists]
+        self.size = sum(len(ids) for ids in lists)
+
+    def __len__(self):
+        return self.size
+
+    def floor(self, number):
+        return max(cursor.floor(number) for cursor in self.cursors)
+
+
+def newest_common(cursors, first=0):
+    """Номера, общие для всех курсоров, от новых к старым, не меньше first
+
+    cursors отсортированы по длине: первый, самый короткий, ведёт, а
+    остальные проверяют его номер или опускают кандидата до своего.
+    """
+    leader, others = cursors[0], cursors[1:]
+    number = leader.floor(NO_LIMIT)
+    while number >= first:
+        found = number
+        for cursor in others:
+            found = cursor.floor(number)
+            if found != number:
+                break
+        else:
+            yield number
+            found = number - 1
+        number = leader.floor(found)
+
+
+def parse_query(query):
+    """Разбор запроса: (слова, префиксы, фразы)"""
+    terms, prefixes, phrases = [], [], []
+    for match in QUERY.finditer(query):
+        quoted, word = match.groups()
+        if quoted is not None:
+            tokens = tokenize(quoted)
+            prefix = False
+        else:
+            prefix = word.endswith('*')
+            tokens = tokenize(word)
+        if not tokens:
+            continue
+        if prefix:
+            prefixes.append(tokens.pop())
+        terms.extend(tokens)
+        if len(tokens) > 1:
+            phrases.append(tokens)
+    return terms, prefixes, phrases
+
+
+class SearchIndex:
+    def __init__(self, path, history=None):
+        self.path = path
+        self.history = history
+        self.postings = {}
+        self.terms = []
+        self.new_terms = set()
+        self.indexed_upto = 0
+        self.unsaved = 0
+
+        self.loaded = threading.Event()
+        self.ready = False
+        self.pending = []
+        self.loaded_state = None
+        # Поток последнего сохранения: следующее ждёт его, чтобы файлы не пошли вразнобой
+        self.saving = None
+        # Записи истории, уже лежавшие на диске до открытия индекса
+        self.catch_up_end = history.end() if history is not None else 0
+
+    def load_async(self):
+        threading.Thread(target=self._load, name='search-load', daemon=True).start()
+
+    def load(self):
+        self._load()
+        self._activate()
+
+    def _load(self):
+        postings = {}
+        indexed_upto = 0
+        try:
+            with open(self.path, 'rb') as index_file:
+                data = index_file.read()
+            magic, indexed_upto, count = FILE_HEADER.unpack_from(data)
+            if magic != MAGIC:
+                raise ValueError("Неизвестный формат индекса")
+            offset = FILE_HEADER.size
+            for _ in range(count):
+                term_size, docs = TERM_HEADER.unpack_from(data, offset)
+                offset += TERM_HEADER.size
+                term = data[offset:offset + term_size].decode('utf-8')
+                offset += term_size
+                ids = array('I')
+                ids.frombytes(data[offset:offset + docs * ids.itemsize])
+                offset += docs * ids.itemsize
+                postings[term] = ids
+        except (OSError, ValueError, struct.error, UnicodeDecodeError):
+            # Нет файла или он повреждён - перестроим по истории
+            postings = {}
+            indexed_upto = 0
+        caught_up = 0
+        if self.history is not None:
+            if indexed_upto > self.catch_up_end:
+                # Индекс новее истории (история удалена или обрезана) - строим заново
+                postings, indexed_upto = {}, 0
+            # Записи после последнего сохранения индексируются здесь же, в
+            # фоне: их может быть до SEARCH_SAVE_EVERY окна
+            start = max(indexed_upto, self.history.first())
+            while start < self.catch_up_end:
+                stop = min(self.catch_up_end, start + 4096)
+                for number, message in enumerate(self.history.read(start, stop), start):
+                    index_text(postings, number, message.text)
+                    caught_up += 1
+                start = stop
+            indexed_upto = max(indexed_upto, self.catch_up_end)
+        self.loaded_state = (postings, sorted(postings), indexed_upto, caught_up)
+        self.loaded.set()
+
+    def _activate(self):
+        """Подключение загруженного индекса в потоке интерфейса"""
+        if self.ready or not self.loaded.is_set():
+            return self.ready
+        self.postings, self.terms, self.indexed_upto, self.unsaved = self.loaded_state
+        self.loaded_state = None
+        self.ready = True
+        pending, self.pending = self.pending, []
+        for number, text in pending:
+            self.add(number, text)
+        return True
+
+    def add(self, number, text):
+        """Индексация записи истории с номером number"""
+        if not self.ready:
+            if not self._activate():
+                self.pending.append((number, text))
+                return
+        if number < self.indexed_upto:
+            return
+        self.new_terms.update(index_text(self.postings, number, text))
+        self.indexed_upto = number + 1
+        self.unsaved += 1
+
+    def is_loaded(self):
+        """Готов ли индекс к поиску; загруженный подключается здесь же"""
+        return self._activate()
+
+    def search(self, query, limit=100, first=0):
+        """Номера подходящих записей, от новых к старым
+
+        Загрузку не ждёт: пока is_loaded() ложно, результатов нет.
+        """
+        if not self._activate():
+            return []
+        terms, prefixes, phrases = parse_query(query)
+        if not terms and not prefixes:
+            return []
+
+        cursors = []
+        for term in set(terms):
+            ids = self.postings.get(term)
+            if ids is None:
+                return []
+            cursors.append(Cursor(ids))
+        for prefix in prefixes:
+            matched = self._expand_prefix(prefix)
+            if not matched:
+                return []
+            if len(matched) == 1:
+                cursors.append(Cursor(self.postings[matched[0]]))
+            else:
+                cursors.append(UnionCursor([self.postings[term] for term in matched]))
+
+        if len(cursors) == 1 and isinstance(cursors[0], Cursor) and not phrases:
+            # Одно слово: последние limit номеров массива
+            ids = cursors[0].ids
+            start = max(len(ids) - limit, bisect.bisect_left(ids, first))
+            return ids[start:].tolist()[::-1]
+
+        cursors.sort(key=len)
+        candidates = newest_common(cursors, first)
+        if not phrases or self.history is None:
+            return list(itertools.islice(candidates, limit))
+        results = []
+        candidates = itertools.islice(candidates, MAX_VERIFY)
+        # Пачки растут: если фраза находится сразу, лишние кандидаты не читаются
+        size = VERIFY_FIRST
+        while len(results) < limit:
+            batch = list(itertools.islice(candidates, size))
+            size = min(size * 2, VERIFY_BATCH)
+            if not batch:
+                break
+            for number, text in self._read_texts(batch):
+                tokens = tokenize(text)
+                if all(contains_phrase(tokens, phrase) for phrase in phrases):
+                    results.append(number)
+                    if len(results) >= limit:
+                        break
+        return results
+
+    def _read_texts(self, numbers):
+        """(номер, текст) для номеров по убыванию одним чтением истории
+
+        Идущие подряд номера сливаются в один диапазон; промежутки не
+        читаются, потому что разбор лишних записей дороже перехода по файлу.
+        """
+        ranges = []
+        start = 0
+        while start < len(numbers):
+            end = start + 1
+            while end < len(numbers) and numbers[end - 1] - numbers[end] == 1:
+                end += 1
+            ranges.append((numbers[end - 1], numbers[start] + 1))
+            start = end
+        texts = {message.number: message.text for message in self.history.read_ranges(ranges)}
+        return [(number, texts[number]) for number in numbers if number in texts]
+
+    def _expand_prefix(self, prefix):
+        if self.new_terms:
+            # Новые термины досортировываем только при префиксном поиске
+            self.terms = sorted(self.terms + list(self.new_terms))
+            self.new_terms.clear()
+        start = bisect.bisect_left(self.terms, prefix)
+        matched = []
+        for term in self.terms[start:start + MAX_PREFIX_TERMS]:
+            if not term.startswith(prefix):
+                break
+            matched.append(term)
+        return matched
+
+    def save(self, first=0):
+        """Атомарная запись индекса в фоне; записи с номерами меньше first в файл не идут
+
+        Здесь только снимок: массивы и их текущие длины. Массивы дальше
+        лишь дописываются в конец, поэтому первые len элементов потоку
+        записи хватает без копий. Старые номера в памяти остаются до
+        следующей загрузки, search() отсекает их по first. Поток записи не
+        фоновый: процесс при выходе дожидается файла. Возвращает поток.
+        """
+        if not self.ready:
+            return None
+        snapshot = [(term, ids, len(ids)) for term, ids in self.postings.items()]
+        self.saving = threading.Thread(target=self._write, name='search-save',
+                                       args=(snapshot, self.indexed_upto, first, self.saving))
+        self.saving.start()
+        self.unsaved = 0
+        return self.saving
+
+    def _write(self, snapshot, indexed_upto, first, previous):
+        if previous is not None:
+            previous.join()
+        parts = []
+        count = 0
+        for term, ids, size in snapshot:
+            start = bisect.bisect_left(ids, first, 0, size) if first else 0
+            if start >= size:
+                continue
+            term_data = term.encode('utf-8')
+            parts.append(TERM_HEADER.pack(len(term_data), size - start))
+            parts.append(term_data)
+            parts.append(ids[start:size].tobytes())
+            count += 1
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as index_file:
+                index_file.write(FILE_HEADER.pack(MAGIC, indexed_upto, count))
+                index_file.write(b''.join(parts))
+            os.replace(temp_path, self.path)
+        except OSError:
+            # Индекс - производная истории: без файла он перестроится при загрузке
+            pass
@@ -0,0 +1,485 @@
+"""Догрузка истории канала у других участников по TCP
+
+Клиент, запущенный посреди разговора, видит только то, что пришло после
+подключения. Клиенты с историей слушают TCP-порт и объявляют его в
+сигналах присутствия (modules/presence.py). Новичок спрашивает у
+нескольких случайных участников, что у них есть (SUMMARY), вычитает
+уже записанное в своей истории и делит недостающее между участниками,
+у которых оно есть, поровну (FETCH). Ответ идёт пачками записей истории,
+сжатыми zlib, по одному TCP-соединению, а не повтором кадров по
+multicast.
+
+Сообщение канала определяется парой (отправитель, номер кадра), поэтому
+и сводка, и запрос - диапазоны номеров по отправителям, те же
+(начало, количество), что в NACK.
+
+Сервер отдаёт только последние WINDOW записей канала и держит не больше
+MAX_SESSIONS запросов одновременно; запрос и сводка больше чем на WINDOW
+сообщений отклоняются, не разворачиваясь в память, остальным отвечает BUSY: их долю
+клиент перекладывает на других участников. Случайный выбор источников
+не даёт каждому новичку приходить к одному и тому же долгоживущему
+клиенту.
+"""
+import bisect
+import errno
+import random
+import socket
+import struct
+import zlib
+
+from modules.clock import order_key
+from modules.history import RECORD, decode_records
+from modules.metrics import REGISTRY
+from modules.protocol import ProtocolError
+from modules.reliability import to_ranges
+
+# Заголовок сообщения в потоке: вид, длина тела
+MESSAGE = struct.Struct('!BI')
+# Диапазон номеров: отправитель, первый номер, количество
+RANGE = struct.Struct('!QQH')
+
+# Запросы клиента: длина имени канала, имя, для FETCH - диапазоны
+REQ_SUMMARY = 1
+REQ_FETCH = 2
+# Ответы сервера
+SYNC_SUMMARY = 3
+SYNC_BATCH = 4
+SYNC_END = 5
+SYNC_BUSY = 6
+
+# Предел тела одного сообщения в потоке и распакованной пачки
+MAX_BODY = 4 * 1024 * 1024
+MAX_BATCH = 4 * 1024 * 1024
+# Размер пачки записей до сжатия
+BATCH_BYTES = 256 * 1024
+
+
+def encode_ranges(ranges):
+    return b''.join(RANGE.pack(sender, start, count) for sender, start, count in ranges)
+
+
+def decode_ranges(data):
+    if len(data) % RANGE.size:
+        raise ProtocolError("Список диапазонов обрезан")
+    return list(RANGE.iter_unpack(data))
+
+
+def encode_request(channel, ranges=()):
+    name = channel.encode('utf-8')
+    return bytes([len(name)]) + name + encode_ranges(ranges)
+
+
+def decode_request(body):
+    """(канал, диапазоны) из тела запроса"""
+    if not body or len(body) < 1 + body[0]:
+        raise ProtocolError("Запрос истории обрезан")
+    end = 1 + body[0]
+    return str(body[1:end], 'utf-8', 'replace'), decode_ranges(body[end:])
+
+
+def summarize(keys):
+    """Диапазоны (отправитель, начало, количество) по парам (отправитель, номер)"""
+    by_sender = {}
+    for sender, seq in keys:
+        by_sender.setdefault(sender, []).append(seq)
+    ranges = []
+    for sender, seqs in by_sender.items():
+        ranges.extend((sender, start, count) for start, count in to_ranges(sorted(seqs)))
+    return ranges
+
+
+def total(ranges):
+    return sum(count for _, _, count in ranges)
+
+
+def expand(ranges, limit):
+    """Множество пар (отправитель, номер) по не больше чем limit номерам"""
+    if len(ranges) > limit or total(ranges) > limit:
+        raise ProtocolError("Диапазонов истории больше допустимого")
+    return {(sender, start + offset) for sender, start, count in ranges for offset in range(count)}
+
+
+class RangeSet:
+    """Проверка пары (отправитель, номер) по диапазонам без их развёртывания
+
+    Диапазоны сортируются и сливаются; принадлежность - двоичный поиск
+    по началам, O(log n) на пару.
+    """
+
+    def __init__(self, ranges):
+        merged = []
+        for sender, start, count in sorted(ranges):
+            if not count:
+                continue
+            end = start + count
+            if merged and merged[-1][0] == sender and start <= merged[-1][2]:
+                merged[-1][2] = max(merged[-1][2], end)
+            else:
+                merged.append([sender, start, end])
+        self.starts = [(sender, start) for sender, start, _ in merged]
+        self.ends = [end for _, _, end in merged]
+
+    def __contains__(self, key):
+        index = bisect.bisect_right(self.starts, key) - 1
+        return index >= 0 and self.starts[index][0] == key[0] and key[1] < self.ends[index]
+
+
+def inflate(body):
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(body, MAX_BATCH)
+    except zlib.error as e:
+        raise ProtocolError(f"Пачка истории повреждена: {e}")
+    if decompressor.unconsumed_tail:
+        raise ProtocolError("Пачка истории больше допустимой")
+    return data
+
+
+class Connection:
+    """Неблокирующее потоковое соединение (TCP или Unix) в цикле событий
+
+    Поток - последовательность сообщений MESSAGE + тело. on_message
+    вызывается с (соединение, вид, тело), on_close(соединение) - один раз
+    при закрытии по любой причине. finish() закрывает соединение, когда
+    дописан весь исходящий буфер. timeout=None - соединение без срока.
+    """
+
+    def __init__(self, loop, sock, on_message, on_close, timeout, connecting=False):
+        self.loop = loop
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.on_message = on_message
+        self.on_close = on_close
+        self.incoming = bytearray()
+        self.outgoing = bytearray()
+        self.sent = 0
+        self.connecting = connecting
+        self.finishing = False
+        self.closed = False
+        self.timer = loop.call_later(timeout, self.close) if timeout is not None else None
+        loop.add_reader(self.fd, self.on_readable)
+        if connecting:
+            loop.add_writer(self.fd, self.on_writable)
+
+    @classmethod
+    def connect(cls, loop, address, on_message, on_close, timeout):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        code = sock.connect_ex(address)
+        if code not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            raise OSError(code, f"Нет соединения с {address[0]}:{address[1]}")
+        return cls(loop, sock, on_message, on_close, timeout, connecting=True)
+
+    def send(self, kind, body=b'', flush=True):
+        """Сообщение в исходящий буфер; flush=False - без записи в сокет до on_writable()"""
+        self.outgoing += MESSAGE.pack(kind, len(body))
+        self.outgoing += body
+        if flush and not self.connecting:
+            self.on_writable()
+
+    def backlog(self):
+        """Байты, ещё не записанные в сокет"""
+        return len(self.outgoing) - self.sent
+
+    def finish(self):
+        self.finishing = True
+        if not self.connecting and self.sent >= len(self.outgoing):
+            self.close()
+
+    def on_writable(self):
+        if self.closed:
+            return
+        if self.connecting:
+            if self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                self.close()
+                return
+            self.connecting = False
+        while self.sent < len(self.outgoing):
+            try:
+                with memoryview(self.outgoing) as view:
+                    self.sent += self.sock.send(view[self.sent:])
+            except (BlockingIOError, InterruptedError):
+                self.loop.add_writer(self.fd, self.on_writable)
+                return
+            except OSError:
+                self.close()
+                return
+        self.outgoing.clear()
+        self.sent = 0
+        self.loop.remove_writer(self.fd)
+        if self.finishing:
+            self.close()
+
+    def on_readable(self):
+        if self.closed:
+            return
+        try:
+            data = self.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.close()
+            return
+        incoming = self.incoming
+        incoming += data
+        offset = 0
+        while len(incoming) - offset >= MESSAGE.size and not self.closed:
+            kind, length = MESSAGE.unpack_from(incoming, offset)
+            if length > MAX_BODY:
+                self.close()
+                return
+            end = offset + MESSAGE.size + length
+            if end > len(incoming):
+                break
+            body = bytes(incoming[offset + MESSAGE.size:end])
+            offset = end
+            self.on_message(self, kind, body)
+        del incoming[:offset]
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.timer is not None:
+            self.timer.cancel()
+        self.loop.remove_reader(self.fd)
+        self.loop.remove_writer(self.fd)
+        self.sock.close()
+        self.on_close(self)
+
+
+class SyncServer:
+    """Раздача истории каналов по запросам SUMMARY и FETCH
+
+    history_of(канал) возвращает HistoryStore канала или None, если
+    канала нет или история не ведётся. Работает в потоке цикла loop.
+    """
+
+    # Сколько последних записей канала участвует в обмене
+    WINDOW = 5000
+    MAX_SESSIONS = 4
+    TIMEOUT = 10.0
+    BACKLOG = 16
+
+    def __init__(self, loop, history_of, host='', port=0, metrics=None):
+        self.loop = loop
+        self.history_of = history_of
+        self.sessions = set()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listener.bind((host, port))
+            self.listener.listen(self.BACKLOG)
+            self.listener.setblocking(False)
+        except OSError as e:
+            self.listener.close()
+            raise Exception(f"Не удалось открыть порт раздачи истории: {str(e)}")
+        self.port = self.listener.getsockname()[1]
+
+        metrics = REGISTRY if metrics is None else metrics
+        self.requests = metrics.counter('chim_sync_requests_total', "Запросы истории от участников")
+        self.busy = metrics.counter('chim_sync_busy_total', "Запросы истории, отклонённые из-за нагрузки")
+        self.served = metrics.counter('chim_sync_served_total', "Сообщения истории, отданные участникам")
+        metrics.gauge('chim_sync_sessions', "Открытые соединения раздачи истории", lambda: len(self.sessions))
+        self.loop.add_reader(self.listener.fileno(), self.on_accept)
+
+    def on_accept(self):
+        for _ in range(self.BACKLOG):
+            try:
+                sock, _ = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            sock.setblocking(False)
+            connection = Connection(self.loop, sock, self.on_request, self.sessions.discard, self.TIMEOUT)
+            if len(self.sessions) >= self.MAX_SESSIONS:
+                self.busy.inc()
+                connection.send(SYNC_BUSY)
+                connection.finish()
+                continue
+            self.sessions.add(connection)
+
+    def on_request(self, connection, kind, body):
+        self.requests.inc()
+        try:
+            channel, ranges = decode_request(body)
+            history = self.history_of(channel)
+            messages = history.tail(self.WINDOW) if history is not None else []
+            if kind == REQ_SUMMARY:
+                keys = [(message.sender_id, message.seq) for message in messages if message.seq]
+                connection.send(SYNC_SUMMARY, zlib.compress(encode_ranges(summarize(keys))))
+            elif kind == REQ_FETCH:
+                if len(ranges) > self.WINDOW or total(ranges) > self.WINDOW:
+                    raise ProtocolError("Запрос истории больше окна")
+                self.send_records(connection, messages, RangeSet(ranges))
+        except ProtocolError:
+            pass
+        connection.finish()
+
+    def send_records(self, connection, messages, wanted):
+        batch = bytearray()
+        for message in messages:
+            if (message.sender_id, message.seq) not in wanted:
+                continue
+            # Признак своего сообщения получателю не передаётся
+            payload = message.payload
+            batch += RECORD.pack(len(payload), 0, message.sender_id, message.seq, message.timestamp)
+            batch += payload
+            self.served.inc()
+            if len(batch) >= BATCH_BYTES:
+                connection.send(SYNC_BATCH, zlib.compress(batch))
+                batch.clear()
+        if batch:
+            connection.send(SYNC_BATCH, zlib.compress(batch))
+        connection.send(SYNC_END)
+
+    def close(self):
+        for connection in list(self.sessions):
+            connection.close()
+        self.loop.remove_reader(self.listener.fileno())
+        self.listener.close()
+
+
+class CatchUp:
+    """Догрузка сообщений канала, которых нет в своей истории
+
+    peers - адреса (IP, порт) участников, раздающих историю, have -
+    множество пар (отправитель, номер), которые уже есть. По окончании
+    on_done(messages) получает догруженные сообщения по возрастанию
+    времени - возможно, пустой список.
+    """
+
+    # У скольких участников спрашивать сводку
+    SUMMARY_PEERS = 3
+    # Доля одного участника нарезается кусками, чтобы делить поровну
+    CHUNK = 256
+    TIMEOUT = 10.0
+    # Раунды перераспределения после отказов
+    ROUNDS = 3
+    # Больше сообщений в сводке участник с окном SyncServer.WINDOW не отдаст
+    MAX_SUMMARY = SyncServer.WINDOW
+
+    def __init__(self, loop, channel, peers, have, on_done, rng=None, metrics=None):
+        self.loop = loop
+        self.channel = channel
+        self.peers = list(peers)
+        self.have = have
+        self.on_done = on_done
+        self.rng = rng or random.Random()
+        self.connections = set()
+        # Адрес -> множество пар, которые есть у участника и нет у нас
+        self.holdings = {}
+        self.failed = set()
+        self.messages = {}
+        self.rounds = 0
+        self.done = False
+        metrics = REGISTRY if metrics is None else metrics
+        self.fetched = metrics.counter('chim_sync_fetched_total', "Сообщения, догруженные у участников")
+
+    def start(self):
+        sources = self.rng.sample(self.peers, min(len(self.peers), self.SUMMARY_PEERS))
+        for address in sources:
+            self.request(address, REQ_SUMMARY, encode_request(self.channel), set())
+        self.check_done()
+
+    def request(self, address, kind, body, keys):
+        try:
+            connection = Connection.connect(self.loop, address, self.on_message, self.on_closed, self.TIMEOUT)
+        except OSError:
+            self.failed.add(address)
+            return
+        connection.address = address
+        # Запрошенные и ещё не полученные пары
+        connection.keys = keys
+        self.connections.add(connection)
+        connection.send(kind, body)
+
+    def on_message(self, connection, kind, body):
+        try:
+            if kind == SYNC_SUMMARY:
+                keys = expand(decode_ranges(inflate(body)), self.MAX_SUMMARY)
+                self.holdings[connection.address] = keys - self.have
+                connection.close()
+            elif kind == SYNC_BATCH:
+                for message in decode_records(inflate(body), 0):
+                    key = (message.sender_id, message.seq)
+                    if key in connection.keys:
+                        connection.keys.discard(key)
+                        self.messages[key] = message
+            elif kind == SYNC_END:
+                connection.close()
+            else:
+                # SYNC_BUSY и неизвестные ответы
+                self.failed.add(connection.address)
+                connection.close()
+        except ProtocolError:
+            self.failed.add(connection.address)
+            connection.close()
+
+    def on_closed(self, connection):
+        self.connections.discard(connection)
+        if connection.keys:
+            # Не дослано: участник перегружен, пропал или оборвал поток
+            self.failed.add(connection.address)
+        self.check_done()
+
+    def check_done(self):
+        if self.connections or self.done:
+            return
+        if self.rounds < self.ROUNDS and self.assign():
+            return
+        self.finish()
+
+    def assign(self):
+        """Раздача недостающего участникам; False - запрашивать нечего"""
+        self.rounds += 1
+        missing = {}
+        for address, keys in self.holdings.items():
+            if address in self.failed:
+                continue
+            for key in keys:
+                if key not in self.messages:
+                    missing.setdefault(key, []).append(address)
+        if not missing:
+            return False
+
+        # Случайный порядок участников разбивает ничьи по нагрузке
+        order = {address: self.rng.random() for address in self.holdings}
+        load = dict.fromkeys(self.holdings, 0)
+        plan = {}
+        chunk = []
+        owners = None
+        for key in sorted(missing):
+            if chunk and (missing[key] != owners or len(chunk) >= self.CHUNK):
+                self.plan_chunk(plan, load, order, owners, chunk)
+                chunk = []
+            owners = missing[key]
+            chunk.append(key)
+        self.plan_chunk(plan, load, order, owners, chunk)
+
+        for address, keys in plan.items():
+            body = encode_request(self.channel, summarize(keys))
+            self.request(address, REQ_FETCH, body, set(keys))
+        if not self.connections:
+            return self.rounds < self.ROUNDS and self.assign()
+        return True
+
+    def plan_chunk(self, plan, load, order, owners, chunk):
+        address = min(owners, key=lambda owner: (load[owner], order[owner]))
+        load[address] += len(chunk)
+        plan.setdefault(address, []).extend(chunk)
+
+    def finish(self):
+        self.done = True
+        messages = sorted(self.messages.values(), key=lambda message: order_key(message.timestamp))
+        self.fetched.inc(len(messages))
+        self.on_done(messages)
+
+    def cancel(self):
+        self.done = True
+        for connection in list(self.connections):
+            connection.close()
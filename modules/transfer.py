@@ -0,0 +1,727 @@
+"""Передача файлов по multicast: блоки, XOR-чётность и NACK
+
+Отправитель объявляет файл кадром MSG_FILE_OFFER и рассылает его
+блоками MSG_FILE_DATA с заданной скоростью. После каждых GROUP блоков
+идёт блок чётности - XOR блоков группы, - поэтому получатель
+восстанавливает одну потерю на группу без повторной передачи. Что не
+восстановилось, получатель запрашивает кадром MSG_FILE_NACK; отправитель
+дочитывает эти блоки из файла и досылает их.
+
+Получатель пишет блоки сразу в отображённый в память файл .part, а
+принятые блоки отмечает в битовой карте .part.state. Пока отправитель
+раздаёт файл, получатель, перезапущенный на середине, продолжает с
+сохранённой карты и запрашивает только недостающее.
+
+Все кадры передачи идут вне последовательности (номер 0): учёт потерь
+по номерам блоков ведётся здесь, а не в modules/reliability.py.
+"""
+import hashlib
+import mmap
+import os
+import random
+import shutil
+import struct
+import time
+
+from modules.metrics import REGISTRY
+from modules.protocol import (HEADER_SIZE, MAX_DATAGRAM, MAX_NAME, MSG_FILE_DATA, MSG_FILE_NACK,
+                              MSG_FILE_OFFER, ProtocolError)
+from modules.reliability import MAX_NACK_RANGES, decode_nack, encode_nack, to_ranges
+
+# Передача, размер файла, размер блока, блоков в группе, состояние, длина имени
+OFFER = struct.Struct('!QQHBBB')
+# Передача, номер блока (для чётности - номер группы), вид блока
+DATA = struct.Struct('!QIB')
+# Карта принятых блоков: передача, размер файла, размер блока, блоков в группе
+STATE = struct.Struct('!QQHB')
+
+BLOCK_DATA = 0
+BLOCK_PARITY = 1
+
+# Состояния отправителя в объявлении
+OFFER_SENDING = 0
+# Все блоки отправлены, идут только досылки по NACK
+OFFER_REPAIRING = 1
+OFFER_DONE = 2
+
+CHUNK_SIZE = (MAX_DATAGRAM - HEADER_SIZE - DATA.size) // 64 * 64
+GROUP = 8
+# Скорость по умолчанию, бит в секунду
+DEFAULT_RATE = 20 * 1000 * 1000
+
+FILES_ROOT = os.path.join(os.path.expanduser('~'), '.chim', 'files')
+# Имя на диске в байтах: с ".part.state.tmp" и " (n)" из free_path
+# оно не выходит за NAME_MAX (255) распространённых файловых систем
+MAX_DISK_NAME = 200
+MAX_EXTENSION = 16
+# Предел размера принимаемого файла: размер приходит из сети
+MAX_FILE_SIZE = 64 * 1024 * 1024 * 1024
+# Предел числа блоков: карта принятых занимает до MAX_BLOCKS / 8 байт
+MAX_BLOCKS = 1 << 26
+# Предел места, которое занимают все начатые приёмы вместе
+MAX_RESERVED = 64 * 1024 * 1024 * 1024
+# Сколько непринятых предложений помнить одновременно
+MAX_OFFERS = 64
+
+
+def encode_offer(transfer_id, size, chunk_size, group, state, name):
+    name_data = name.encode('utf-8')[:MAX_NAME]
+    return OFFER.pack(transfer_id, size, chunk_size, group, state, len(name_data)) + name_data
+
+
+def decode_offer(payload):
+    """(передача, размер, размер блока, группа, состояние, имя)"""
+    if len(payload) < OFFER.size:
+        raise ProtocolError("Объявление файла обрезано")
+    transfer_id, size, chunk_size, group, state, name_size = OFFER.unpack_from(payload)
+    end = OFFER.size + name_size
+    if end > len(payload):
+        raise ProtocolError("Имя файла обрезано")
+    if not chunk_size or not group:
+        raise ProtocolError("Некорректные параметры передачи")
+    name = str(payload[OFFER.size:end], 'utf-8', 'replace')
+    return transfer_id, size, chunk_size, group, state, name
+
+
+def safe_name(name):
+    """Имя файла без каталогов: отправитель не выбирает, куда писать"""
+    name = name.replace('\\', '/').rsplit('/', 1)[-1].strip()
+    if name in ('', '.', '..'):
+        name = 'file'
+    return name
+
+
+def disk_name(name):
+    """Безопасное имя, укороченное до MAX_DISK_NAME байт с хешем полного имени"""
+    name = safe_name(name)
+    data = name.encode('utf-8')
+    if len(data) <= MAX_DISK_NAME:
+        return name
+    root, extension = os.path.splitext(name)
+    if len(extension.encode('utf-8')) > MAX_EXTENSION:
+        root, extension = name, ''
+    digest = hashlib.sha1(data).hexdigest()[:8]
+    keep = MAX_DISK_NAME - len(extension.encode('utf-8')) - len(digest) - 1
+    root = root.encode('utf-8')[:keep].decode('utf-8', 'ignore')
+    return f"{root}-{digest}{extension}"
+
+
+def free_path(path):
+    """path, а если он занят - 'имя (n).расширение'"""
+    if not os.path.exists(path):
+        return path
+    root, extension = os.path.splitext(path)
+    number = 1
+    while os.path.exists(f"{root} ({number}){extension}"):
+        number += 1
+    return f"{root} ({number}){extension}"
+
+
+def format_size(size):
+    for unit in ("Б", "КБ", "МБ"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ГБ"
+
+
+def xor_into(accumulator, data):
+    """XOR блока в накопитель; короткий блок дополняется нулями"""
+    return accumulator ^ int.from_bytes(data, 'little')
+
+
+class FileSender:
+    """Раздача одного файла с ограничением скорости
+
+    Отправка идёт порциями раз в TICK секунд: токенов в корзине
+    прибавляется по rate, каждая датаграмма расходует свой размер. Пока
+    очередь массовой отправки перегружена, новые блоки не выдаются.
+    """
+
+    TICK = 0.005
+    OFFER_INTERVAL = 1.0
+    # Сколько ждать NACK после последней досылки, прежде чем закончить
+    LINGER = 3.0
+    MAX_REPAIR = 1 << 20
+
+    def __init__(self, manager, path, channel=None, rate=DEFAULT_RATE, transfer_id=None):
+        self.manager = manager
+        self.path = path
+        self.name = os.path.basename(path)
+        self.channel = channel
+        self.rate = rate / 8
+        self.transfer_id = transfer_id or random.getrandbits(64) or 1
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+        self.count = (self.size + CHUNK_SIZE - 1) // CHUNK_SIZE
+        self.next_chunk = 0
+        self.parity = 0
+        self.repair = set()
+        self.state = OFFER_SENDING
+        self.burst = max(2 * MAX_DATAGRAM, self.rate * self.TICK * 4)
+        self.tokens = self.burst
+        self.last_pump = None
+        self.last_offer = None
+        self.last_activity = None
+        self.timer = None
+
+        # Статистика
+        self.chunks_sent = 0
+        self.parity_sent = 0
+        self.repairs_sent = 0
+        self.started = None
+        self.finished = None
+
+    def start(self):
+        self.started = self.last_activity = time.monotonic()
+        self.pump()
+
+    def chunk(self, index):
+        start = index * CHUNK_SIZE
+        return self.map[start:start + CHUNK_SIZE]
+
+    def progress(self):
+        """Доля разосланного в первом проходе"""
+        return self.next_chunk / self.count if self.count else 1.0
+
+    def pump(self):
+        self.timer = None
+        now = time.monotonic()
+        if self.last_pump is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.last_pump) * self.rate)
+        self.last_pump = now
+        if self.last_offer is None or now - self.last_offer >= self.OFFER_INTERVAL:
+            self.send_offer()
+            self.last_offer = now
+
+        messenger = self.manager.messenger
+        while self.tokens > 0 and not messenger.congested():
+            if self.repair:
+                index = min(self.repair)
+                self.repair.discard(index)
+                self.send_block(BLOCK_DATA, index, self.chunk(index))
+                self.repairs_sent += 1
+                self.last_activity = now
+            elif self.next_chunk < self.count:
+                index = self.next_chunk
+                data = self.chunk(index)
+                self.send_block(BLOCK_DATA, index, data)
+                self.chunks_sent += 1
+                self.parity = xor_into(self.parity, data)
+                self.next_chunk += 1
+                if self.next_chunk % GROUP == 0 or self.next_chunk == self.count:
+                    group = (self.next_chunk - 1) // GROUP
+                    self.send_block(BLOCK_PARITY, group, self.parity.to_bytes(CHUNK_SIZE, 'little'))
+                    self.parity_sent += 1
+                    self.parity = 0
+                self.last_activity = now
+            else:
+                break
+
+        if self.next_chunk >= self.count and not self.repair:
+            if self.state == OFFER_SENDING:
+                self.state = OFFER_REPAIRING
+                self.send_offer()
+            elif now - self.last_activity >= self.LINGER:
+                self.finish()
+                return
+            # Досылать нечего: просыпаемся реже, только для объявлений
+            self.timer = self.manager.loop.call_later(min(self.OFFER_INTERVAL, self.LINGER) / 4, self.pump)
+            return
+        self.timer = self.manager.loop.call_later(self.TICK, self.pump)
+
+    def send_block(self, kind, index, data):
+        payload = DATA.pack(self.transfer_id, index, kind) + data
+        self.manager.send(MSG_FILE_DATA, payload, self.channel)
+        self.tokens -= HEADER_SIZE + len(payload)
+
+    def send_offer(self):
+        self.manager.send(MSG_FILE_OFFER, encode_offer(self.transfer_id, self.size, CHUNK_SIZE, GROUP,
+                                                       self.state, self.name), self.channel)
+
+    def on_nack(self, ranges):
+        for start, count in ranges:
+            for index in range(start, min(start + count, self.next_chunk)):
+                if len(self.repair) >= self.MAX_REPAIR:
+                    return
+                self.repair.add(index)
+        self.last_activity = time.monotonic()
+        if self.timer is not None and self.state == OFFER_REPAIRING:
+            # Ускоряем цикл: сейчас он просыпается с периодом объявлений
+            self.timer.cancel()
+            self.timer = self.manager.loop.call_later(0, self.pump)
+
+    def finish(self):
+        self.state = OFFER_DONE
+        self.finished = time.monotonic()
+        try:
+            self.send_offer()
+        except Exception:
+            pass
+        self.close()
+        self.manager.sender_done(self)
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.size:
+            self.map.close()
+        self.file.close()
+
+
+class FileReceiver:
+    """Приём одного файла в отображённый в память .part"""
+
+    NACK_INTERVAL = 0.3
+    STATE_SAVE_EVERY = 1024
+    # Сколько групп с лишними потерями держать с чётностью в памяти
+    MAX_PARITY = 4096
+
+    def __init__(self, manager, sender, channel, transfer_id, size, chunk_size, group, name):
+        self.manager = manager
+        self.sender = sender
+        self.channel = channel
+        self.transfer_id = transfer_id
+        self.size = size
+        self.chunk_size = chunk_size
+        self.group = group
+        self.name = disk_name(name)
+        self.count = (size + chunk_size - 1) // chunk_size
+        self.path = None
+        self.part_path = os.path.join(manager.directory, self.name + '.part')
+        self.state_path = self.part_path + '.state'
+        self.received = None
+        self.file = None
+        self.map = None
+        # Причина неудачного приёма для события 'failed'
+        self.error = None
+        self.have = 0
+        self.parities = {}
+        # Блоки до этого номера отправитель уже разослал (с чётностью групп)
+        self.horizon = 0
+        self.sender_state = OFFER_SENDING
+        self.unsaved = 0
+        self.nack_timer = None
+        self.last_seen = time.monotonic()
+        self.done = False
+
+        # Статистика
+        self.recovered = 0
+        self.duplicates = 0
+        self.nacks_sent = 0
+        self.resumed = 0
+
+    def check(self, max_size=MAX_FILE_SIZE):
+        """Проверка размера из объявления; ValueError, если файл не принять"""
+        if self.size > max_size:
+            raise ValueError(f"файл больше {format_size(max_size)}")
+        if self.count > MAX_BLOCKS:
+            raise ValueError(f"слишком много блоков ({self.count})")
+
+    def open(self, max_size=MAX_FILE_SIZE):
+        """Проверка размера из объявления и открытие .part
+
+        ValueError - размер больше max_size или свободного места, OSError -
+        ошибка файловой системы.
+        """
+        size = self.size
+        self.check(max_size)
+        os.makedirs(self.manager.directory, exist_ok=True)
+        self.received = bytearray((self.count + 7) // 8)
+        self.resume()
+        self.file = open(self.part_path, 'r+b' if os.path.exists(self.part_path) else 'w+b')
+        current = os.fstat(self.file.fileno()).st_size
+        if current != size:
+            if size - current > shutil.disk_usage(self.manager.directory).free:
+                raise ValueError(f"нет места на диске ({format_size(size)})")
+            self.file.truncate(size)
+        # Место выделяется сразу: нехватка диска при записи в отображение
+        # дала бы SIGBUS, а не исключение
+        if size and hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(self.file.fileno(), 0, size)
+        self.map = mmap.mmap(self.file.fileno(), size) if size else None
+        self.schedule_nack()
+
+    def resume(self):
+        """Карта принятых блоков от прежнего запуска с той же передачей"""
+        try:
+            with open(self.state_path, 'rb') as state_file:
+                data = state_file.read()
+        except OSError:
+            return
+        if len(data) == STATE.size + len(self.received) and \
+                STATE.unpack_from(data) == (self.transfer_id, self.size, self.chunk_size, self.group) and \
+                os.path.exists(self.part_path):
+            self.received[:] = data[STATE.size:]
+            self.have = sum(bin(byte).count('1') for byte in self.received)
+            self.resumed = self.have
+            return
+        # Чужая или испорченная карта: начинаем заново
+        for path in (self.part_path, self.state_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def save_state(self):
+        if self.done or self.received is None:
+            return
+        with open(self.state_path + '.tmp', 'wb') as state_file:
+            state_file.write(STATE.pack(self.transfer_id, self.size, self.chunk_size, self.group))
+            state_file.write(self.received)
+        os.replace(self.state_path + '.tmp', self.state_path)
+        self.unsaved = 0
+
+    def has(self, index):
+        return self.received[index >> 3] & (1 << (index & 7))
+
+    def mark(self, index):
+        self.received[index >> 3] |= 1 << (index & 7)
+        self.have += 1
+        self.unsaved += 1
+
+    def chunk_range(self, index):
+        start = index * self.chunk_size
+        return start, min(start + self.chunk_size, self.size)
+
+    def on_offer(self, state):
+        self.last_seen = time.monotonic()
+        self.sender_state = state
+        if state != OFFER_SENDING:
+            self.horizon = self.count
+        if state == OFFER_DONE and not self.done:
+            self.manager.receiver_done(self, False)
+
+    def on_block(self, kind, index, data):
+        self.last_seen = time.monotonic()
+        if kind == BLOCK_PARITY:
+            self.horizon = max(self.horizon, min(self.count, (index + 1) * self.group))
+            self.on_parity(index, data)
+        elif index < self.count:
+            self.horizon = max(self.horizon, index - index % self.group)
+            if self.has(index):
+                self.duplicates += 1
+                return
+            start, end = self.chunk_range(index)
+            if len(data) < end - start:
+                raise ProtocolError("Блок файла обрезан")
+            # Из буфера приёма сразу в страницы файла
+            self.map[start:end] = data[:end - start]
+            self.mark(index)
+            group = index // self.group
+            if group in self.parities:
+                self.try_recover(group, self.parities[group])
+        if self.unsaved >= self.STATE_SAVE_EVERY:
+            self.save_state()
+        if self.have == self.count:
+            self.complete()
+
+    def group_missing(self, group):
+        first = group * self.group
+        return [index for index in range(first, min(first + self.group, self.count))
+                if not self.has(index)]
+
+    def on_parity(self, group, data):
+        if group * self.group >= self.count:
+            return
+        missing = self.group_missing(group)
+        if not missing:
+            return
+        if len(missing) == 1:
+            self.try_recover(group, bytes(data))
+        elif len(self.parities) < self.MAX_PARITY:
+            self.parities[group] = bytes(data)
+
+    def try_recover(self, group, parity):
+        missing = self.group_missing(group)
+        if len(missing) > 1:
+            return
+        self.parities.pop(group, None)
+        if not missing:
+            return
+        value = int.from_bytes(parity[:self.chunk_size], 'little')
+        first = group * self.group
+        for index in range(first, min(first + self.group, self.count)):
+            if index != missing[0]:
+                start, end = self.chunk_range(index)
+                value = xor_into(value, self.map[start:end])
+        start, end = self.chunk_range(missing[0])
+        self.map[start:end] = value.to_bytes(self.chunk_size, 'little')[:end - start]
+        self.mark(missing[0])
+        self.recovered += 1
+        self.manager.recovered.inc()
+
+    def missing_ranges(self):
+        """Недостающие блоки из уже разосланных, диапазонами"""
+        missing = []
+        for index in range(self.horizon):
+            if not self.has(index):
+                missing.append(index)
+                if len(missing) >= MAX_NACK_RANGES * 64:
+                    break
+        return to_ranges(missing)
+
+    def schedule_nack(self):
+        delay = self.NACK_INTERVAL * random.uniform(1.0, 1.5)
+        self.nack_timer = self.manager.loop.call_later(delay, self.on_nack_timer)
+
+    def on_nack_timer(self):
+        self.nack_timer = None
+        if self.done:
+            return
+        ranges = self.missing_ranges()
+        if ranges:
+            self.manager.send(MSG_FILE_NACK, encode_nack(self.transfer_id, ranges), self.channel)
+            self.nacks_sent += 1
+        self.schedule_nack()
+
+    def complete(self):
+        if self.map is not None:
+            self.map.flush()
+        self.close()
+        self.path = free_path(os.path.join(self.manager.directory, self.name))
+        os.replace(self.part_path, self.path)
+        try:
+            os.remove(self.state_path)
+        except OSError:
+            pass
+        self.manager.receiver_done(self, True)
+
+    def close(self, keep_state=False):
+        if self.nack_timer is not None:
+            self.nack_timer.cancel()
+            self.nack_timer = None
+        if self.done:
+            return
+        if keep_state:
+            self.save_state()
+        self.done = True
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+
+    def discard(self):
+        self.close()
+        for path in (self.part_path, self.state_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class Transfers:
+    """Передачи файлов поверх MulticastMessenger
+
+    on_frame(frame) принимает кадры MSG_FILE_*. on_event(kind, transfer)
+    сообщает о ходе передач: 'offer' - предложен файл; приём начинается,
+    только когда его примут через accept(transfer), а до того место на
+    диске не занимается; decline(transfer) отказывает. 'accepted' - начат
+    приём (transfer.resumed - блоки от прежнего запуска), 'received' - файл
+    сохранён (transfer.path), 'failed' - отправитель закончил раньше, чем
+    пришли все блоки, или приём невозможен (transfer.error: длинное имя,
+    размер, место на диске, ошибка записи), 'paused' - отправитель
+    пропал, приём продолжится при его возвращении, 'sent' - раздача
+    закончена.
+    """
+
+    # Приём без кадров дольше этого срока откладывается до возобновления
+    IDLE_TIMEOUT = 60.0
+    MAX_FILE_SIZE = MAX_FILE_SIZE
+    MAX_RESERVED = MAX_RESERVED
+    MAX_OFFERS = MAX_OFFERS
+
+    def __init__(self, messenger, loop, directory=FILES_ROOT, on_event=None, metrics=None):
+        self.messenger = messenger
+        self.loop = loop
+        self.directory = directory
+        self.on_event = on_event
+        self.senders = {}
+        # (отправитель, передача) -> FileReceiver
+        self.receivers = {}
+        # Предложения, которые ещё не приняты: (отправитель, передача) -> FileReceiver
+        self.offers = {}
+        # Принятые предложения: после паузы приём продолжается без нового вопроса
+        self.accepted = set()
+        # Законченные передачи, чтобы поздние кадры не начинали их заново
+        self.finished = set()
+        metrics = REGISTRY if metrics is None else metrics
+        self.chunks_received = metrics.counter('chim_file_chunks_received_total', "Принято блоков файлов")
+        self.recovered = metrics.counter('chim_file_recovered_total', "Блоки, восстановленные по чётности")
+        metrics.gauge('chim_file_transfers', "Активные передачи файлов",
+                      lambda: len(self.senders) + len(self.receivers))
+        self.idle_timer = self.loop.call_later(self.IDLE_TIMEOUT, self.expire)
+
+    def send(self, msg_type, payload, channel=None):
+        self.messenger.send_unsequenced(msg_type, payload, channel)
+
+    def send_file(self, path, channel=None, rate=DEFAULT_RATE):
+        sender = FileSender(self, path, channel, rate)
+        self.senders[sender.transfer_id] = sender
+        sender.start()
+        return sender
+
+    def on_frame(self, frame):
+        if frame.msg_type == MSG_FILE_OFFER:
+            transfer_id, size, chunk_size, group, state, name = decode_offer(frame.payload)
+            key = (frame.sender, transfer_id)
+            receiver = self.receivers.get(key)
+            if receiver is not None:
+                self.guard(receiver, receiver.on_offer, state)
+                return
+            receiver = self.offers.get(key)
+            if receiver is not None:
+                receiver.last_seen = time.monotonic()
+                if state == OFFER_DONE:
+                    # Раздача закончилась раньше, чем предложение приняли
+                    del self.offers[key]
+                    self.refuse(receiver, "раздача закончилась до согласия на приём")
+                else:
+                    receiver.sender_state = state
+                return
+            if state == OFFER_DONE or key in self.finished:
+                return
+            if key not in self.accepted and len(self.offers) >= self.MAX_OFFERS:
+                return
+            receiver = FileReceiver(self, frame.sender, frame.channel, transfer_id,
+                                    size, chunk_size, group, name)
+            receiver.sender_state = state
+            try:
+                receiver.check(self.MAX_FILE_SIZE)
+            except ValueError as e:
+                # Заведомо неподъёмное предложение не спрашиваем
+                self.refuse(receiver, str(e))
+                return
+            self.offers[key] = receiver
+            if key in self.accepted:
+                # Приостановленный приём: согласие уже было
+                self.accept(receiver)
+            else:
+                self.emit('offer', receiver)
+        elif frame.msg_type == MSG_FILE_DATA:
+            if len(frame.payload) < DATA.size:
+                raise ProtocolError("Блок файла обрезан")
+            transfer_id, index, kind = DATA.unpack_from(frame.payload)
+            receiver = self.receivers.get((frame.sender, transfer_id))
+            if receiver is not None and not receiver.done:
+                self.chunks_received.inc()
+                self.guard(receiver, receiver.on_block, kind, index, frame.payload[DATA.size:])
+        elif frame.msg_type == MSG_FILE_NACK:
+            transfer_id, ranges = decode_nack(frame.payload)
+            sender = self.senders.get(transfer_id)
+            if sender is not None:
+                sender.on_nack(ranges)
+
+    def reserved(self):
+        """Байты, занятые на диске начатыми приёмами"""
+        return sum(receiver.size for receiver in self.receivers.values())
+
+    def accept(self, transfer):
+        """Согласие на приём предложенного файла
+
+        Только здесь создаётся .part и выделяется место. False - предложения
+        уже нет (отозвано, устарело или отклонено); отказ по месту приходит
+        событием 'failed'.
+        """
+        key = (transfer.sender, transfer.transfer_id)
+        receiver = self.offers.pop(key, None)
+        if receiver is None:
+            return False
+        receiver.last_seen = time.monotonic()
+        reserved = self.reserved()
+        if reserved + receiver.size > self.MAX_RESERVED:
+            # .part от прежнего запуска не трогаем: приём можно продолжить позже
+            self.refuse(receiver, f"предел приёма {format_size(self.MAX_RESERVED)}: занято "
+                                  f"{format_size(reserved)}, файлу нужно {format_size(receiver.size)}")
+            return True
+        self.receivers[key] = receiver
+        try:
+            receiver.open(self.MAX_FILE_SIZE)
+        except (OSError, ValueError, MemoryError) as e:
+            self.fail(receiver, e)
+            return True
+        self.accepted.add(key)
+        self.emit('accepted', receiver)
+        if receiver.have == receiver.count:
+            self.guard(receiver, receiver.complete)
+        else:
+            self.guard(receiver, receiver.on_offer, receiver.sender_state)
+        return True
+
+    def decline(self, transfer):
+        """Отказ от предложенного файла: его кадры больше не рассматриваются"""
+        key = (transfer.sender, transfer.transfer_id)
+        if self.offers.pop(key, None) is not None:
+            self.finished.add(key)
+
+    def refuse(self, receiver, error):
+        """'failed' для неоткрытого приёма; .part от прежнего запуска остаётся"""
+        self.finished.add((receiver.sender, receiver.transfer_id))
+        receiver.done = True
+        receiver.error = error
+        self.emit('failed', receiver)
+
+    def guard(self, receiver, method, *args):
+        """Вызов метода приёма; ошибка диска завершает приём событием 'failed'"""
+        try:
+            method(*args)
+        except ProtocolError:
+            raise
+        except (OSError, ValueError, MemoryError) as e:
+            self.fail(receiver, e)
+
+    def fail(self, receiver, error):
+        receiver.error = str(error) or type(error).__name__
+        if (receiver.sender, receiver.transfer_id) in self.receivers:
+            self.receiver_done(receiver, False)
+
+    def sender_done(self, sender):
+        self.senders.pop(sender.transfer_id, None)
+        self.emit('sent', sender)
+
+    def receiver_done(self, receiver, success):
+        key = (receiver.sender, receiver.transfer_id)
+        self.receivers.pop(key, None)
+        self.accepted.discard(key)
+        self.finished.add(key)
+        if not success:
+            receiver.discard()
+        self.emit('received' if success else 'failed', receiver)
+
+    def emit(self, kind, transfer):
+        if self.on_event is not None:
+            self.on_event(kind, transfer)
+
+    def expire(self):
+        """Откладывание приёма, от которого давно нет кадров"""
+        self.idle_timer = self.loop.call_later(self.IDLE_TIMEOUT, self.expire)
+        now = time.monotonic()
+        for key, receiver in list(self.offers.items()):
+            # Отправитель пропал, не дождавшись ответа: при возвращении он предложит снова
+            if now - receiver.last_seen > self.IDLE_TIMEOUT:
+                del self.offers[key]
+        for key, receiver in list(self.receivers.items()):
+            if now - receiver.last_seen > self.IDLE_TIMEOUT:
+                # Карта остаётся на диске: передача продолжится, если отправитель вернётся
+                try:
+                    receiver.close(keep_state=True)
+                except OSError as e:
+                    self.fail(receiver, e)
+                    continue
+                del self.receivers[key]
+                self.emit('paused', receiver)
+
+    def close(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+        for sender in list(self.senders.values()):
+            sender.close()
+        self.senders.clear()
+        for receiver in list(self.receivers.values()):
+            receiver.close(keep_state=True)
+        self.receivers.clear()
+        self.offers.clear()
@@ -0,0 +1,604 @@
+"""Сетевой процесс: сокет, разбор и распаковка вне процесса окна
+
+В этом режиме multicast-сокет принадлежит отдельному процессу. Он
+принимает датаграммы, отбрасывает дубликаты, собирает фрагменты,
+распаковывает и ограничивает флуд - всё, что раньше делил с отрисовкой
+один GIL, - и кладёт готовые кадры в кольцо в разделяемой памяти
+(modules/ring.py). Окно читает кольцо, когда по управляющему Unix-сокету
+приходит пробуждение; оно посылается, только если окно уже всё
+прочитало, поэтому поток кадров не порождает потока пробуждений.
+
+По тому же сокету окно подписывается на каналы и отправляет кадры.
+WorkerMessenger в процессе окна повторяет интерфейс MulticastMessenger,
+которым пользуются окно и присутствие.
+
+Передачи файлов (modules/transfer.py) целиком идут здесь: блоки
+MSG_FILE_* в кольцо не попадают, восстановление по чётности, запись в
+.part и досылки не занимают поток окна. Окно через WorkerTransfers
+отправляет файлы, принимает или отклоняет предложения и получает
+события передач. В окне остаются история с её единственным писателем и
+раздача её опоздавшим (SyncServer), поиск, окно переупорядочения и
+присутствие.
+
+Процесс не завершается вместе с окном: он держит подписки и копит кадры
+в кольце ещё LINGER секунд, и перезапущенное окно подключается к нему
+заново - без выхода из групп и с тем же идентификатором отправителя.
+
+    python -m modules.worker --control ~/.chim/worker.sock
+"""
+import argparse
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+from modules.channels import DEFAULT_CHANNEL, DEFAULT_GROUP
+from modules.clock import HybridClock
+from modules.loop import SelectorLoop
+from modules.metrics import REGISTRY
+from modules.network import MulticastMessenger
+from modules.protocol import (MSG_CHAT, MSG_FILE_DATA, MSG_FILE_NACK, MSG_FILE_OFFER, MSG_PRESENCE,
+                              Frame, ProtocolError, encode_chat)
+from modules.ratelimit import SenderLimiter
+from modules.ring import SharedRing
+from modules.scheduler import PRIORITY_BULK
+from modules.sync import MESSAGE, Connection
+from modules.transfer import FILES_ROOT, Transfers
+
+CONTROL_PATH = os.path.join(os.path.expanduser('~'), '.chim', 'worker.sock')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Команды окна
+CMD_HELLO = 1
+CMD_SUBSCRIBE = 2
+CMD_UNSUBSCRIBE = 3
+CMD_FRAME = 4
+CMD_UNSEQUENCED = 5
+CMD_SHUTDOWN = 6
+CMD_SEND_FILE = 7
+CMD_ACCEPT = 8
+CMD_DECLINE = 9
+# Ответы и сигналы процесса
+REPLY_OK = 16
+REPLY_ERROR = 17
+REPLY_HELLO = 18
+REPLY_SEQ = 19
+WORKER_WAKE = 20
+REPLY_TRANSFER = 21
+WORKER_TRANSFER = 22
+
+# Кадр в кольце: тип, флаги, отправитель, номер, время, адрес, длина имени канала
+FRAME_RECORD = struct.Struct('!BBQIQ4sB')
+SEQ = struct.Struct('!Q')
+# Начало CMD_FRAME: тип кадра и метка часов окна (modules/clock.py)
+FRAME_COMMAND = struct.Struct('!BQ')
+# Передача в событии: отправитель, передача, размер, блоков, принято прежде;
+# за ними через нулевой байт вид события, канал, имя, путь и ошибка
+TRANSFER_RECORD = struct.Struct('!QQQII')
+# Передача в CMD_ACCEPT и CMD_DECLINE: отправитель, передача
+TRANSFER_KEY = struct.Struct('!QQ')
+
+TRANSFER_TYPES = (MSG_FILE_OFFER, MSG_FILE_DATA, MSG_FILE_NACK)
+
+# Байт состояния кольца: очередь массовой отправки перегружена
+STATE_CONGESTED = 1
+
+
+def encode_name(name):
+    data = (name or '').encode('utf-8')
+    return bytes((len(data),)) + data
+
+
+def decode_name(body, offset=0):
+    """(имя или None, конец имени)"""
+    if offset >= len(body) or offset + 1 + body[offset] > len(body):
+        raise ProtocolError("Имя в команде обрезано")
+    end = offset + 1 + body[offset]
+    return str(body[offset + 1:end], 'utf-8', 'replace') or None, end
+
+
+def encode_frame_record(frame):
+    address = socket.inet_aton(frame.address) if frame.address else bytes(4)
+    channel = frame.channel.encode('utf-8')
+    return b''.join((FRAME_RECORD.pack(frame.msg_type, frame.flags, frame.sender, frame.seq,
+                                       frame.timestamp, address, len(channel)),
+                     channel, frame.payload))
+
+
+def decode_frame_record(data):
+    msg_type, flags, sender, seq, timestamp, address, size = FRAME_RECORD.unpack_from(data)
+    end = FRAME_RECORD.size + size
+    frame = Frame(msg_type, flags, sender, seq, timestamp, data[end:])
+    frame.channel = str(data[FRAME_RECORD.size:end], 'utf-8', 'replace')
+    if address != bytes(4):
+        frame.address = socket.inet_ntoa(address)
+    return frame
+
+
+def encode_transfer(kind, transfer):
+    fields = (kind, transfer.channel or '', transfer.name, getattr(transfer, 'path', None) or '',
+              getattr(transfer, 'error', None) or '')
+    return TRANSFER_RECORD.pack(getattr(transfer, 'sender', 0), transfer.transfer_id, transfer.size,
+                                transfer.count, getattr(transfer, 'resumed', 0)) + \
+        '\0'.join(fields).encode('utf-8', 'surrogateescape')
+
+
+def decode_transfer(body):
+    """(вид события, RemoteTransfer)"""
+    if len(body) < TRANSFER_RECORD.size:
+        raise ProtocolError("Событие передачи обрезано")
+    sender, transfer_id, size, count, resumed = TRANSFER_RECORD.unpack_from(body)
+    fields = str(body[TRANSFER_RECORD.size:], 'utf-8', 'surrogateescape').split('\0')
+    if len(fields) != 5:
+        raise ProtocolError("Событие передачи повреждено")
+    kind, channel, name, path, error = fields
+    return kind, RemoteTransfer(sender, transfer_id, channel or None, name, size, count,
+                                resumed, path or None, error or None)
+
+
+class RemoteTransfer:
+    """Передача в сетевом процессе: поля, которые показывает окно"""
+
+    def __init__(self, sender, transfer_id, channel=None, name='', size=0, count=0, resumed=0,
+                 path=None, error=None):
+        self.sender = sender
+        self.transfer_id = transfer_id
+        self.channel = channel
+        self.name = name
+        self.size = size
+        self.count = count
+        self.resumed = resumed
+        self.path = path
+        self.error = error
+
+
+class NetworkWorker:
+    """Процесс-владелец сокета: MulticastMessenger, кольцо и одно окно"""
+
+    # Сколько ждать окно после его отключения (и первого подключения)
+    LINGER = 60.0
+    RING_SIZE = 16 * 1024 * 1024
+    CONGESTION_CHECK = 0.005
+
+    def __init__(self, control_path, name, group=DEFAULT_GROUP, channel=DEFAULT_CHANNEL, port=5007,
+                 files=FILES_ROOT):
+        self.control_path = control_path
+        self.client = None
+        self.linger_timer = None
+        self.congestion_timer = None
+
+        # Второй процесс, запущенный одновременно, не должен занять сокет живого
+        probe = connect_control(control_path)
+        if probe is not None:
+            probe.close()
+            raise Exception("Сетевой процесс уже запущен")
+        os.makedirs(os.path.dirname(control_path), exist_ok=True)
+        if os.path.exists(control_path):
+            os.unlink(control_path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(control_path)
+        os.chmod(control_path, 0o600)
+        self.listener.listen(4)
+        self.listener.setblocking(False)
+
+        self.loop = SelectorLoop()
+        self.ring = SharedRing(capacity=self.RING_SIZE)
+        self.messenger = MulticastMessenger(name, self.loop, self.on_frame, group, port,
+                                            channel=channel, limiter=SenderLimiter())
+        self.transfers = Transfers(self.messenger, self.loop, files, self.on_transfer)
+        self.loop.add_reader(self.listener.fileno(), self.on_accept)
+        self.start_linger()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.loop.stop())
+        try:
+            self.loop.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def on_frame(self, frame):
+        if frame.msg_type in TRANSFER_TYPES:
+            self.transfers.on_frame(frame)
+            return
+        if self.ring.put(encode_frame_record(frame)) and self.client is not None:
+            self.client.send(WORKER_WAKE)
+
+    def on_transfer(self, kind, transfer):
+        # Без окна предложение ждёт: hello() повторит его подключившемуся окну
+        if self.client is not None:
+            self.client.send(WORKER_TRANSFER, encode_transfer(kind, transfer))
+
+    def on_accept(self):
+        try:
+            sock, _ = self.listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        sock.setblocking(False)
+        Connection(self.loop, sock, self.on_command, self.on_disconnect, None)
+
+    def on_disconnect(self, connection):
+        if connection is self.client:
+            self.client = None
+            self.start_linger()
+
+    def start_linger(self):
+        self.linger_timer = self.loop.call_later(self.LINGER, self.loop.stop)
+
+    def on_command(self, connection, kind, body):
+        if kind == CMD_HELLO:
+            self.hello(connection, body)
+            return
+        if connection is not self.client:
+            connection.close()
+            return
+        try:
+            if kind == CMD_UNSEQUENCED:
+                msg_type = body[0]
+                channel, end = decode_name(body, 1)
+                self.messenger.send_unsequenced(msg_type, body[end:], channel)
+                self.check_congestion()
+            elif kind == CMD_FRAME:
+                msg_type, timestamp = FRAME_COMMAND.unpack_from(body)
+                channel, end = decode_name(body, FRAME_COMMAND.size)
+                seq = self.messenger.send_frame(msg_type, body[end:], channel, timestamp)
+                connection.send(REPLY_SEQ, SEQ.pack(seq))
+            elif kind == CMD_SUBSCRIBE:
+                name, end = decode_name(body)
+                group, _ = decode_name(body, end)
+                self.messenger.subscribe(name, group)
+                connection.send(REPLY_OK)
+            elif kind == CMD_UNSUBSCRIBE:
+                name, _ = decode_name(body)
+                self.messenger.unsubscribe(name)
+                connection.send(REPLY_OK)
+            elif kind == CMD_SEND_FILE:
+                channel, end = decode_name(body)
+                sender = self.transfers.send_file(os.fsdecode(body[end:]), channel)
+                connection.send(REPLY_TRANSFER, encode_transfer('', sender))
+            elif kind == CMD_ACCEPT:
+                accepted = self.transfers.accept(RemoteTransfer(*TRANSFER_KEY.unpack_from(body)))
+                connection.send(REPLY_OK, bytes((accepted,)))
+            elif kind == CMD_DECLINE:
+                self.transfers.decline(RemoteTransfer(*TRANSFER_KEY.unpack_from(body)))
+                connection.send(REPLY_OK)
+            elif kind == CMD_SHUTDOWN:
+                self.loop.stop()
+        except Exception as e:
+            if kind != CMD_UNSEQUENCED:
+                connection.send(REPLY_ERROR, str(e).encode('utf-8'))
+
+    def hello(self, connection, body):
+        if self.client is not None and self.client is not connection:
+            connection.send(REPLY_ERROR, "Сетевой процесс занят другим окном".encode('utf-8'))
+            connection.finish()
+            return
+        self.client = connection
+        if self.linger_timer is not None:
+            self.linger_timer.cancel()
+            self.linger_timer = None
+        self.messenger.workstation_id = str(body, 'utf-8', 'replace')
+        connection.send(REPLY_HELLO, SEQ.pack(self.messenger.sender_id) + self.ring.name.encode('utf-8'))
+        # Кадры и предложения файлов, накопленные без окна
+        if len(self.ring):
+            connection.send(WORKER_WAKE)
+        for receiver in self.transfers.offers.values():
+            connection.send(WORKER_TRANSFER, encode_transfer('offer', receiver))
+
+    def check_congestion(self):
+        """Состояние очереди массовой отправки для WorkerMessenger.congested()"""
+        congested = self.messenger.congested(PRIORITY_BULK)
+        self.ring.state = STATE_CONGESTED if congested else 0
+        if congested and self.congestion_timer is None:
+            self.congestion_timer = self.loop.call_later(self.CONGESTION_CHECK, self.on_congestion_timer)
+
+    def on_congestion_timer(self):
+        self.congestion_timer = None
+        self.check_congestion()
+
+    def close(self):
+        # Незаконченный приём сохраняет карту блоков для продолжения
+        self.transfers.close()
+        self.messenger.close()
+        self.listener.close()
+        try:
+            os.unlink(self.control_path)
+        except OSError:
+            pass
+        self.ring.close()
+        self.loop.close()
+
+
+class WorkerMessenger:
+    """Заместитель MulticastMessenger в процессе окна
+
+    Кадры приходят из кольца в on_frame(frame) в потоке цикла loop;
+    frame.payload здесь - bytes. Команды, на которые нужен ответ
+    (подписка, отправка кадра с номером), ждут его синхронно не дольше
+    REPLY_TIMEOUT. Если процесс завершился, on_disconnect(причина)
+    вызывается один раз в цикле loop; отправки после этого не проходят.
+    """
+
+    REPLY_TIMEOUT = 5.0
+    # Кадров за один проход по кольцу, чтобы не задерживать цикл
+    DRAIN_BATCH = 256
+
+    def __init__(self, sock, workstation_id, loop, on_frame, metrics=None):
+        self.sock = sock
+        self.workstation_id = workstation_id
+        self.loop = loop
+        self.on_frame = on_frame
+        # Свои часы: метки своих сообщений ставит окно, принятые кадры их двигают
+        self.clock = HybridClock()
+        self.running = True
+        self.incoming = bytearray()
+        self.replies = []
+        self.drain_pending = False
+        self.on_disconnect = None
+        # События передач для WorkerTransfers: on_transfer(вид, RemoteTransfer)
+        self.on_transfer = None
+        metrics = REGISTRY if metrics is None else metrics
+        self.handler_errors = metrics.counter(
+            'chim_handler_errors_total', "Исключения обработчика кадров, пропущенные без остановки приёма")
+        self.sock.settimeout(self.REPLY_TIMEOUT)
+        kind, body = self.call(CMD_HELLO, workstation_id.encode('utf-8'))
+        if kind != REPLY_HELLO:
+            raise Exception(str(body, 'utf-8', 'replace'))
+        self.sender_id = SEQ.unpack_from(body)[0]
+        self.ring = SharedRing(str(body[SEQ.size:], 'utf-8'))
+        self.loop.add_reader(self.sock.fileno(), self.on_readable)
+
+    def post(self, kind, body=b''):
+        if not self.running:
+            raise Exception("Сетевой процесс недоступен")
+        try:
+            self.sock.sendall(MESSAGE.pack(kind, len(body)) + body)
+        except OSError as e:
+            reason = f"Сетевой процесс недоступен: {str(e)}"
+            self.disconnected(reason)
+            raise Exception(reason)
+
+    def call(self, kind, body=b''):
+        """Команда и ожидание ответа на неё: (вид ответа, тело)"""
+        self.post(kind, body)
+        while not self.replies:
+            self.receive()
+        return self.replies.pop(0)
+
+    def check(self, kind, body=b''):
+        reply, body = self.call(kind, body)
+        if reply == REPLY_ERROR:
+            raise Exception(str(body, 'utf-8', 'replace'))
+        return body
+
+    def receive(self):
+        try:
+            data = self.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            reason = f"Сетевой процесс не отвечает: {str(e)}"
+            self.disconnected(reason)
+            raise Exception(reason)
+        if not data:
+            self.disconnected("Сетевой процесс завершился")
+            raise Exception("Сетевой процесс завершился")
+        incoming = self.incoming
+        incoming += data
+        offset = 0
+        while len(incoming) - offset >= MESSAGE.size:
+            kind, length = MESSAGE.unpack_from(incoming, offset)
+            end = offset + MESSAGE.size + length
+            if end > len(incoming):
+                break
+            if kind == WORKER_WAKE:
+                self.schedule_drain()
+            elif kind == WORKER_TRANSFER:
+                # Не из ожидания ответа в call(): событие обрабатывается в цикле
+                event = bytes(incoming[offset + MESSAGE.size:end])
+                self.loop.call_later(0, lambda event=event: self.transfer_event(event))
+            else:
+                self.replies.append((kind, bytes(incoming[offset + MESSAGE.size:end])))
+            offset = end
+        del incoming[:offset]
+
+    def on_readable(self):
+        try:
+            self.receive()
+        except Exception:
+            # receive() уже сообщил окну через disconnected()
+            pass
+
+    def disconnected(self, reason):
+        """Процесс пропал: чтение прекращается, окно узнаёт через on_disconnect"""
+        self.running = False
+        try:
+            self.loop.remove_reader(self.sock.fileno())
+        except Exception:
+            pass
+        callback, self.on_disconnect = self.on_disconnect, None
+        if callback is not None:
+            self.loop.call_later(0, lambda: callback(reason))
+
+    def transfer_event(self, body):
+        if self.on_transfer is None:
+            return
+        try:
+            self.on_transfer(*decode_transfer(body))
+        except Exception:
+            self.handler_errors.inc()
+
+    def schedule_drain(self):
+        if not self.drain_pending:
+            self.drain_pending = True
+            self.loop.call_later(0, self.drain)
+
+    def drain(self):
+        self.drain_pending = False
+        if not self.running:
+            return
+        for _ in range(self.DRAIN_BATCH):
+            data = self.ring.get()
+            if data is None:
+                return
+            try:
+                frame = decode_frame_record(data)
+            except ProtocolError:
+                continue
+            self.clock.update(frame.timestamp)
+            try:
+                self.on_frame(frame)
+            except Exception:
+                self.handler_errors.inc()
+        # Остаток - в следующем проходе цикла; пробуждения не будет, пока
+        # кольцо не прочитано до конца
+        self.schedule_drain()
+
+    def subscribe(self, name, group):
+        self.check(CMD_SUBSCRIBE, encode_name(name) + encode_name(group))
+
+    def unsubscribe(self, name):
+        self.check(CMD_UNSUBSCRIBE, encode_name(name))
+
+    def send_message(self, message, channel=None, timestamp=None):
+        try:
+            return self.send_frame(MSG_CHAT, encode_chat(self.workstation_id, message), channel, timestamp)
+        except Exception as e:
+            raise Exception(f"Ошибка отправки сообщения: {str(e)}")
+
+    def send_frame(self, msg_type, payload, channel=None, timestamp=None):
+        if timestamp is None:
+            timestamp = self.clock.now()
+        body = self.check(CMD_FRAME, FRAME_COMMAND.pack(msg_type, timestamp) + encode_name(channel) + payload)
+        return SEQ.unpack(body)[0]
+
+    def send_unsequenced(self, msg_type, payload, channel=None):
+        """Как у MulticastMessenger: False - датаграмма не отправлена"""
+        try:
+            self.post(CMD_UNSEQUENCED, bytes((msg_type,)) + encode_name(channel) + payload)
+        except Exception:
+            return False
+        return True
+
+    def send_presence(self, payload, channel=None):
+        self.send_unsequenced(MSG_PRESENCE, payload, channel)
+
+    def congested(self, priority=PRIORITY_BULK):
+        return self.ring.state == STATE_CONGESTED
+
+    def close(self, shutdown=False):
+        """Отключение от процесса; он остаётся ждать окно LINGER секунд"""
+        if shutdown and self.running:
+            try:
+                self.post(CMD_SHUTDOWN)
+            except Exception:
+                pass
+        self.running = False
+        self.on_disconnect = None
+        try:
+            self.loop.remove_reader(self.sock.fileno())
+        except Exception:
+            pass
+        self.sock.close()
+        self.ring.close()
+
+    @classmethod
+    def connect(cls, workstation_id, loop, on_frame, control_path=CONTROL_PATH,
+                group=DEFAULT_GROUP, channel=DEFAULT_CHANNEL, port=5007, spawn_timeout=5.0,
+                metrics=None, files=FILES_ROOT):
+        """Подключение к работающему процессу; если его нет - запуск"""
+        sock = connect_control(control_path)
+        if sock is None:
+            spawn_worker(control_path, workstation_id, group, channel, port, files)
+            deadline = time.monotonic() + spawn_timeout
+            while sock is None and time.monotonic() < deadline:
+                time.sleep(0.02)
+                sock = connect_control(control_path)
+            if sock is None:
+                raise Exception("Сетевой процесс не запустился")
+        try:
+            return cls(sock, workstation_id, loop, on_frame, metrics)
+        except Exception:
+            sock.close()
+            raise
+
+
+class WorkerTransfers:
+    """Заместитель Transfers в процессе окна
+
+    Передачи идут в сетевом процессе; окно отправляет файлы, отвечает на
+    предложения и получает on_event(kind, transfer) с RemoteTransfer -
+    те же события, что у Transfers.
+    """
+
+    def __init__(self, messenger, on_event=None):
+        self.messenger = messenger
+        self.on_event = on_event
+        messenger.on_transfer = self.emit
+
+    def send_file(self, path, channel=None):
+        body = self.messenger.check(CMD_SEND_FILE, encode_name(channel) + os.fsencode(path))
+        return decode_transfer(body)[1]
+
+    def accept(self, transfer):
+        """Как Transfers.accept: False - предложения уже нет"""
+        body = self.messenger.check(CMD_ACCEPT, TRANSFER_KEY.pack(transfer.sender, transfer.transfer_id))
+        return body == b'\1'
+
+    def decline(self, transfer):
+        self.messenger.check(CMD_DECLINE, TRANSFER_KEY.pack(transfer.sender, transfer.transfer_id))
+
+    def emit(self, kind, transfer):
+        if self.on_event is not None:
+            self.on_event(kind, transfer)
+
+    def close(self):
+        """Передачи продолжаются в сетевом процессе, пока он ждёт окно"""
+        self.messenger.on_transfer = None
+        self.on_event = None
+
+
+def connect_control(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return sock
+    except OSError:
+        sock.close()
+        return None
+
+
+def spawn_worker(control_path, name, group=DEFAULT_GROUP, channel=DEFAULT_CHANNEL, port=5007,
+                 files=FILES_ROOT):
+    """Запуск процесса в своей сессии: он переживает окно, которое его запустило"""
+    return subprocess.Popen([sys.executable, '-m', 'modules.worker', '--control', control_path,
+                             '--name', name, '--group', group, '--channel', channel,
+                             '--port', str(port), '--files', files],
+                            cwd=ROOT, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                            start_new_session=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Сетевой процесс Chim Messenger")
+    parser.add_argument('--control', default=CONTROL_PATH, help="управляющий Unix-сокет")
+    parser.add_argument('--name', default='')
+    parser.add_argument('--group', default=DEFAULT_GROUP)
+    parser.add_argument('--channel', default=DEFAULT_CHANNEL)
+    parser.add_argument('--port', type=int, default=5007)
+    parser.add_argument('--files', default=FILES_ROOT, help="каталог принятых файлов")
+    args = parser.parse_args(argv)
+    try:
+        worker = NetworkWorker(args.control, args.name, args.group, args.channel, args.port, args.files)
+    except Exception as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    worker.run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
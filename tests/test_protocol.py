@@ -0,0 +1,109 @@
+"""Проверки бинарного протокола кадров (modules/protocol.py)
+
+Запуск из корня репозитория: python -m unittest
+"""
+import unittest
+
+from modules.protocol import (FLAG_COMPRESSED, FLAG_FRAGMENT, HEADER_SIZE, MAGIC_VERSION, MAX_PAYLOAD,
+                              MSG_CHAT, MSG_PRESENCE, ProtocolError, TruncatedFrame, chat_name_end,
+                              decode_chat, decode_frame, decode_header, encode_chat, encode_frame,
+                              peek_sender)
+
+SENDER = 0x0123456789ABCDEF
+TIMESTAMP = 1234567890123 << 16 | 7
+
+
+class EncodeDecodeTest(unittest.TestCase):
+    def test_round_trip(self):
+        payload = encode_chat("пользователь", "Привет, коллеги!")
+        data = encode_frame(MSG_CHAT, SENDER, 42, TIMESTAMP, payload, FLAG_FRAGMENT | FLAG_COMPRESSED)
+        frame = decode_frame(data)
+        self.assertEqual((frame.msg_type, frame.flags, frame.sender, frame.seq, frame.timestamp),
+                         (MSG_CHAT, FLAG_FRAGMENT | FLAG_COMPRESSED, SENDER, 42, TIMESTAMP))
+        self.assertEqual(bytes(frame.payload), payload)
+        self.assertEqual(decode_chat(frame.payload), ("пользователь", "Привет, коллеги!"))
+
+    def test_header_fields(self):
+        data = encode_frame(MSG_PRESENCE, SENDER, 0, 5, b'abc')
+        self.assertEqual(len(data), HEADER_SIZE + 3)
+        self.assertEqual(data[0], MAGIC_VERSION)
+        self.assertEqual(decode_header(data), (MSG_PRESENCE, 0, SENDER, 0, 5, 3))
+
+    def test_seq_wraps_to_32_bits(self):
+        frame = decode_frame(encode_frame(MSG_CHAT, SENDER, (1 << 32) + 5, 0, b''))
+        self.assertEqual(frame.seq, 5)
+
+    def test_trailing_bytes_ignored(self):
+        frame = decode_frame(encode_frame(MSG_CHAT, SENDER, 1, 0, b'abc') + b'tail')
+        self.assertEqual(bytes(frame.payload), b'abc')
+
+    def test_payload_limit(self):
+        encode_frame(MSG_CHAT, SENDER, 1, 0, bytes(MAX_PAYLOAD))
+        with self.assertRaises(ProtocolError):
+            encode_frame(MSG_CHAT, SENDER, 1, 0, bytes(MAX_PAYLOAD + 1))
+
+    def test_chat_edge_cases(self):
+        self.assertEqual(decode_chat(encode_chat("", "")), ("", ""))
+        self.assertEqual(decode_chat(encode_chat("host:with:colons", "a:b:c")), ("host:with:colons", "a:b:c"))
+        # Имя длиннее 255 байт обрезается, текст остаётся целым
+        name, text = decode_chat(encode_chat("я" * 200, "текст"))
+        self.assertTrue(name.startswith("я" * 127))
+        self.assertEqual(text, "текст")
+
+    def test_broken_chat(self):
+        with self.assertRaises(ProtocolError):
+            chat_name_end(b'')
+        with self.assertRaises(ProtocolError):
+            decode_chat(b'\x05abc')
+
+
+class PeekSenderTest(unittest.TestCase):
+    def test_own_frame(self):
+        self.assertEqual(peek_sender(encode_frame(MSG_CHAT, SENDER, 1, 0, b'x')), SENDER)
+
+    def test_memoryview(self):
+        data = bytearray(encode_frame(MSG_CHAT, SENDER, 1, 0, b'x'))
+        self.assertEqual(peek_sender(memoryview(data)), SENDER)
+
+    def test_short_datagram(self):
+        data = encode_frame(MSG_CHAT, SENDER, 1, 0, b'')
+        self.assertIsNone(peek_sender(data[:HEADER_SIZE - 1]))
+        self.assertIsNone(peek_sender(b''))
+
+
+class TruncatedFrameTest(unittest.TestCase):
+    def test_short_header(self):
+        data = encode_frame(MSG_CHAT, SENDER, 1, 0, b'abc')
+        for size in range(HEADER_SIZE):
+            with self.assertRaises(TruncatedFrame):
+                decode_frame(data[:size])
+
+    def test_short_payload(self):
+        data = encode_frame(MSG_CHAT, SENDER, 1, 0, b'\x00abc')
+        with self.assertRaises(TruncatedFrame):
+            decode_frame(data[:-1])
+        with self.assertRaises(TruncatedFrame):
+            decode_header(data[:-1])
+
+    def test_truncated_is_protocol_error(self):
+        self.assertTrue(issubclass(TruncatedFrame, ProtocolError))
+
+
+class ForeignMagicTest(unittest.TestCase):
+    def test_old_text_format(self):
+        data = b"192.168.1.10:hello world, this is the old text format"
+        self.assertIsNone(peek_sender(data))
+        with self.assertRaises(ProtocolError):
+            decode_frame(data)
+
+    def test_other_version(self):
+        data = bytearray(encode_frame(MSG_CHAT, SENDER, 1, 0, b'abc'))
+        data[0] = MAGIC_VERSION + 1
+        self.assertIsNone(peek_sender(data))
+        with self.assertRaises(ProtocolError) as context:
+            decode_frame(data)
+        self.assertNotIsInstance(context.exception, TruncatedFrame)
+
+
+if __name__ == "__main__":
+    unittest.main()